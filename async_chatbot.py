@@ -0,0 +1,199 @@
+import json
+import asyncio
+import time
+import openai
+from openai.types import CompletionUsage
+from typing import AsyncIterator, List, Dict, Optional, Tuple, Union
+from chatbot import ChatBot
+from clients import get_async_client
+from tokens import count_message_tokens
+
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def run_sync(coroutine):
+    """
+    Runs a coroutine from synchronous code on a loop that lives as long as the process.
+    Reusing one loop keeps the pooled connections of the shared async client alive between calls.
+    """
+    global _loop
+    if _loop is None:
+        _loop = asyncio.new_event_loop()
+    return _loop.run_until_complete(coroutine)
+
+
+class AsyncChatBot(ChatBot):
+    """
+    An asyncio version of ChatBot. Requests go through a shared, pooled async client,
+    so many requests (or many bots) can be in flight at once, and through the scheduler
+    and the response cache like ChatBot's.
+    """
+
+    def __init__(self, *args, **kwargs):
+        """
+        Takes the same arguments as ChatBot.
+        """
+        super().__init__(*args, **kwargs)
+        self.async_client = get_async_client(self.api_key, self.base_url)
+
+    @classmethod
+    def from_bot(cls, bot: ChatBot) -> "AsyncChatBot":
+        """
+        Creates an AsyncChatBot with the same settings, system prompt and history as bot.
+        The history is shared, not copied.
+        """
+        async_bot = cls(
+            api_key=bot.api_key,
+            model=bot.model,
+            max_history_length=bot.max_history_length,
+            max_history_tokens=bot.max_history_tokens,
+            reply_reserve=bot.reply_reserve,
+            base_url=bot.base_url,
+            history_trim_target=bot.history_trim_target,
+            response_cache=bot.response_cache,
+            scheduler=bot.scheduler,
+        )
+        async_bot.system_prompt = bot.system_prompt
+        async_bot._store = bot._store
+        async_bot._history_lock = bot._history_lock
+        return async_bot
+
+    async def _complete(self, messages: List[Dict[str, str]], model: str) -> str:
+        raw = await self.scheduler.call_async(
+            lambda timeout: self.async_client.chat.completions.with_raw_response.create(
+                model=model,
+                messages=messages,
+                timeout=timeout,
+            ),
+            estimated_tokens=sum(count_message_tokens(message) for message in messages),
+        )
+        return raw.parse().choices[0].message.content.strip()
+
+    async def send_message(self, user_input: str, model: Optional[str] = None) -> str:
+        """
+        Sends a user message to the OpenAI API and returns the chatbot's response.
+
+        :param user_input: The input message from the user.
+        :param model: (Optional) The model to use for this specific message.
+        :return: The chatbot's response.
+        """
+        self._append_message("user", user_input)
+
+        if model:
+            self.set_model(model)
+
+        try:
+            assistant_message = await self._complete(self._format_system_prompt(), self.model)
+            self._append_message("assistant", assistant_message)
+            return assistant_message
+
+        except openai.OpenAIError as e:
+            # Handle API errors gracefully
+            print(f"An error occurred: {e}")
+            return "I'm sorry, but I'm unable to process your request at the moment."
+
+    async def stream_message(self, user_input: str, model: Optional[str] = None,
+                             use_cache: bool = True) -> AsyncIterator[str]:
+        """
+        Sends a user message to the OpenAI API and yields the chatbot's response as it arrives.
+        Like ChatBot.stream_message, the reply is appended to the history once the stream
+        ends, and a reply that was cut off is kept as far as it got.
+
+        :param user_input: The input message from the user.
+        :param model: (Optional) The model to use for this specific message.
+        :param use_cache: Whether the response cache may answer this message, if there is one.
+        :return: An async iterator over the chunks of the chatbot's response.
+        """
+        self._append_message("user", user_input)
+
+        if model:
+            self.set_model(model)
+
+        messages = self._format_system_prompt()
+        cache_key = self._get_cache_key(messages, use_cache)
+        if cache_key:
+            assistant_message = await asyncio.to_thread(self.response_cache.get, cache_key)
+            if assistant_message is not None:
+                self.last_usage = None
+                self._append_message("assistant", assistant_message)
+                yield assistant_message
+                return
+
+        chunks: List[str] = []
+        self.last_usage = None
+        streams = []
+
+        def open_stream(timeout):
+            streams.append(self.async_client.chat.completions.with_streaming_response.create(
+                model=self.model,
+                messages=messages,
+                stream=True,
+                stream_options={"include_usage": True},
+                timeout=timeout,
+            ))
+            return streams[-1].__aenter__()  # Sends the request; a failed one is retried
+
+        try:
+            # The events are parsed from the raw stream instead of into the SDK's chunk models,
+            # which takes most of the CPU time of a streamed reply when many are in flight
+            response = await self.scheduler.call_async(
+                open_stream, estimated_tokens=sum(count_message_tokens(message) for message in messages))
+            try:
+                async for line in response.iter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[5:].strip()
+                    if data == "[DONE]":
+                        break
+                    event = json.loads(data)
+                    if event.get("error"):
+                        raise openai.OpenAIError(event["error"].get("message", "The stream failed."))
+                    if event.get("usage"):
+                        self._record_usage(CompletionUsage.model_validate(event["usage"]))  # Sent in the last event
+                    if not event.get("choices"):
+                        continue
+                    delta = event["choices"][0].get("delta", {}).get("content")
+                    if delta:
+                        chunks.append(delta)
+                        yield delta
+            finally:
+                await streams[-1].__aexit__(None, None, None)  # Releases the connection
+            # Only complete replies are cached
+            if cache_key:
+                await asyncio.to_thread(self.response_cache.put, cache_key, self.model, "".join(chunks).strip())
+
+        except (openai.OpenAIError, ValueError) as e:
+            # Handle API errors gracefully
+            print(f"An error occurred: {e}")
+            if not chunks:
+                yield "I'm sorry, but I'm unable to process your request at the moment."
+
+        finally:
+            # Leaving the block above releases the connection if the stream was cut off.
+            # Keep whatever was received, even if the stream ended early
+            assistant_message = "".join(chunks).strip()
+            if assistant_message:
+                self._append_message("assistant", assistant_message)
+
+    async def compare(self, user_input: str, models: List[str]) -> Dict[str, Tuple[Union[str, Exception], float]]:
+        """
+        Sends the same history plus user_input to several models concurrently.
+        The history is not modified.
+
+        :param user_input: The input message from the user.
+        :param models: The models to ask.
+        :return: For each model, its response (or the error it raised) and the seconds it took.
+        """
+        history = self.chat_history + [{"role": "user", "content": user_input}]
+
+        async def ask(model: str):
+            start = time.monotonic()
+            try:
+                result = await self._complete(self._format_messages(history, model), model)
+            except openai.OpenAIError as e:
+                result = e
+            return result, time.monotonic() - start
+
+        results = await asyncio.gather(*(ask(model) for model in models))
+        return dict(zip(models, results))
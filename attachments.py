@@ -0,0 +1,284 @@
+import os
+import re
+import json
+import math
+import mmap
+import struct
+import hashlib
+import zlib
+from typing import Dict, List, Optional, Tuple
+from tokens import count_tokens
+
+CHUNK_BYTES = 4096  # Chunks end at the first line break after this many bytes
+MAX_LINE_BYTES = 4096  # How far past CHUNK_BYTES a line break is looked for
+MASK_BITS = 1024  # Words of a chunk are hashed into a bit mask of this size to score it
+PART_HEADER_TOKENS = 16  # The line that introduces every included chunk
+MAX_MISSES = 16  # Chunks in a row that did not fit, after which the budget counts as full
+
+# Runs of letters, with every byte of a UTF-8 character counted as a letter; digits are left
+# out, so timestamps and ids in logs do not fill up the masks
+_WORDS = re.compile(rb"(?:[a-z]|[\x80-\xff]){2,}")
+# Offset, length, first line, tokens (-1 until counted), digest, word mask
+_RECORD = struct.Struct(f"<QIQi16s{MASK_BITS // 8}s")
+_TOKENS = struct.Struct("<i")
+_TOKENS_OFFSET = 20  # Of the tokens field in a record
+_INDEX_VERSION = 1
+
+
+def _word_mask(data: bytes) -> int:
+    mask = 0
+    for word in set(_WORDS.findall(data.lower())):
+        mask |= 1 << zlib.crc32(word) % MASK_BITS
+    return mask
+
+
+class Chunk:
+    __slots__ = ("offset", "length", "line", "tokens", "digest", "mask")
+
+    def __init__(self, offset: int, length: int, line: int, tokens: int, digest: bytes, mask: int):
+        self.offset = offset
+        self.length = length
+        self.line = line  # Number of the first line, counting from 1
+        self.tokens = tokens  # -1 until the chunk is first considered for a request
+        self.digest = digest
+        self.mask = mask
+
+
+class FileIndex:
+    """
+    The chunks of one file, with the signature of the file they were made from.
+    """
+
+    def __init__(self, path: str, size: int, mtime_ns: int, chunks: List[Chunk]):
+        self.path = path
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.chunks = chunks
+        self.reused = 0  # Chunks taken from the cache instead of being hashed again
+
+
+class AttachmentIndex:
+    """
+    Turns local files into request context that fits a token budget.
+
+    Files are memory-mapped and split into chunks at line breaks, so even logs of hundreds of
+    megabytes are never read into memory as a whole. The digest and hashed words of every
+    chunk are cached on disk, and so are the token counts, which are only counted for chunks
+    that are considered for a request. Attaching an unchanged file again reads only the cache;
+    after a change, chunks whose digest is known keep their token counts.
+
+    For a question, the chunks are scored by the question words they contain, weighted by how
+    rare the words are in the file. The best ones that fit the budget are included in file
+    order, and the rest of the budget goes to the start and the end of the file.
+    """
+
+    def __init__(self, path: Optional[str] = None, chunk_bytes: int = CHUNK_BYTES):
+        """
+        :param path: The cache directory. Defaults to 'attachments' in CACHE_PATH.
+        :param chunk_bytes: The size chunks are cut at.
+        """
+        if path is None:
+            cache_dir = os.getenv('CACHE_PATH')
+            if not cache_dir:
+                raise EnvironmentError("CACHE_PATH environment variable not set.")
+            path = os.path.join(cache_dir, 'attachments')
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.chunk_bytes = chunk_bytes
+        self.pending: List[str] = []  # Files attached to the next question
+
+    def _cache_path(self, file_path: str) -> str:
+        name = hashlib.blake2b(file_path.encode('utf-8'), digest_size=12).hexdigest()
+        return os.path.join(self.path, f"{name}.idx")
+
+    def _header(self, index: FileIndex) -> bytes:
+        return json.dumps({"version": _INDEX_VERSION, "path": index.path, "size": index.size,
+                           "mtime_ns": index.mtime_ns, "chunk_bytes": self.chunk_bytes}).encode('utf-8') + b"\n"
+
+    def _load(self, file_path: str) -> Optional[FileIndex]:
+        try:
+            with open(self._cache_path(file_path), 'rb') as file:
+                header = json.loads(file.readline())
+                if header.get("version") != _INDEX_VERSION or header.get("chunk_bytes") != self.chunk_bytes \
+                        or header.get("path") != file_path:
+                    return None
+                data = file.read()
+        except (OSError, ValueError):
+            return None
+        if len(data) % _RECORD.size:
+            return None  # Torn write
+        chunks = [Chunk(offset, length, line, tokens, digest, int.from_bytes(mask, 'little'))
+                  for offset, length, line, tokens, digest, mask in _RECORD.iter_unpack(data)]
+        return FileIndex(file_path, header["size"], header["mtime_ns"], chunks)
+
+    def _store(self, index: FileIndex):
+        # Written to a temporary file and renamed, so a crash never leaves half an index
+        path = self._cache_path(index.path)
+        temporary = f"{path}.{os.getpid()}.tmp"
+        mask_bytes = MASK_BITS // 8
+        try:
+            with open(temporary, 'wb') as file:
+                file.write(self._header(index))
+                for chunk in index.chunks:
+                    file.write(_RECORD.pack(chunk.offset, chunk.length, chunk.line, chunk.tokens, chunk.digest,
+                                            chunk.mask.to_bytes(mask_bytes, 'little')))
+            os.replace(temporary, path)
+        except OSError:
+            pass  # The file is chunked again next time
+
+    def _store_tokens(self, index: FileIndex, positions: List[int]):
+        """
+        Writes the token counts of some chunks into the cached index, in place.
+        """
+        start = len(self._header(index))
+        try:
+            with open(self._cache_path(index.path), 'r+b') as file:
+                for position in positions:
+                    file.seek(start + position * _RECORD.size + _TOKENS_OFFSET)
+                    file.write(_TOKENS.pack(index.chunks[position].tokens))
+        except OSError:
+            pass  # Counted again next time
+
+    def _boundaries(self, data) -> List[Tuple[int, int]]:
+        """
+        Returns the start and end of every chunk of data, cut at line breaks where possible
+        and otherwise between UTF-8 characters.
+        """
+        size = len(data)
+        boundaries = []
+        start = 0
+        while start < size:
+            end = start + self.chunk_bytes
+            if end >= size:
+                end = size
+            else:
+                newline = data.find(b"\n", end, end + MAX_LINE_BYTES)
+                if newline != -1:
+                    end = newline + 1
+                else:
+                    # No line break nearby: do not split a character
+                    while end > start + 1 and data[end] & 0xC0 == 0x80:
+                        end -= 1
+            boundaries.append((start, end))
+            start = end
+        return boundaries
+
+    def index(self, file_path: str) -> FileIndex:
+        """
+        Returns the chunks of a file, from the cache if the file has not changed.
+
+        :raises ValueError: If the file is not a text file.
+        """
+        file_path = os.path.realpath(file_path)
+        stat = os.stat(file_path)
+        cached = self._load(file_path)
+        if cached is not None and cached.size == stat.st_size and cached.mtime_ns == stat.st_mtime_ns:
+            cached.reused = len(cached.chunks)
+            return cached
+        known: Dict[bytes, Chunk] = {chunk.digest: chunk for chunk in cached.chunks} if cached else {}
+
+        chunks = []
+        reused = 0
+        if stat.st_size:
+            with open(file_path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                if b"\0" in data[:self.chunk_bytes]:
+                    raise ValueError(f"'{os.path.basename(file_path)}' is not a text file.")
+                line = 1
+                for start, end in self._boundaries(data):
+                    raw = data[start:end]
+                    digest = hashlib.blake2b(raw, digest_size=16).digest()
+                    previous = known.get(digest)
+                    if previous is not None:
+                        tokens, mask = previous.tokens, previous.mask
+                        reused += 1
+                    else:
+                        tokens, mask = -1, _word_mask(raw)
+                    chunks.append(Chunk(start, end - start, line, tokens, digest, mask))
+                    line += raw.count(b"\n")
+        index = FileIndex(file_path, stat.st_size, stat.st_mtime_ns, chunks)
+        index.reused = reused
+        self._store(index)
+        return index
+
+    def _order(self, index: FileIndex, question: str) -> List[int]:
+        """
+        Returns the positions of the chunks in the order they should be included: the ones
+        that match the question best first, then from the start and the end of the file.
+        """
+        count = len(index.chunks)
+        # Rare words tell more about a chunk than words that are in most of them
+        weights = {}
+        for word in set(_WORDS.findall(question.encode('utf-8').lower())):
+            flag = 1 << zlib.crc32(word) % MASK_BITS
+            if flag in weights:
+                continue
+            frequency = sum(1 for chunk in index.chunks if chunk.mask & flag)
+            if frequency:
+                weights[flag] = math.log((count + 1) / (frequency + 0.5))
+        scores = [sum(weight for flag, weight in weights.items() if chunk.mask & flag) for chunk in index.chunks]
+        matches = sorted((i for i in range(count) if scores[i] > 0), key=lambda i: -scores[i])
+        # The start and the end, e.g. the header of a document and the latest lines of a log
+        edges = [i for pair in zip(range(count), reversed(range(count))) for i in pair][:count]
+        return matches + edges
+
+    def select(self, index: FileIndex, question: str, max_tokens: int) -> List[Chunk]:
+        """
+        Returns the chunks that best match question and fit into max_tokens, in file order.
+        A file that fits as a whole is included as a whole.
+        """
+        selected = set()
+        counted = []
+        tokens = 0
+        misses = 0
+        with open(index.path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for position in self._order(index, question):
+                if position in selected:
+                    continue
+                chunk = index.chunks[position]
+                if chunk.tokens < 0:
+                    chunk.tokens = count_tokens(
+                        data[chunk.offset:chunk.offset + chunk.length].decode('utf-8', errors='replace'))
+                    counted.append(position)
+                if tokens + chunk.tokens + PART_HEADER_TOKENS <= max_tokens:
+                    selected.add(position)
+                    tokens += chunk.tokens + PART_HEADER_TOKENS
+                    misses = 0
+                else:
+                    misses += 1
+                    if misses == MAX_MISSES:
+                        break
+        if counted:
+            self._store_tokens(index, counted)
+        return [index.chunks[i] for i in sorted(selected)]
+
+    def build_context(self, file_path: str, question: str, max_tokens: int) -> Tuple[str, Dict[str, int]]:
+        """
+        Builds the text of a file attached to a question: the parts of the file that best
+        match the question and fit into max_tokens.
+
+        :param file_path: The file to attach.
+        :param question: The question about the file.
+        :param max_tokens: How many tokens the parts of the file may take up.
+        :return: The text, and how many of the chunks of the file it includes and their tokens.
+        """
+        index = self.index(file_path)
+        name = os.path.basename(index.path)
+        chunks = self.select(index, question, max_tokens) if index.chunks else []
+        parts = []
+        if chunks:
+            with open(index.path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                for chunk in chunks:
+                    text = data[chunk.offset:chunk.offset + chunk.length].decode('utf-8', errors='replace')
+                    last_line = chunk.line + text.rstrip("\n").count("\n")
+                    parts.append(f"--- {name}, lines {chunk.line}-{last_line} ---\n{text.rstrip()}")
+        if len(chunks) == len(index.chunks):
+            intro = f"The attached file {name}:"
+        else:
+            intro = (f"Parts of the attached file {name} ({len(chunks)} of {len(index.chunks)}, "
+                     f"the ones that best match the question):")
+        stats = {
+            "chunks": len(index.chunks),
+            "included": len(chunks),
+            "tokens": sum(chunk.tokens for chunk in chunks),
+        }
+        return "\n\n".join([intro] + parts), stats
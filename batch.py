@@ -0,0 +1,187 @@
+import os
+import json
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Callable, Dict, Iterator, Optional, Set, Tuple
+from chatbot import ChatBot
+from ui import print_info, print_error
+
+
+def get_prompts(item: Dict) -> list:
+    """
+    Returns the user messages of an input line: "prompt" (a string, or a list of strings for
+    a conversation of several turns), or "body" with an optional "title", as in requests.jsonl.
+    """
+    prompt = item.get("prompt")
+    if prompt is None and item.get("body") is not None:
+        prompt = f"{item['title']}\n\n{item['body']}" if item.get("title") else item["body"]
+    if isinstance(prompt, str):
+        prompt = [prompt]
+    if not prompt or not all(isinstance(part, str) for part in prompt):
+        raise ValueError("Line has no 'prompt' or 'body'.")
+    return prompt
+
+
+def read_completed(output_path: str) -> Set[int]:
+    """
+    Returns the input line numbers the output file already holds a response for. A torn
+    last line, left behind when a run was killed in the middle of a write, is cut off.
+    """
+    completed = set()
+    if not os.path.exists(output_path):
+        return completed
+    with open(output_path, 'rb+') as file:
+        end = 0
+        for raw in file:
+            if not raw.endswith(b"\n"):
+                break
+            end += len(raw)
+            try:
+                record = json.loads(raw)
+            except ValueError:
+                continue
+            if "response" in record:
+                completed.add(record["line"])
+        file.truncate(end)
+    return completed
+
+
+def read_jobs(input_path: str, completed: Set[int]) -> Iterator[Tuple[int, Optional[Dict], Optional[str]]]:
+    """
+    Reads the input file one line at a time and yields (line number, parsed line, error)
+    for every line that is not completed yet.
+    """
+    with open(input_path, encoding='utf-8') as file:
+        for number, line in enumerate(file, 1):
+            if number in completed or not line.strip():
+                continue
+            try:
+                item = json.loads(line)
+                if not isinstance(item, dict):
+                    raise ValueError("Line is not a JSON object.")
+                yield number, item, None
+            except ValueError as e:
+                yield number, None, str(e)
+
+
+def run_job(number: int, item: Dict, create_bot: Callable[[], ChatBot]) -> Dict:
+    """
+    Runs one input line in a session of its own and returns its output record.
+    """
+    record = {"line": number}
+    for key in ("id", "request_id"):
+        if key in item:
+            record[key] = item[key]
+    start = time.perf_counter()
+    try:
+        prompts = get_prompts(item)
+        bot = create_bot()
+        if item.get("system"):
+            bot.set_system_prompt(item["system"])
+        if item.get("model"):
+            bot.set_model(item["model"])
+        responses = [bot.send_message(prompt, raise_errors=True) for prompt in prompts]
+        record["response"] = responses[-1] if len(responses) == 1 else responses
+        record["model"] = bot.model
+        record["usage"] = bot.last_usage
+    except Exception as e:
+        record["error"] = f"{type(e).__name__}: {e}"
+    record["seconds"] = round(time.perf_counter() - start, 3)
+    return record
+
+
+def run_batch(
+    input_path: str,
+    output_path: str,
+    create_bot: Callable[[], ChatBot],
+    concurrency: int = 4
+) -> Dict[str, int]:
+    """
+    Sends every line of a JSONL file of prompts to the API, concurrently, and appends a JSONL
+    record per line to the output file as soon as it is done. The input is read as the workers
+    need it, so its size does not matter. Lines that already have a response in the output
+    file are skipped, so an interrupted run resumes where it stopped; failed lines are retried.
+
+    :param input_path: The JSONL file of prompts.
+    :param output_path: The JSONL file the results are appended to.
+    :param create_bot: Creates the ChatBot for a line. Every line gets a session of its own.
+    :param concurrency: How many lines are sent at once.
+    :return: How many lines succeeded, failed and were skipped as already completed.
+    """
+    completed = read_completed(output_path)
+    counts = {"succeeded": 0, "failed": 0, "skipped": len(completed)}
+
+    with open(output_path, 'a', encoding='utf-8') as output, \
+            ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="batch") as pool:
+
+        def write(futures):
+            for future in futures:
+                record = future.result()
+                counts["succeeded" if "response" in record else "failed"] += 1
+                output.write(json.dumps(record, ensure_ascii=False) + "\n")
+            output.flush()
+
+        pending = set()
+        try:
+            for number, item, error in read_jobs(input_path, completed):
+                if error is not None:
+                    counts["failed"] += 1
+                    output.write(json.dumps({"line": number, "error": error}) + "\n")
+                    continue
+                # Keep only a few lines per worker in flight, the rest of the input stays on disk
+                if len(pending) >= 2 * concurrency:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    write(done)
+                pending.add(pool.submit(run_job, number, item, create_bot))
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                write(done)
+        except KeyboardInterrupt:
+            print_info("Interrupted, finishing the prompts in flight. Run the same command again to resume.")
+            for future in pending:
+                future.cancel()
+            pool.shutdown(wait=True)
+            write(future for future in pending if not future.cancelled())
+            raise
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="main.py batch",
+        description="Sends a JSONL file of prompts to the API and writes the responses as JSONL."
+    )
+    parser.add_argument("input", help="JSONL file with a 'prompt' (or 'title' and 'body') per line")
+    parser.add_argument("output", help="JSONL file the responses are appended to")
+    parser.add_argument("--concurrency", type=int, default=4, help="how many prompts are sent at once")
+    parser.add_argument("--model", default="gpt-4o-mini", help="the model, unless a line sets 'model'")
+    parser.add_argument("--system", help="the system prompt, unless a line sets 'system'")
+    args = parser.parse_args(argv)
+
+    from dotenv import load_dotenv
+    from request_scheduler import RequestScheduler
+    from response_cache import ResponseCache
+    load_dotenv()
+
+    api_key = os.getenv('OPENAI_API_KEY')
+    if not api_key:
+        print_error("API key must be provided via the OPENAI_API_KEY environment variable.")
+        return 1
+    # The sessions share one scheduler, so together they stay within the rate limits
+    scheduler = RequestScheduler()
+    response_cache = ResponseCache() if os.getenv('RESPONSE_CACHE', '').lower() in ('1', 'true', 'yes') else None
+
+    def create_bot():
+        bot = ChatBot(api_key=api_key, model=args.model, response_cache=response_cache, scheduler=scheduler)
+        if args.system:
+            bot.set_system_prompt(args.system)
+        return bot
+
+    try:
+        counts = run_batch(args.input, args.output, create_bot, max(args.concurrency, 1))
+    except KeyboardInterrupt:
+        return 130
+    print_info(f"{counts['succeeded']} lines succeeded, {counts['failed']} failed, "
+               f"{counts['skipped']} were already done.")
+    return 1 if counts["failed"] else 0
@@ -0,0 +1,106 @@
+"""
+Measures attaching a large log file: chunking it the first time, attaching it again unchanged
+and after lines were appended, and picking the parts that match a question.
+
+    python benchmarks/attachments.py [--mb 200] [--budget 8000]
+
+The log is generated with one rare line (the "needle") in the middle; the question asks about
+it, so it should be among the parts that are sent. Python allocations are measured with
+tracemalloc, which shows whether the file was ever read into memory as a whole (the pages
+the kernel maps in for the mmap are not allocations and can be dropped at any time).
+The steps are run twice, to time them without tracemalloc slowing them down.
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from attachments import AttachmentIndex
+
+LEVELS = ["INFO", "INFO", "INFO", "DEBUG", "WARN"]
+EVENTS = ["request served in {} ms", "cache hit for key {}", "worker {} heartbeat", "connection {} closed",
+          "retrying job {} after timeout", "flushed {} records to disk"]
+NEEDLE = "ERROR payment gateway rejected settlement batch 4471: signature mismatch"
+
+
+def write_log(path: str, megabytes: int):
+    rng = random.Random(0)
+    target = megabytes * 1024 * 1024
+    written = 0
+    with open(path, "w") as file:
+        while written < target:
+            lines = [f"2024-05-01T12:{rng.randint(0, 59):02d}:{rng.randint(0, 59):02d} {rng.choice(LEVELS)} "
+                     f"{rng.choice(EVENTS).format(rng.randint(1, 99999))}" for _ in range(10000)]
+            if written < target // 2 <= written + 10000 * 60:
+                lines[5000] = f"2024-05-01T12:30:00 {NEEDLE}"
+            block = "\n".join(lines) + "\n"
+            file.write(block)
+            written += len(block)
+
+
+def measure(function, traced: bool):
+    """
+    Runs function and returns its result with the time it took or its peak allocations.
+    Tracing allocations slows Python down, so time and memory are measured in separate runs.
+    """
+    if traced:
+        tracemalloc.start()
+    start = time.perf_counter()
+    result = function()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] if traced else 0
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def steps(log_path: str, cache_path: str, question: str, budget: int, traced: bool):
+    """
+    Attaches the log the first time, unchanged, after an append, and selects its parts.
+    Returns the timings, peak allocations and results of the steps.
+    """
+    attachments = AttachmentIndex(cache_path)
+    results = [("first attach", *measure(lambda: attachments.index(log_path), traced))]
+    results.append(("unchanged", *measure(lambda: attachments.index(log_path), traced)))
+    with open(log_path, "a") as file:
+        file.write("2024-05-01T13:00:00 INFO restarted\n" * 2000)
+    results.append(("appended", *measure(lambda: attachments.index(log_path), traced)))
+    results.append(("select", *measure(lambda: attachments.build_context(log_path, question, budget), traced)))
+    results.append(("select again", *measure(lambda: attachments.build_context(log_path, question, budget), traced)))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mb", type=int, default=200, help="size of the log in MB")
+    parser.add_argument("--budget", type=int, default=8000, help="tokens the attached parts may take up")
+    args = parser.parse_args()
+
+    question = "Why did the payment gateway reject the settlement batch?"
+    with tempfile.TemporaryDirectory() as path:
+        log_path = os.path.join(path, "service.log")
+        write_log(log_path, args.mb)
+        size = os.path.getsize(log_path)
+        timed = steps(log_path, os.path.join(path, "timed"), question, args.budget, traced=False)
+        # The log was appended to; start the traced run from the same file
+        with open(log_path, "r+b") as file:
+            file.truncate(size)
+        traced = steps(log_path, os.path.join(path, "traced"), question, args.budget, traced=True)
+
+    print(f"{'step':<14} {'time':>9} {'peak heap':>10}  result")
+    for (name, result, elapsed, _), (_, _, _, peak) in zip(timed, traced):
+        if isinstance(result, tuple):
+            text, stats = result
+            detail = (f"{stats['included']} of {stats['chunks']} parts, {stats['tokens']} tokens, "
+                      f"needle {'included' if NEEDLE in text else 'MISSING'}")
+        else:
+            detail = f"{len(result.chunks)} chunks, {result.reused} from the cache"
+        print(f"{name:<14} {elapsed:>7.2f} s {peak / 1024 / 1024:>7.1f} MB  {detail}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Measures what the chat log manifest costs every save, the update and the quota check after
+it, with many cached chat logs, and checks that the quotas delete exactly the oldest logs.
+
+    python benchmarks/cache_manifest.py [--logs 10000] [--saves 500]
+
+The quotas are checked the way cleanup_cached_files does after every save. The baseline is
+what the check cost when it sorted every entry on every save.
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cache_manifest import CacheManifest
+
+PATTERN = 'cached_chatlog_*.jsonl'
+DAY = 24 * 3600
+
+
+def fill(path: str, logs: int) -> CacheManifest:
+    """
+    Records logs a minute apart, the newest one now. The files themselves are not needed.
+    """
+    manifest = CacheManifest(path, PATTERN)
+    now = time.time()
+    for number in range(logs):
+        manifest.update(f"cached_chatlog_{number:05d}.jsonl", 40 * 1024, 40, mtime=now - (logs - number) * 60)
+    return manifest
+
+
+def per_save(manifest: CacheManifest, saves: int, check) -> float:
+    name = "cached_chatlog_session.jsonl"
+    start = time.perf_counter()
+    for turn in range(saves):
+        manifest.update(name, 1024 * (turn + 1), turn + 1)
+        check(name)
+    return (time.perf_counter() - start) / saves
+
+
+def check_quotas(path: str, logs: int):
+    """
+    Nothing is deleted while every quota is met; past one, only the oldest logs are.
+    """
+    for number in range(logs):
+        open(os.path.join(path, f"cached_chatlog_{number:05d}.jsonl"), "wb").close()
+    manifest = fill(path, logs)
+    size = logs * 40 * 1024
+    assert manifest.enforce(max_files=logs, max_bytes=size, max_age=logs * 60 + DAY) == []
+    assert manifest.enforce(max_files=logs - 3) == [f"cached_chatlog_{number:05d}.jsonl" for number in range(3)]
+    assert manifest.enforce(max_bytes=size - 5 * 40 * 1024) == [f"cached_chatlog_{number:05d}.jsonl"
+                                                                 for number in range(3, 5)]
+    assert manifest.enforce(max_age=(logs - 7) * 60 + 30) == [f"cached_chatlog_{number:05d}.jsonl"
+                                                               for number in range(5, 7)]
+    assert len(manifest.entries()) == logs - 7 == len(os.listdir(path)) - 1  # And the journal
+    # Saving the oldest log makes it the newest, the next one is now the oldest
+    manifest.update("cached_chatlog_00007.jsonl", 40 * 1024, 41)
+    assert manifest.enforce(max_age=(logs - 8) * 60 + 30) == []
+    assert manifest.enforce(max_age=(logs - 9) * 60 + 30) == ["cached_chatlog_00008.jsonl"]
+    # Replayed by a second process, the totals are the same
+    assert CacheManifest(path, PATTERN).enforce(max_files=logs - 8, max_bytes=size - 8 * 40 * 1024) == []
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--logs", type=int, default=10000, help="number of cached chat logs")
+    parser.add_argument("--saves", type=int, default=500, help="saves to average over")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as path:
+        check_quotas(path, 100)
+    with tempfile.TemporaryDirectory() as path:
+        manifest = fill(path, args.logs)
+        quotas = dict(max_files=args.logs + 1, max_bytes=args.logs * 1024 * 1024, max_age=30 * DAY)
+
+        def sorted_check(name):
+            entries = manifest.entries()
+            sum(entry["size"] for entry in entries)
+
+        baseline = per_save(manifest, args.saves, sorted_check)
+        current = per_save(manifest, args.saves, lambda name: manifest.enforce(keep=(name,), **quotas))
+    print(f"{args.logs} chat logs, quotas met")
+    print(f"sorting every save:   {baseline * 1e6:8.0f} us per save")
+    print(f"running totals:       {current * 1e6:8.0f} us per save")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""
+Compares the memory and time a long session spends on its history, with the history kept
+in a ConversationStore and with the plain list it used to be.
+
+    python benchmarks/conversation_store.py [--turns 5000] [--window 2000]
+
+Every turn appends a question and a reply, builds the request messages and trims the window,
+and every tenth turn is undone. "list" replays what ChatBot did before: the request copied
+the history twice and /undo discarded the turn. Both run with the same chunked trimming.
+The extra memory a request needs is measured with tracemalloc, as the peak above what was
+allocated before it. "retained" is what the history holds at the end, undone turns included.
+"""
+import os
+import sys
+import time
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from conversation_store import ConversationStore
+
+SYSTEM_PROMPT = [{"role": "system", "content": "You are a helpful assistant"}]
+
+
+class ListHistory:
+    """
+    The history as ChatBot kept it before: a list of messages and a list of token counts.
+    """
+
+    def __init__(self):
+        self.messages = []
+        self.token_counts = []
+
+    def append(self, message, tokens):
+        self.messages.append(message)
+        self.token_counts.append(tokens)
+
+    def trim(self, count):
+        del self.messages[:count]
+        del self.token_counts[:count]
+
+    def request(self):
+        history = list(self.messages)
+        return SYSTEM_PROMPT + history
+
+    def undo(self):
+        self.messages.pop()
+        self.messages.pop()
+        self.token_counts.pop()
+        self.token_counts.pop()
+
+
+class StoreHistory:
+    def __init__(self):
+        self.store = ConversationStore()
+        self.messages = self.store.messages
+
+    def append(self, message, tokens):
+        self.store.append(message, tokens)
+
+    def trim(self, count):
+        self.store.trim(count)
+
+    def request(self):
+        return SYSTEM_PROMPT + self.store.messages
+
+    def undo(self):
+        self.store.undo(2)
+
+
+def run(history, turns: int, window: int, reply_chars: int, measure: bool) -> int:
+    """
+    Plays the session and returns the extra bytes of the largest request.
+    """
+    request_peak = 0
+
+    def peak_of(function):
+        if not measure:
+            function()
+            return 0
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        function()
+        return tracemalloc.get_traced_memory()[1] - before
+
+    reply = "word " * (reply_chars // 5)
+    for turn in range(turns):
+        history.append({"role": "user", "content": f"Question {turn}?"}, 8)
+        request_peak = max(request_peak, peak_of(history.request))
+        history.append({"role": "assistant", "content": f"{turn} {reply}"}, reply_chars // 5 + 4)
+        if len(history.messages) > window:
+            history.trim(window // 2)
+        if turn % 10 == 9:
+            history.undo()
+    return request_peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--turns", type=int, default=5000, help="turns of the session")
+    parser.add_argument("--window", type=int, default=2000, help="messages in the history window")
+    parser.add_argument("--reply-chars", type=int, default=500, help="length of every reply")
+    args = parser.parse_args()
+
+    print(f"{'history':<8} {'ms/turn':>8} {'request KiB':>12} {'retained KiB':>13}")
+    for name, factory in (("list", ListHistory), ("store", StoreHistory)):
+        start = time.perf_counter()
+        run(factory(), args.turns, args.window, args.reply_chars, measure=False)
+        elapsed = time.perf_counter() - start
+
+        tracemalloc.start()
+        history = factory()
+        request_peak = run(history, args.turns, args.window, args.reply_chars, measure=True)
+        retained = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print(f"{name:<8} {elapsed / args.turns * 1000:>8.3f} {request_peak / 1024:>12.1f} {retained / 1024:>13.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+Measures exporting cached chat logs: all of them at first, again unchanged, and after a few
+of them were touched or appended to, and how long the chat is held up while they are exported.
+
+    python benchmarks/exporter.py [--logs 1000] [--messages 40] [--workers N]
+
+The baseline renders every log serially in the chat's own process, with the history built
+as one string the way the chat used to save it as Markdown. The exporter is run with one
+worker process and with --workers (all cores by default). While it runs, the main thread
+wakes up every 10 ms; the longest it was late shows whether the export blocks the chat.
+"""
+import os
+import sys
+import time
+import html
+import json
+import random
+import argparse
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from chatlog_format import encode_messages, read_chatlog
+from exporter import Exporter, EXPORT_FORMATS
+
+WORDS = ("the loop runs over every item of the list and returns the sum of the values it found "
+         "while the function keeps the state of the parser in a dictionary").split()
+
+
+def write_logs(path: str, logs: int, messages: int):
+    rng = random.Random(0)
+    for number in range(logs):
+        conversation = [{"role": "user" if i % 2 == 0 else "assistant",
+                         "content": " ".join(rng.choice(WORDS) for _ in range(rng.randint(20, 400)))}
+                        for i in range(messages)]
+        with open(os.path.join(path, f"cached_chatlog_{number:05d}.jsonl"), "wb") as file:
+            file.write(encode_messages(conversation))
+
+
+def serial_baseline(sources, directory: str) -> float:
+    """
+    Renders every log in this process, building every output as one string.
+    """
+    os.makedirs(directory, exist_ok=True)
+    start = time.perf_counter()
+    for path, title in sources:
+        name = os.path.splitext(os.path.basename(path))[0]
+        messages = read_chatlog(path)
+        history = ""
+        for message in messages:
+            role = "User" if message["role"] == "user" else "Assistant"
+            history += f"**{role}**: \n\n{message['content']}\n\n"
+        page = "".join(f"<div>{role}{html.escape(message['content'])}</div>" for message in messages)
+        for fmt, text in (("md", history.strip()), ("html", page), ("json", json.dumps(messages))):
+            with open(os.path.join(directory, f"{name}.{fmt}"), "w") as file:
+                file.write(text)
+    return time.perf_counter() - start
+
+
+def export(exporter: Exporter, sources) -> tuple:
+    """
+    Runs a bulk export and returns its summary, how long it took and the longest the main
+    thread was kept waiting meanwhile.
+    """
+    done = threading.Event()
+    summaries = []
+    start = time.perf_counter()
+    exporter.export_all(sources, EXPORT_FORMATS, on_done=lambda summary: (summaries.append(summary), done.set()))
+    submitted = time.perf_counter()
+    lag = submitted - start
+    while not done.is_set():
+        before = time.perf_counter()
+        done.wait(0.01)
+        lag = max(lag, time.perf_counter() - before - 0.01)
+    return summaries[0], time.perf_counter() - start, lag
+
+
+def run(path: str, sources, workers: int) -> list:
+    exporter = Exporter(os.path.join(path, f"exports-{workers}"), max_workers=workers)
+    exporter.executor.submit(int).result()  # Start the worker processes before timing
+    results = [("cold", *export(exporter, sources))]
+    results.append(("unchanged", *export(exporter, sources)))
+    for source, _ in sources[:10]:
+        os.utime(source)
+    results.append(("10 touched", *export(exporter, sources)))
+    for source, _ in sources[10:20]:
+        with open(source, "ab") as file:
+            file.write(encode_messages([{"role": "user", "content": "one more question"}]))
+    results.append(("10 appended", *export(exporter, sources)))
+    exporter.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--logs", type=int, default=1000, help="number of chat logs")
+    parser.add_argument("--messages", type=int, default=40, help="messages of every chat log")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="worker processes")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as path:
+        logs = os.path.join(path, "logs")
+        os.makedirs(logs)
+        write_logs(logs, args.logs, args.messages)
+        sources = [(os.path.join(logs, name), None) for name in sorted(os.listdir(logs))]
+        size = sum(os.path.getsize(source) for source, _ in sources)
+        print(f"{args.logs} chat logs, {size / 1024 / 1024:.1f} MB, {os.cpu_count()} cores")
+        print(f"serial, in process:  {serial_baseline(sources, os.path.join(path, 'baseline')):.2f} s, "
+              f"blocks the chat throughout")
+        for workers in sorted({1, args.workers}):
+            for name, summary, elapsed, lag in run(path, sources, workers):
+                print(f"{workers} worker(s), {name + ':':<13} {elapsed:>6.2f} s, {summary['exported']:>5} exported, "
+                      f"{summary['skipped']:>5} skipped, {summary['written']:>5} files written, "
+                      f"chat held up {lag * 1000:.1f} ms at most")
+
+
+if __name__ == "__main__":
+    main()
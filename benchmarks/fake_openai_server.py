@@ -0,0 +1,221 @@
+"""
+A local stand-in for the OpenAI chat completions endpoint, for benchmarks and offline tests.
+
+    python benchmarks/fake_openai_server.py --port 8000 --latency 0.2 --chunk-rate 50
+
+Point the app at it with OPENAI_BASE_URL=http://127.0.0.1:8000/v1 (any API key works).
+It answers POST /v1/chat/completions, streaming or not, with a canned Markdown reply after
+a configurable time to first byte, and can inject rate limit (429) and server (500) errors.
+Like the real API, it reports prompt tokens as cached when the request starts with messages
+an earlier request started with, for prompts of at least 1024 tokens, in blocks of 128.
+"""
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+from dataclasses import dataclass
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+REPLY_PARAGRAPH = (
+    "Here is a **sample** answer with `inline code` and a list:\n\n"
+    "- first point\n- second point\n\n"
+    "```python\nfor i in range(3):\n    print(i)\n```\n\n"
+)
+
+
+@dataclass
+class FakeServerConfig:
+    latency: float = 0.05  # Seconds before the first byte of the response
+    chunk_rate: float = 200.0  # Streamed chunks per second, 0 for as fast as possible
+    chunk_chars: int = 16  # Characters per streamed chunk
+    reply_chars: int = 600  # Length of the reply
+    rate_limit_rate: float = 0.0  # Fraction of requests answered with a 429
+    server_error_rate: float = 0.0  # Fraction of requests answered with a 500
+    requests_limit: int = 10000  # Reported in the x-ratelimit-* headers
+    tokens_limit: int = 10000000
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "FakeOpenAI/1.0"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload, headers=()):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _rate_limit_headers(self):
+        config = self.server.config
+        return [
+            ("x-ratelimit-limit-requests", str(config.requests_limit)),
+            ("x-ratelimit-remaining-requests", str(config.requests_limit - 1)),
+            ("x-ratelimit-reset-requests", "60ms"),
+            ("x-ratelimit-limit-tokens", str(config.tokens_limit)),
+            ("x-ratelimit-remaining-tokens", str(config.tokens_limit - 1000)),
+            ("x-ratelimit-reset-tokens", "6ms"),
+        ]
+
+    def do_POST(self):
+        config = self.server.config
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        self.server.count_request()
+
+        roll = random.random()
+        if roll < config.rate_limit_rate:
+            self._send_json(429, {"error": {"message": "Rate limit reached", "type": "requests"}},
+                            [("retry-after-ms", "20")])
+            return
+        if roll < config.rate_limit_rate + config.server_error_rate:
+            self._send_json(500, {"error": {"message": "Injected server error", "type": "server_error"}})
+            return
+
+        time.sleep(config.latency)
+        reply = (REPLY_PARAGRAPH * (config.reply_chars // len(REPLY_PARAGRAPH) + 1))[:config.reply_chars]
+        prompt_chars, cached_chars = self.server.read_prefix(request.get("messages", []))
+        cached_tokens = cached_chars // 4 // 128 * 128 if prompt_chars // 4 >= 1024 else 0
+        usage = {
+            "prompt_tokens": prompt_chars // 4,
+            "completion_tokens": len(reply) // 4,
+            "total_tokens": (prompt_chars + len(reply)) // 4,
+            "prompt_tokens_details": {"cached_tokens": cached_tokens},
+        }
+        model = request.get("model", "fake")
+
+        if not request.get("stream"):
+            self._send_json(200, {
+                "id": "chatcmpl-fake", "object": "chat.completion", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": reply}, "finish_reason": "stop"}],
+                "usage": usage,
+            }, self._rate_limit_headers())
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        for name, value in self._rate_limit_headers():
+            self.send_header(name, value)
+        self.end_headers()
+
+        def send_event(payload):
+            data = f"data: {payload}\n\n".encode('utf-8')
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            self.wfile.flush()
+
+        def chunk(delta, finish_reason=None):
+            return json.dumps({
+                "id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": int(time.time()),
+                "model": model, "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            })
+
+        try:
+            send_event(chunk({"role": "assistant", "content": ""}))
+            for start in range(0, len(reply), config.chunk_chars):
+                send_event(chunk({"content": reply[start:start + config.chunk_chars]}))
+                if config.chunk_rate:
+                    time.sleep(1 / config.chunk_rate)
+            send_event(chunk({}, "stop"))
+            if (request.get("stream_options") or {}).get("include_usage"):
+                send_event(json.dumps({
+                    "id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": int(time.time()),
+                    "model": model, "choices": [], "usage": usage,
+                }))
+            send_event("[DONE]")
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # The client cancelled the stream
+
+
+class FakeOpenAIServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, config: FakeServerConfig = None, host: str = "127.0.0.1", port: int = 0):
+        super().__init__((host, port), _Handler)
+        self.config = config or FakeServerConfig()
+        self.requests = 0
+        self._count_lock = threading.Lock()
+        self._prefixes = set()  # Digests of every message prefix sent so far
+        self._thread = None
+
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError):  # Clients closing pooled connections
+            super().handle_error(request, client_address)
+
+    def count_request(self):
+        with self._count_lock:
+            self.requests += 1
+
+    def read_prefix(self, messages) -> tuple:
+        """
+        Returns the characters of the messages and how many of them, from the start and at
+        message boundaries, were already sent in an earlier request, and remembers the prefixes.
+        """
+        digest = hashlib.sha256()
+        length = cached = 0
+        with self._count_lock:
+            for message in messages:
+                digest.update(json.dumps(message, sort_keys=True).encode('utf-8'))
+                length += len(str(message.get("content", "")))
+                key = digest.digest()
+                if key in self._prefixes:
+                    cached = length
+                else:
+                    self._prefixes.add(key)
+        return length, cached
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> "FakeOpenAIServer":
+        """
+        Serves in a background thread and returns the server.
+        """
+        self._thread = threading.Thread(target=self.serve_forever, name="fake-openai", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=FakeServerConfig.latency, help="seconds to first byte")
+    parser.add_argument("--chunk-rate", type=float, default=FakeServerConfig.chunk_rate, help="streamed chunks per second")
+    parser.add_argument("--reply-chars", type=int, default=FakeServerConfig.reply_chars, help="length of the reply")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="fraction of requests answered with 429")
+    parser.add_argument("--server-error-rate", type=float, default=0.0, help="fraction of requests answered with 500")
+    args = parser.parse_args()
+
+    config = FakeServerConfig(
+        latency=args.latency,
+        chunk_rate=args.chunk_rate,
+        reply_chars=args.reply_chars,
+        rate_limit_rate=args.rate_limit_rate,
+        server_error_rate=args.server_error_rate,
+    )
+    server = FakeOpenAIServer(config, args.host, args.port)
+    print(f"Fake OpenAI server listening on {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
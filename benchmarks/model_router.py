@@ -0,0 +1,111 @@
+"""
+Simulates a session with automatic model selection and evaluates it from the routing log,
+the way a policy would be evaluated offline.
+
+    python benchmarks/model_router.py [--turns 1000] [--latency-target 8]
+
+Two models are simulated with log-normal first-token times and generation speeds: a slow,
+strong one and a fast, cheap one. Between --spike-start and --spike-end the strong model's
+first-token time is --spike-factor times as long, like a provider under load. The session
+runs once with every turn on the strong model and once with each routing policy. Time is
+simulated, so the run takes no longer than the routing itself.
+"""
+import os
+import sys
+import json
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import model_router
+from model_router import ModelRouter, get_price
+from perf_metrics import percentile
+
+MODELS = {
+    # First-token seconds, tokens per second
+    "gpt-4o": (0.6, 60.0),
+    "gpt-4o-mini": (0.35, 110.0),
+}
+
+
+class SimulatedClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def time(self) -> float:
+        return self.now
+
+
+def simulate(model: str, turn: int, args, rng: random.Random):
+    ttft, speed = MODELS[model]
+    ttft *= rng.lognormvariate(0, 0.3)
+    if model == "gpt-4o" and args.spike_start <= turn < args.spike_end:
+        ttft *= args.spike_factor
+    reply_tokens = int(rng.uniform(100, 600))
+    return ttft, ttft + reply_tokens / (speed * rng.lognormvariate(0, 0.15)), reply_tokens
+
+
+def run(args, policy: str, log_path: str):
+    clock = SimulatedClock()
+    model_router.time = clock  # Cooldowns pass in simulated time
+    router = ModelRouter(list(MODELS), latency_target=args.latency_target if policy == "target" else None,
+                         log_path=log_path)
+    rng = random.Random(0)
+    for turn in range(args.turns):
+        prompt_tokens = 500 + turn % 50 * 100
+        decision = router.route(prompt_tokens)
+        if policy == "fixed":
+            decision["model"] = "gpt-4o"
+        ttft, latency, reply_tokens = simulate(decision["model"], turn, args, rng)
+        clock.now += latency + args.think_time
+        router.record(decision, ttft, latency, {"prompt_tokens": prompt_tokens, "completion_tokens": reply_tokens})
+
+
+def evaluate(log_path: str):
+    """
+    Reads back a routing log and returns the first-token times, the latencies, the cost and
+    the models of its turns.
+    """
+    ttfts, latencies, cost, models = [], [], 0.0, {}
+    with open(log_path) as file:
+        for line in file:
+            record = json.loads(line)
+            outcome = record["outcome"]
+            ttfts.append(outcome["ttft"])
+            latencies.append(outcome["latency"])
+            prices = get_price(record["model"])
+            cost += (outcome["prompt_tokens"] * prices[0] + outcome["completion_tokens"] * prices[1]) / 1e6
+            models[record["model"]] = models.get(record["model"], 0) + 1
+    return ttfts, latencies, cost, models
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--turns", type=int, default=1000, help="turns of the session")
+    parser.add_argument("--latency-target", type=float, default=8.0, help="seconds per reply for the target policy")
+    parser.add_argument("--spike-start", type=int, default=300, help="first turn of the latency spike")
+    parser.add_argument("--spike-end", type=int, default=400, help="first turn after the latency spike")
+    parser.add_argument("--spike-factor", type=float, default=8.0, help="how much slower the strong model gets")
+    parser.add_argument("--think-time", type=float, default=20.0, help="seconds between a reply and the next turn")
+    args = parser.parse_args()
+
+    print(f"{'policy':<8} {'TTFT p50':>9} {'p95':>6} {'p99':>6} {'latency p50':>12} {'p95':>6} {'cost $':>7}"
+          "  turns per model")
+    with tempfile.TemporaryDirectory() as path:
+        for policy in ("fixed", "router", "target"):
+            log_path = os.path.join(path, f"{policy}.jsonl")
+            run(args, policy, log_path)
+            ttfts, latencies, cost, models = evaluate(log_path)
+            print(f"{policy:<8} {percentile(ttfts, 0.5):>9.2f} {percentile(ttfts, 0.95):>6.2f} "
+                  f"{percentile(ttfts, 0.99):>6.2f} {percentile(latencies, 0.5):>12.2f} "
+                  f"{percentile(latencies, 0.95):>6.2f} {cost:>7.3f}  "
+                  + ", ".join(f"{model} {count}" for model, count in models.items()))
+
+
+if __name__ == "__main__":
+    main()
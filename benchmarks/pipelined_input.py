@@ -0,0 +1,121 @@
+"""
+Measures how long a multi-prompt session takes with serial and with pipelined input, and
+how quickly Ctrl+C cancels a reply, against the local fake OpenAI server.
+
+    python benchmarks/pipelined_input.py [--prompts 10] [--typing 1.0]
+
+The user is simulated: typing a prompt takes --typing seconds, and with pipelined input
+the typing goes on while earlier prompts are answered. Every turn streams the reply through
+the real renderer (into /dev/null) and saves the chat log, as the chat does.
+"""
+import os
+import sys
+import time
+import signal
+import argparse
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ui
+from rich.console import Console
+from benchmarks.fake_openai_server import FakeOpenAIServer, FakeServerConfig
+from chatbot import ChatBot
+from chat_log_manager import ChatLogManager
+from input_pipeline import InputPipeline
+
+
+def typist(prompts: int, typing: float):
+    remaining = iter(range(prompts))
+
+    def read():
+        number = next(remaining, None)
+        if number is None:
+            return None
+        time.sleep(typing)
+        return f"Question {number}: how do loops work?"
+    return read
+
+
+def answer(bot: ChatBot, log: ChatLogManager, prompt: str):
+    ui.print_bot_message_stream(bot.stream_message(prompt, use_cache=False))
+    log.save_chatlog(bot.chat_history)
+
+
+def run(base_url: str, prompts: int, typing: float, pipelined: bool) -> float:
+    bot = ChatBot(api_key="sk-benchmark", base_url=base_url, max_history_length=1000)
+    log = ChatLogManager()
+    read = typist(prompts, typing)
+    start = time.perf_counter()
+    if pipelined:
+        pipeline = InputPipeline(read).start()
+        for prompt in iter(pipeline.get, None):
+            answer(bot, log, prompt)
+    else:
+        for prompt in iter(read, None):
+            answer(bot, log, prompt)
+    log.flush()
+    return time.perf_counter() - start
+
+
+def check_end_of_input():
+    """
+    The end of the input is not a queued prompt: once the last prompt is taken, none are queued.
+    """
+    inputs = iter(["first", "second"])
+    pipeline = InputPipeline(lambda: next(inputs, None)).start()
+    pipeline._thread.join()  # Both prompts and the end of the input are queued
+    assert pipeline.pending() == 2, pipeline.pending()
+    assert pipeline.get() == "first" and pipeline.pending() == 1, pipeline.pending()
+    assert pipeline.get() == "second" and pipeline.pending() == 0, pipeline.pending()
+    assert pipeline.get() is None and pipeline.pending() == 0, pipeline.pending()
+
+
+def cancel_delay(base_url: str) -> float:
+    """
+    Interrupts a reply the way Ctrl+C does and returns how long it took to stop.
+    """
+    bot = ChatBot(api_key="sk-benchmark", base_url=base_url)
+    chunks = bot.stream_message("Write a long story.", use_cache=False)
+    interrupted = []
+    timer = threading.Timer(0.5, lambda: (interrupted.append(time.perf_counter()), os.kill(os.getpid(), signal.SIGINT)))
+    timer.start()
+    try:
+        ui.print_bot_message_stream(chunks)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        chunks.close()
+    stopped = time.perf_counter()
+    assert bot.chat_history[-1]["role"] == "assistant", "the partial reply should be kept"
+    return stopped - interrupted[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--prompts", type=int, default=10, help="prompts of the session")
+    parser.add_argument("--typing", type=float, default=1.0, help="seconds it takes to type a prompt")
+    parser.add_argument("--reply-chars", type=int, default=1600, help="length of every reply")
+    parser.add_argument("--chunk-rate", type=float, default=100.0, help="streamed chunks per second")
+    args = parser.parse_args()
+
+    check_end_of_input()
+    ui.console = Console(file=open(os.devnull, "w"), width=100)
+    os.environ.setdefault("CACHE_PATH", tempfile.mkdtemp())
+    server = FakeOpenAIServer(FakeServerConfig(latency=0.2, chunk_rate=args.chunk_rate,
+                                               reply_chars=args.reply_chars)).start()
+    try:
+        serial = run(server.base_url, args.prompts, args.typing, pipelined=False)
+        pipelined = run(server.base_url, args.prompts, args.typing, pipelined=True)
+        server.config.reply_chars = 200000  # Long enough that only Ctrl+C ends it
+        delay = cancel_delay(server.base_url)
+    finally:
+        server.stop()
+    print(f"serial:    {serial:.2f} s for {args.prompts} prompts")
+    print(f"pipelined: {pipelined:.2f} s for {args.prompts} prompts ({1 - pipelined / serial:.0%} less)")
+    print(f"Ctrl+C stopped the reply after {delay * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""
+Measures how much of the prompt the provider can serve from its prompt prefix cache, for
+different history trim targets, in a long conversation against the local fake OpenAI server.
+
+    python benchmarks/prefix_cache.py [--turns 100] [--targets 1.0 0.75 0.5]
+
+The fake server reports prompt tokens as cached the way the API does: when the request
+starts with the same messages as an earlier one. A trim target of 1.0 drops one message per
+turn once the history is full, which changes the start of every request.
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fake_openai_server import FakeOpenAIServer, FakeServerConfig
+from chatbot import ChatBot
+
+
+def run(base_url: str, turns: int, target: float, max_history_tokens: int, prompt_chars: int):
+    bot = ChatBot(api_key="sk-benchmark", base_url=base_url, max_history_length=1000,
+                  max_history_tokens=max_history_tokens, history_trim_target=target)
+    bot.set_system_prompt("You are a helpful assistant. " * 100)
+    start = time.perf_counter()
+    for turn in range(turns):
+        question = f"Question {turn}: " + "tell me more about loops. " * (prompt_chars // 26)
+        for _ in bot.stream_message(question, use_cache=False):
+            pass
+    return bot.prompt_cache, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--turns", type=int, default=100, help="turns of the conversation")
+    parser.add_argument("--targets", type=float, nargs="+", default=[1.0, 0.75, 0.5], help="history trim targets")
+    parser.add_argument("--max-history-tokens", type=int, default=8000, help="history token limit")
+    parser.add_argument("--prompt-chars", type=int, default=400, help="length of every question")
+    parser.add_argument("--reply-chars", type=int, default=2000, help="length of every reply")
+    args = parser.parse_args()
+
+    print(f"{'target':>7} {'prompt tokens':>14} {'cached':>10} {'hit rate':>9} {'seconds':>8}")
+    for target in args.targets:
+        # A new server per run, so no run profits from the cache of another
+        server = FakeOpenAIServer(FakeServerConfig(latency=0, chunk_rate=0, reply_chars=args.reply_chars)).start()
+        try:
+            totals, elapsed = run(server.base_url, args.turns, target, args.max_history_tokens, args.prompt_chars)
+        finally:
+            server.stop()
+        rate = totals["cached_tokens"] / totals["prompt_tokens"] if totals["prompt_tokens"] else 0.0
+        print(f"{target:>7.2f} {totals['prompt_tokens']:>14} {totals['cached_tokens']:>10} {rate:>9.0%} {elapsed:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+Measures how long the terminal rendering of a reply takes, and the longest the terminal is
+frozen while a streamed reply is rendered.
+
+    python benchmarks/render.py [--lines 200 1000 5000] [--width 100]
+
+Replies are streamed at a fixed chunk rate, and the output goes to /dev/null through a
+Console that behaves like a terminal of the given width.
+"whole" re-parses the entire reply on every refresh, as rendering did before replies were
+chunked, for comparison. Its cost grows quadratically, so it is skipped for long replies.
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rich.console import Console
+from rich.live import Live
+from rich.markdown import Markdown
+
+import ui
+
+
+def make_reply(lines: int) -> str:
+    """
+    Returns a reply of about the given number of lines: prose, lists and one long code block.
+    """
+    prose = ["Here is a paragraph with **bold**, `code` and a [link](https://example.com).", "",
+             "- first point", "- second point", ""]
+    code = [f"    result_{i} = compute(values[{i}]) * {i}  # step {i}" for i in range(lines // 2)]
+    text = prose * (lines // 10) + ["```python", "def run(values):"] + code + ["```", ""]
+    return "\n".join(text)
+
+
+def stream(text: str, chunk_chars: int, chunk_rate: float):
+    for start in range(0, len(text), chunk_chars):
+        time.sleep(1 / chunk_rate)
+        yield text[start:start + chunk_chars]
+
+
+class Gaps:
+    """
+    Wraps a chunk iterator and records the longest time the consumer spent on one chunk,
+    i.e. how long the terminal was frozen.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.longest = 0.0
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            start = time.perf_counter()
+            yield chunk
+            self.longest = max(self.longest, time.perf_counter() - start)
+
+
+def render_whole(chunks, refresh_per_second: int):
+    """
+    Streams the way rendering worked before chunking: every refresh re-parses the whole reply.
+    """
+    message = ""
+    interval = 1 / refresh_per_second
+    last_render = 0.0
+    with Live(console=ui.console, refresh_per_second=refresh_per_second, vertical_overflow="visible") as live:
+        for chunk in chunks:
+            message += chunk
+            now = time.monotonic()
+            if now - last_render >= interval:
+                live.update(Markdown(message))
+                last_render = now
+        live.update(Markdown(message))
+
+
+def measure(render, text: str, chunk_chars: int, chunk_rate: float):
+    gaps = Gaps(stream(text, chunk_chars, chunk_rate))
+    start = time.perf_counter()
+    render(gaps)
+    return time.perf_counter() - start, gaps.longest
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lines", type=int, nargs="+", default=[200, 1000, 5000], help="reply sizes in lines")
+    parser.add_argument("--width", type=int, default=100, help="terminal width")
+    parser.add_argument("--refresh", type=int, default=10, help="refreshes per second")
+    parser.add_argument("--chunk-chars", type=int, default=32, help="characters per streamed chunk")
+    parser.add_argument("--chunk-rate", type=float, default=500, help="streamed chunks per second")
+    parser.add_argument("--whole-max-lines", type=int, default=1000,
+                        help="longest reply the whole-reply renderer is measured for")
+    args = parser.parse_args()
+
+    devnull = open(os.devnull, 'w')
+    ui.console = Console(file=devnull, width=args.width, force_terminal=True, color_system="truecolor")
+
+    start = time.perf_counter()
+    for _ in range(10000):
+        ui.create_oneline(title="Assistant", style='bold magenta')
+    print(f"create_oneline: {(time.perf_counter() - start) / 10000 * 1e6:.1f} us per call")
+
+    print(f"{'lines':>7} {'renderer':<10} {'total s':>9} {'longest freeze ms':>18}")
+    for lines in args.lines:
+        text = make_reply(lines)
+        renderers = [("chunked", lambda chunks: ui.print_bot_message_stream(chunks, args.refresh))]
+        if lines <= args.whole_max_lines:
+            renderers.append(("whole", lambda chunks: render_whole(chunks, args.refresh)))
+        for name, render in renderers:
+            total, longest = measure(render, text, args.chunk_chars, args.chunk_rate)
+            print(f"{lines:>7} {name:<10} {total:>9.2f} {longest * 1000:>18.1f}")
+        start = time.perf_counter()
+        ui.print_bot_message(text)
+        print(f"{lines:>7} {'static':<10} {time.perf_counter() - start:>9.2f}")
+
+    devnull.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Measures the semantic memory: indexing speed, disk size and query latency over a large
+number of past messages.
+
+    python benchmarks/semantic_memory.py [--messages 100000] [--queries 200]
+
+The messages are generated from a fixed vocabulary, in chat logs of --log-messages each,
+and indexed through update_source the way saves feed it. Queries reuse words of indexed
+messages, so most of them have matches. The index is opened again before querying, so the
+queries run on the memory-mapped files as after a restart.
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import resource
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from perf_metrics import percentile
+from semantic_memory import SemanticMemory
+
+TOPICS = ["python", "numpy", "sqlite", "docker", "kubernetes", "react", "rust", "pandas", "regex", "git",
+          "async", "threads", "memory", "caching", "testing", "logging", "networking", "http", "json", "css"]
+WORDS = ["function", "error", "install", "version", "loop", "class", "module", "performance", "query", "index",
+         "server", "client", "config", "build", "deploy", "debug", "parse", "format", "file", "path", "string",
+         "list", "dictionary", "timeout", "retry", "stream", "buffer", "window", "layout", "branch", "merge"]
+
+
+def make_message(rng: random.Random) -> str:
+    topic = rng.choice(TOPICS)
+    words = [rng.choice(WORDS) for _ in range(rng.randint(10, 60))]
+    return f"How do I use {topic} " + " ".join(words) + f" with {topic}?"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=100000, help="messages in the index")
+    parser.add_argument("--log-messages", type=int, default=200, help="messages per chat log")
+    parser.add_argument("--queries", type=int, default=200, help="queries to time")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    with tempfile.TemporaryDirectory() as path:
+        memory = SemanticMemory(path)
+        start = time.perf_counter()
+        for log in range(0, args.messages, args.log_messages):
+            messages = [{"role": "user" if i % 2 == 0 else "assistant", "content": make_message(rng)}
+                        for i in range(min(args.log_messages, args.messages - log))]
+            # Saved in turns, as the chat saves them
+            for position in range(0, len(messages), 2):
+                memory.update_source(f"cached_chatlog_{log}.jsonl", messages[position:position + 2], position)
+        indexing = time.perf_counter() - start
+        size = sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+        memory = SemanticMemory(path)
+        timings = []
+        found = 0
+        for _ in range(args.queries):
+            query = make_message(rng)
+            start = time.perf_counter()
+            results = memory.search(query, limit=3)
+            timings.append(time.perf_counter() - start)
+            found += bool(results)
+
+    print(f"{len(memory)} messages indexed in {indexing:.1f} s "
+          f"({indexing / args.messages * 1e6:.0f} us per message), {size / 1024 / 1024:.1f} MB on disk")
+    print(f"query: p50 {percentile(timings, 0.5) * 1000:.2f} ms, p95 {percentile(timings, 0.95) * 1000:.2f} ms, "
+          f"p99 {percentile(timings, 0.99) * 1000:.2f} ms, {found} of {args.queries} with results")
+    print(f"peak RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB")
+
+
+if __name__ == "__main__":
+    main()
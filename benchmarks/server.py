@@ -0,0 +1,129 @@
+"""
+Load test of the chat server: many concurrent sessions against a local fake OpenAI server.
+
+    python benchmarks/server.py [--sessions 300] [--turns 5] [--max-sessions 100]
+
+The fake upstream and the chat server run in this process. Every client session is created,
+then sends its turns one after another, streamed, with all sessions running at once. With
+--max-sessions below --sessions the server keeps dropping sessions from memory and loading
+them again from their chat logs, so the eviction and rehydration path is measured too.
+Reports the time to first byte and the turn latency percentiles, turns per second, the peak
+resident memory and the server's session counters.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import resource
+import argparse
+import tempfile
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fake_openai_server import FakeOpenAIServer, FakeServerConfig
+from chat_server import ChatServer
+
+
+async def request(port: int, method: str, path: str, body=None):
+    """
+    Sends one request on a new connection and returns (status, time to first byte, body).
+    """
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    data = json.dumps(body).encode('utf-8') if body is not None else b""
+    start = time.perf_counter()
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: close\r\n"
+                 f"Content-Type: application/json\r\nContent-Length: {len(data)}\r\n\r\n".encode('ascii') + data)
+    await writer.drain()
+    status_line = await reader.readline()
+    first_byte = None
+    # The body of an event stream: first_byte is when the first event arrives
+    response = b""
+    while True:
+        chunk = await reader.read(65536)
+        if not chunk:
+            break
+        if first_byte is None and b"data:" in chunk:
+            first_byte = time.perf_counter() - start
+        response += chunk
+    writer.close()
+    return int(status_line.split()[1]), first_byte, response.split(b"\r\n\r\n", 1)[1]
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)] if values else 0.0
+
+
+async def run_client(port: int, turns: int, results: dict):
+    status, _, body = await request(port, "POST", "/sessions", {})
+    assert status == 201, body
+    session_id = json.loads(body)["session_id"]
+    for turn in range(turns):
+        await asyncio.sleep(random.random() * 0.05)  # Think time, so sessions go idle in between
+        start = time.perf_counter()
+        status, first_byte, body = await request(port, "POST", f"/sessions/{session_id}/messages",
+                                                 {"content": f"Question {turn}: how do I write a loop?"})
+        if status != 200 or b'"done": true' not in body:
+            results["errors"] += 1
+            continue
+        results["latency"].append(time.perf_counter() - start)
+        results["first_byte"].append(first_byte)
+    status, _, body = await request(port, "GET", f"/sessions/{session_id}")
+    if status != 200 or len(json.loads(body)["messages"]) != 2 * turns:
+        results["errors"] += 1
+
+
+async def run(args, sessions_path: str):
+    upstream = FakeOpenAIServer(FakeServerConfig(latency=args.latency, chunk_rate=args.chunk_rate,
+                                                 reply_chars=args.reply_chars))
+    upstream.start()
+    server = ChatServer(api_key="sk-benchmark", base_url=upstream.base_url, sessions_path=sessions_path,
+                        max_sessions=args.max_sessions, idle_timeout=args.idle_timeout)
+    listener = await server.start("127.0.0.1", 0)
+    port = listener.sockets[0].getsockname()[1]
+
+    results = {"latency": [], "first_byte": [], "errors": 0}
+    start = time.perf_counter()
+    await asyncio.gather(*(run_client(port, args.turns, results) for _ in range(args.sessions)))
+    elapsed = time.perf_counter() - start
+    _, _, stats = await request(port, "GET", "/stats")
+
+    listener.close()
+    await listener.wait_closed()
+    await server.close()
+    upstream.stop()
+    return results, elapsed, json.loads(stats)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=300, help="concurrent client sessions")
+    parser.add_argument("--turns", type=int, default=5, help="turns per session")
+    parser.add_argument("--max-sessions", type=int, default=100, help="sessions the server keeps in memory")
+    parser.add_argument("--idle-timeout", type=float, default=600, help="seconds before an idle session is dropped")
+    parser.add_argument("--latency", type=float, default=0.05, help="fake upstream time to first byte")
+    parser.add_argument("--chunk-rate", type=float, default=200, help="fake upstream chunks per second")
+    parser.add_argument("--reply-chars", type=int, default=600, help="fake upstream reply length")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as sessions_path:
+        results, elapsed, stats = asyncio.run(run(args, sessions_path))
+
+    turns = len(results["latency"])
+    print(f"{args.sessions} sessions x {args.turns} turns, {args.max_sessions} kept in memory")
+    print(f"{'':<14} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'mean ms':>9}")
+    for name in ("first_byte", "latency"):
+        values = results[name]
+        print(f"{name:<14} {percentile(values, 0.5) * 1000:>9.1f} {percentile(values, 0.95) * 1000:>9.1f} "
+              f"{percentile(values, 0.99) * 1000:>9.1f} {statistics.fmean(values or [0]) * 1000:>9.1f}")
+    print(f"turns/s: {turns / elapsed:.1f}, errors: {results['errors']}")
+    print(f"peak RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB")
+    print(f"server: {stats}")
+    return 1 if results["errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
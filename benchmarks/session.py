@@ -0,0 +1,191 @@
+"""
+Drives scripted chat sessions against the local fake OpenAI server and reports the app's
+own overhead: latency percentiles per step, turn throughput and peak RSS.
+
+    python benchmarks/session.py [--turns 50] [--history 2000] [--cached-files 300] [--log-mb 5]
+    python benchmarks/session.py --save-baseline
+
+The fake server answers instantly, so the numbers are the cost of the send/save/render loop,
+main.handle_command and the chat log storage at large history sizes, not of the network.
+Results are compared with benchmarks/baselines/session.json; the run fails if a step got
+slower than the baseline by more than --tolerance.
+"""
+import os
+import sys
+import json
+import time
+import random
+import builtins
+import argparse
+import resource
+import tempfile
+import statistics
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+from benchmarks.fake_openai_server import FakeOpenAIServer, FakeServerConfig
+
+BASELINE_PATH = os.path.join(BENCHMARK_DIR, "baselines", "session.json")
+WORDS = ("model latency token cache index stream render history python rust sqlite "
+         "answer question summary vector window budget retry").split()
+
+
+def make_message(role, words=40):
+    return {"role": role, "content": " ".join(random.choices(WORDS, k=words))}
+
+
+def write_log(path, messages):
+    with open(path, 'w') as file:
+        for message in messages:
+            file.write(json.dumps(message) + "\n")
+
+
+def populate_cache(cache_path, cached_files, log_mb):
+    """
+    Fills the cache directory with small chat logs and one large one. Returns the large one's name.
+    """
+    for i in range(cached_files):
+        write_log(os.path.join(cache_path, f"cached_chatlog_2000-01-01_{i:05d}.jsonl"),
+                  [make_message("user" if j % 2 == 0 else "assistant") for j in range(20)])
+    large = "cached_chatlog_2000-01-02_00-00.jsonl"
+    message_bytes = len(json.dumps(make_message("user", 200))) + 1
+    write_log(os.path.join(cache_path, large),
+              [make_message("user" if j % 2 == 0 else "assistant", 200)
+               for j in range(log_mb * 1024 * 1024 // message_bytes)])
+    return large
+
+
+def timed(samples, name, func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    samples.setdefault(name, []).append(time.perf_counter() - start)
+    return result
+
+
+def describe(samples):
+    return {
+        "count": len(samples),
+        "p50": statistics.median(samples),
+        "p95": sorted(samples)[max(int(len(samples) * 0.95) - 1, 0)],
+        "p99": sorted(samples)[max(int(len(samples) * 0.99) - 1, 0)],
+    }
+
+
+def run(args):
+    server = FakeOpenAIServer(FakeServerConfig(latency=0, chunk_rate=0, reply_chars=args.reply_chars)).start()
+    with tempfile.TemporaryDirectory() as cache_path, tempfile.TemporaryDirectory() as save_path:
+        os.environ.update(CACHE_PATH=cache_path, SAVE_PATH=save_path, OPENAI_BASE_URL=server.base_url)
+        large_log = populate_cache(cache_path, args.cached_files, args.log_mb)
+
+        import ui
+        import main
+        from chatbot import ChatBot
+        from chat_log_manager import ChatLogManager, CHATLOG_PATTERN
+        from search_index import SearchIndex
+        from perf_metrics import PerformanceMetrics
+
+        # Render into /dev/null: the work is the same, the terminal is not flooded
+        devnull = open(os.devnull, 'w')
+        ui.console.file = devnull
+        sys.stdout = devnull
+
+        samples = {}
+        metrics = PerformanceMetrics()
+        log_handler = ChatLogManager(max_cached_files=args.cached_files + 10, metrics=metrics)
+        search_index = SearchIndex()
+        log_handler.add_save_listener(search_index.update_source)
+        timed(samples, "search_sync", search_index.sync, [os.path.join(cache_path, CHATLOG_PATTERN)])
+
+        bot = ChatBot(api_key="benchmark", max_history_length=args.history + 2 * args.turns + 10)
+        builtins.input = lambda prompt="": large_log
+        for _ in range(5):
+            timed(samples, "load_history", main.handle_command, ["/load_history"], bot, log_handler, search_index, metrics)
+
+        bot.chat_history = [make_message("user" if j % 2 == 0 else "assistant")
+                            for j in range(args.history)]
+        for command in (["/history_list"], ["/budget"], ["/search", "latency", "token"], ["/stats"]):
+            for _ in range(5):
+                timed(samples, " ".join(command), main.handle_command, command, bot, log_handler, search_index, metrics)
+
+        start = time.perf_counter()
+        for i in range(args.turns):
+            turn_start = time.perf_counter()
+            timed(samples, "respond", lambda: ui.print_bot_message_stream(bot.stream_message(f"question {i}")))
+            timed(samples, "save", log_handler.save_chatlog, bot.chat_history)
+            samples.setdefault("turn", []).append(time.perf_counter() - turn_start)
+        timed(samples, "flush", log_handler.flush)
+        elapsed = time.perf_counter() - start
+
+        sys.stdout = sys.__stdout__
+        devnull.close()
+    server.stop()
+
+    return {
+        "config": {key: getattr(args, key) for key in ("turns", "history", "cached_files", "log_mb", "reply_chars")},
+        "steps": {name: describe(values) for name, values in samples.items()},
+        "turns_per_second": args.turns / elapsed,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def compare(result, baseline, tolerance):
+    """
+    Returns a description of every step that is slower than its baseline by more than tolerance.
+    """
+    regressions = []
+    if baseline.get("config") != result["config"]:
+        print("Baseline was recorded with a different configuration, not comparing.")
+        return regressions
+    for name, stats in result["steps"].items():
+        base = baseline["steps"].get(name)
+        # Steps that take under a millisecond or ran only once are too noisy to compare
+        if (base and base["p50"] > 0.001 and stats["count"] > 1
+                and stats["p50"] > base["p50"] * (1 + tolerance)):
+            regressions.append(f"{name}: p50 {stats['p50'] * 1000:.1f} ms vs {base['p50'] * 1000:.1f} ms")
+    if result["turns_per_second"] < baseline["turns_per_second"] / (1 + tolerance):
+        regressions.append(f"throughput: {result['turns_per_second']:.1f} vs {baseline['turns_per_second']:.1f} turns/s")
+    if result["peak_rss_mb"] > baseline["peak_rss_mb"] * (1 + tolerance):
+        regressions.append(f"peak RSS: {result['peak_rss_mb']:.0f} MB vs {baseline['peak_rss_mb']:.0f} MB")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--turns", type=int, default=50, help="chat turns to run")
+    parser.add_argument("--history", type=int, default=2000, help="messages in the history before the turns")
+    parser.add_argument("--cached-files", type=int, default=300, help="small chat logs in the cache directory")
+    parser.add_argument("--log-mb", type=int, default=5, help="size of the large chat log that is loaded")
+    parser.add_argument("--reply-chars", type=int, default=2000, help="length of every reply")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown against the baseline")
+    parser.add_argument("--save-baseline", action="store_true", help="store this run as the baseline")
+    args = parser.parse_args()
+
+    random.seed(0)
+    result = run(args)
+
+    print(f"{'step':<24} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for name, stats in result["steps"].items():
+        print(f"{name:<24} {stats['count']:>6} {stats['p50'] * 1000:>9.2f} "
+              f"{stats['p95'] * 1000:>9.2f} {stats['p99'] * 1000:>9.2f}")
+    print(f"\nthroughput: {result['turns_per_second']:.1f} turns/s, peak RSS: {result['peak_rss_mb']:.0f} MB")
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(BASELINE_PATH), exist_ok=True)
+        with open(BASELINE_PATH, 'w') as file:
+            json.dump(result, file, indent=2)
+        print(f"Baseline saved to {BASELINE_PATH}")
+        return 0
+
+    if not os.path.exists(BASELINE_PATH):
+        print("No baseline yet, run with --save-baseline to record one.")
+        return 0
+    with open(BASELINE_PATH) as file:
+        regressions = compare(result, json.load(file), args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,88 @@
+"""
+Measures how long the app takes to show its first prompt, and which imports that time goes to.
+
+    python benchmarks/startup.py [--runs 5] [--threshold 0.5]
+
+Each run starts a fresh interpreter that imports main, builds the ChatLogManager and ChatBot
+and prints the welcome screen, the same work main.main() does before the first prompt.
+Exits with status 1 if the median cold start is slower than the threshold (in seconds).
+"""
+import os
+import re
+import sys
+import argparse
+import statistics
+import subprocess
+import tempfile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STARTUP_SCRIPT = """
+import time
+start = time.perf_counter()
+import main
+from chatbot import ChatBot
+from chat_log_manager import ChatLogManager
+from search_index import SearchIndex
+from ui import print_welcome
+ChatLogManager()
+SearchIndex()
+ChatBot(api_key='benchmark')
+print_welcome()
+print('STARTUP', time.perf_counter() - start)
+"""
+
+# "import time: self [us] | cumulative | imported package"
+_IMPORT_TIME = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \| +(\S+)")
+
+
+def run_once(env):
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", STARTUP_SCRIPT],
+        cwd=REPO_ROOT, env=env, capture_output=True, text=True, check=True
+    )
+    startup = float(re.search(r"STARTUP (\S+)", result.stdout).group(1))
+    imports = {}
+    for self_us, cumulative_us, module in _IMPORT_TIME.findall(result.stderr):
+        imports[module] = (int(self_us), int(cumulative_us))
+    return startup, imports
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="number of cold starts to measure")
+    parser.add_argument("--threshold", type=float, default=0.5, help="maximum median cold start in seconds")
+    parser.add_argument("--top", type=int, default=15, help="number of imports to list")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        env = dict(os.environ, CACHE_PATH=cache_dir, COLUMNS="80")
+        runs = [run_once(env) for _ in range(args.runs)]
+
+    startups = [startup for startup, _ in runs]
+    median = statistics.median(startups)
+
+    # Median import times of every module, over all runs
+    modules = {}
+    for _, imports in runs:
+        for module, times in imports.items():
+            modules.setdefault(module, []).append(times)
+    rows = [(module, statistics.median(t[1] for t in times), statistics.median(t[0] for t in times))
+            for module, times in modules.items()]
+    rows.sort(key=lambda row: row[1], reverse=True)
+
+    print(f"{'module':<40} {'cumulative ms':>14} {'self ms':>9}")
+    for module, cumulative_us, self_us in rows[:args.top]:
+        print(f"{module:<40} {cumulative_us / 1000:>14.1f} {self_us / 1000:>9.1f}")
+    print()
+    print(f"cold start: median {median * 1000:.0f} ms, min {min(startups) * 1000:.0f} ms, "
+          f"max {max(startups) * 1000:.0f} ms over {len(startups)} runs (threshold {args.threshold * 1000:.0f} ms)")
+
+    if median > args.threshold:
+        print("FAIL: cold start is over the threshold")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
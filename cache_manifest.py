@@ -0,0 +1,265 @@
+import os
+import json
+import time
+import fnmatch
+import threading
+from typing import Dict, List, Optional, Tuple
+from chatlog_format import count_messages
+
+MANIFEST_FILENAME = 'chatlog_manifest.json'
+JOURNAL_FILENAME = 'chatlog_manifest.journal'
+COMPACT_MIN_BYTES = 64 * 1024  # The journal is folded into the manifest past this size, or past the manifest's
+
+
+class CacheManifest:
+    """
+    An index of the chat logs in the cache directory: size, modification time, message count
+    and title of every file. It is kept up to date by the savers instead of by listing and
+    stat'ing the directory, so listing the logs and enforcing the retention quotas costs no
+    file system calls per file. The number and total size of the logs and the oldest of them
+    are kept as they change, so the logs are only sorted when a quota is exceeded. It is
+    reconciled with the directory once, when it is opened.
+
+    Changes are appended to a journal next to the manifest, one line each, so a save costs
+    the same however many logs there are. The journal is replayed on top of the manifest, also
+    the lines other processes sharing the directory appended, and folded into the manifest
+    once it has grown larger than it. Every line holds absolute values, so replaying a line
+    twice is harmless.
+    """
+
+    def __init__(self, directory: str, pattern: str):
+        """
+        :param directory: The cache directory.
+        :param pattern: The glob pattern of the chat log filenames.
+        """
+        self.directory = directory
+        self.pattern = pattern
+        self.path = os.path.join(directory, MANIFEST_FILENAME)
+        self.journal_path = os.path.join(directory, JOURNAL_FILENAME)
+        self._lock = threading.Lock()
+        self._manifest_size = 0
+        self._journal_inode: Optional[int] = None
+        self._journal_offset = 0  # How far the journal has been replayed
+        self._set_entries(self._load())
+        with self._lock:
+            self._replay()
+        self._reconcile()
+
+    def _load(self) -> Dict[str, Dict]:
+        try:
+            with open(self.path, encoding='utf-8') as file:
+                self._manifest_size = os.fstat(file.fileno()).st_size
+                entries = json.load(file)["files"]
+            return entries if isinstance(entries, dict) else {}
+        except (OSError, ValueError, KeyError, TypeError):
+            return {}  # Missing or damaged, rebuilt from the directory
+
+    def _set_entries(self, entries: Dict[str, Dict]):
+        self._entries = entries
+        self._total_bytes = sum(entry.get("size", 0) for entry in entries.values())
+        self._oldest: Optional[Tuple[float, str]] = None  # (mtime, name) of the oldest log, None if not known
+
+    def _apply(self, change: Dict):
+        name = change["name"]
+        entry = self._entries.get(name)
+        if entry is not None and change["op"] in ("update", "remove"):
+            self._total_bytes -= entry.get("size", 0)
+            if self._oldest is not None and self._oldest[1] == name:
+                self._oldest = None  # Looked up again when a quota is checked
+        if change["op"] == "update":
+            entry = self._entries.setdefault(name, {"title": None})
+            entry.update(size=change["size"], mtime=change["mtime"], messages=change["messages"])
+            self._total_bytes += entry["size"]
+            if self._oldest is not None and (entry["mtime"], name) < self._oldest:
+                self._oldest = (entry["mtime"], name)
+        elif change["op"] == "title":
+            if name in self._entries:
+                self._entries[name]["title"] = change["title"]
+        elif change["op"] == "remove":
+            self._entries.pop(name, None)
+
+    def _replay(self):
+        """
+        Applies the journal lines appended since it was last replayed, by any process.
+        """
+        try:
+            with open(self.journal_path, 'rb') as file:
+                inode = os.fstat(file.fileno()).st_ino
+                if inode != self._journal_inode:
+                    if self._journal_inode is not None:
+                        # Folded into the manifest by another process
+                        self._set_entries(self._load())
+                    self._journal_inode, self._journal_offset = inode, 0
+                file.seek(self._journal_offset)
+                data = file.read()
+        except OSError:
+            return
+        end = data.rfind(b"\n") + 1  # A line still being written is read next time
+        for line in data[:end].splitlines():
+            # A line torn by a crash is followed by the next one on the same line
+            line = line[line.rfind(b'{"op"'):]
+            try:
+                self._apply(json.loads(line))
+            except (ValueError, KeyError, TypeError, AttributeError):
+                continue
+        self._journal_offset += end
+
+    def _append(self, changes: List[Dict]):
+        """
+        Applies changes and appends them to the journal, folding it into the manifest once it
+        is larger than the manifest.
+        """
+        for change in changes:
+            self._apply(change)
+        data = "".join(json.dumps(change, ensure_ascii=False) + "\n" for change in changes).encode('utf-8')
+        try:
+            with open(self.journal_path, 'ab') as file:
+                file.write(data)
+                size = file.tell()
+        except OSError:
+            return  # Rebuilt from the directory next time
+        if size > max(COMPACT_MIN_BYTES, self._manifest_size):
+            self._compact()
+
+    def _compact(self):
+        try:
+            with open(self.journal_path, 'rb') as old:
+                self._replay()
+                self._write()
+                temporary = f"{self.journal_path}.{os.getpid()}.tmp"
+                with open(temporary, 'wb') as file:
+                    # Lines other processes appended since the replay above are carried over
+                    old.seek(self._journal_offset)
+                    rest = old.read()
+                    rest = rest[:rest.rfind(b"\n") + 1]
+                    file.write(rest)
+                os.replace(temporary, self.journal_path)
+        except OSError:
+            return
+        self._journal_inode, self._journal_offset = None, 0
+        self._replay()
+
+    def _reconcile(self):
+        """
+        Adds the logs that were written without the manifest (e.g. by an older version) and
+        drops the ones that were deleted, using one listing of the directory.
+        """
+        names = set(fnmatch.filter(os.listdir(self.directory), self.pattern))
+        changes = [{"op": "remove", "name": name} for name in set(self._entries) - names]
+        for name in names - set(self._entries):
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+                messages = count_messages(path)
+            except (OSError, ValueError):
+                continue
+            changes.append({"op": "update", "name": name, "size": stat.st_size, "mtime": stat.st_mtime,
+                            "messages": messages})
+        if changes:
+            with self._lock:
+                self._append(changes)
+
+    def _write(self):
+        # Written to a temporary file and renamed, so a crash never leaves half a manifest
+        temporary = f"{self.path}.{os.getpid()}.tmp"
+        with open(temporary, 'w', encoding='utf-8') as file:
+            json.dump({"version": 1, "files": self._entries}, file)
+            self._manifest_size = file.tell()
+        os.replace(temporary, self.path)
+
+    def update(self, name: str, size: int, messages: int, mtime: Optional[float] = None):
+        """
+        Records that a chat log was written.
+        """
+        with self._lock:
+            self._append([{"op": "update", "name": name, "size": size, "mtime": mtime or time.time(),
+                           "messages": messages}])
+
+    def set_title(self, name: str, title: str):
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None or entry.get("title") == title:
+                return
+            self._append([{"op": "title", "name": name, "title": title}])
+
+    def remove(self, name: str):
+        with self._lock:
+            if name in self._entries:
+                self._append([{"op": "remove", "name": name}])
+
+    def entries(self) -> List[Dict]:
+        """
+        Returns the chat logs, oldest first, each with its name, size, mtime, messages and title.
+        """
+        with self._lock:
+            self._replay()  # Also what other processes saved
+            entries = [dict(entry, name=name) for name, entry in self._entries.items()]
+        return sorted(entries, key=lambda entry: (entry["mtime"], entry["name"]))
+
+    def enforce(
+        self,
+        max_files: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+        max_age: Optional[float] = None,
+        keep: tuple = ()
+    ) -> List[str]:
+        """
+        Deletes the oldest chat logs until every quota is met.
+
+        :param max_files: (Optional) The maximum number of logs to retain.
+        :param max_bytes: (Optional) The maximum total size of the logs.
+        :param max_age: (Optional) The maximum age of a log in seconds.
+        :param keep: Names that are never deleted, e.g. the logs being written.
+        :return: The names of the deleted logs.
+        """
+        oldest_allowed = time.time() - max_age if max_age is not None else None
+        # The running totals tell whether a quota is exceeded, the logs are only sorted if one is
+        with self._lock:
+            self._replay()
+            if oldest_allowed is not None and self._oldest is None and self._entries:
+                self._oldest = min((entry["mtime"], name) for name, entry in self._entries.items())
+            if not ((max_files is not None and len(self._entries) > max_files)
+                    or (max_bytes is not None and self._total_bytes > max_bytes)
+                    or (oldest_allowed is not None and self._oldest is not None
+                        and self._oldest[0] < oldest_allowed)):
+                return []
+        entries = self.entries()
+        count = len(entries)
+        total = sum(entry["size"] for entry in entries)
+        removed = []
+        for entry in entries:
+            if not ((max_files is not None and count > max_files)
+                    or (max_bytes is not None and total > max_bytes)
+                    or (oldest_allowed is not None and entry["mtime"] < oldest_allowed)):
+                break  # Entries are oldest first, so the rest meet the quotas too
+            if entry["name"] in keep:
+                continue
+            try:
+                os.remove(os.path.join(self.directory, entry["name"]))
+            except FileNotFoundError:
+                pass
+            except OSError:
+                continue
+            removed.append(entry["name"])
+            count -= 1
+            total -= entry["size"]
+        if removed:
+            with self._lock:
+                self._append([{"op": "remove", "name": name} for name in removed])
+        return removed
+
+
+_manifests: Dict[str, CacheManifest] = {}
+_manifests_lock = threading.Lock()
+
+
+def get_manifest(directory: str, pattern: str) -> CacheManifest:
+    """
+    Returns the manifest of the directory, shared by every ChatLogManager saving there.
+    """
+    key = os.path.abspath(directory)
+    with _manifests_lock:
+        manifest = _manifests.get(key)
+        if manifest is None:
+            manifest = _manifests[key] = CacheManifest(directory, pattern)
+        return manifest
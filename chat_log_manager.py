@@ -1,23 +1,170 @@
 import os
-import glob
+import atexit
+import queue
+import threading
+import time
+from functools import partial
 from datetime import datetime
 import json
+from typing import Optional, List, Dict
 from ui import (
         print_info,
         print_error
 )
+from cache_manifest import get_manifest
+from chatlog_format import (
+        read_chatlog,
+        count_messages,
+        read_frame_index,
+        find_line_ends,
+        encode_frame,
+        encode_footer,
+        COMPRESSED_SUFFIX,
+        FRAME_MESSAGES
+)
+
+CHATLOG_PATTERN = 'cached_chatlog_*.jsonl*'  # Plain and compressed chat logs
+
+
+class _LogWriter:
+    """
+    Background thread that applies queued chat log writes in batches.
+    Everything queued while a batch is being written is picked up by the next one,
+    so the files are flushed and fsynced once per batch instead of once per write.
+    """
 
-class ChatLogManager:
     def __init__(self):
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="chatlog-writer", daemon=True)
+        self._thread.start()
+
+    def write(self, path: str, offset: int, data: bytes):
+        """
+        Queues a write of data at offset, truncating whatever followed it in the file.
+        """
+        self._queue.put(("write", path, offset, data))
+
+    def call(self, func):
+        """
+        Queues a function to run on the writer thread after the pending writes.
+        """
+        self._queue.put(("call", func))
+
+    def flush(self):
+        """
+        Blocks until everything queued so far is on disk.
+        """
+        done = threading.Event()
+        self._queue.put(("barrier", done))
+        done.wait()
+
+    def _run(self):
+        while True:
+            jobs = [self._queue.get()]
+            while True:
+                try:
+                    jobs.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._apply(jobs)
+
+    def _apply(self, jobs):
+        files = {}
+        for job in jobs:
+            kind = job[0]
+            if kind == "write":
+                _, path, offset, data = job
+                try:
+                    file = files.get(path)
+                    if file is None:
+                        file = files[path] = open(path, 'r+b' if os.path.exists(path) else 'w+b')
+                    file.seek(offset)
+                    file.write(data)
+                    file.truncate()
+                except Exception as e:
+                    print_error(f"Failed to save chat log: {e}")
+            else:
+                # Calls and barriers must see every write queued before them
+                self._sync(files)
+                files = {}
+                if kind == "call":
+                    try:
+                        job[1]()
+                    except Exception as e:
+                        print_error(f"Chat log background task failed: {e}")
+                else:
+                    job[1].set()
+        self._sync(files)
+
+    def _sync(self, files):
+        for file in files.values():
+            try:
+                file.flush()
+                os.fsync(file.fileno())
+                file.close()
+            except Exception as e:
+                print_error(f"Failed to save chat log: {e}")
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def _get_writer() -> _LogWriter:
+    """
+    Returns the process-wide log writer, starting it on first use.
+    """
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = _LogWriter()
+            atexit.register(_writer.flush)
+        return _writer
+
+
+class ChatLogManager:
+    def __init__(
+        self,
+        compress: bool = False,
+        metrics=None,
+        max_cached_files: int = 10,
+        max_cached_bytes: Optional[int] = None,
+        max_cached_age: Optional[float] = None,
+        save_path: Optional[str] = None,
+        verbose: bool = True
+    ):
         """
         Initializes the ChatLogHandle object by setting the save path and preparing to handle chat history.
+
+        :param compress: Write the chat log in the compressed, framed format (.jsonlz).
+        :param metrics: (Optional) A PerformanceMetrics to record the background save and cleanup times in.
+        :param max_cached_files: Maximum number of cached files allowed to retain.
+        :param max_cached_bytes: (Optional) Maximum total size of the cached files.
+        :param max_cached_age: (Optional) Maximum age of a cached file in seconds.
+        :param save_path: (Optional) The directory to save in. Defaults to the CACHE_PATH environment variable.
+        :param verbose: Print a message after every save.
         """
-        self.save_path = self._get_save_path()
-        self.max_cached_files = 10  # Maximum number of cached files allowed to retain
-        self.filename = f'cached_chatlog_{datetime.now().strftime("%Y-%m-%d_%H-%M")}.jsonl'
+        self.metrics = metrics
+        self.save_path = self._get_save_path(save_path)
+        self.verbose = verbose
+        self.max_cached_files = max_cached_files
+        self.max_cached_bytes = max_cached_bytes
+        self.max_cached_age = max_cached_age
+        self.compress = compress
+        suffix = COMPRESSED_SUFFIX if compress else '.jsonl'
+        self.filename = f'cached_chatlog_{datetime.now().strftime("%Y-%m-%d_%H-%M")}{suffix}'
 
-        # cleaning cached file
-        self.cleanup_cached_files()
+        # Messages already written to self.filename, in file order
+        self._saved = []
+        self._saved_index = {}  # id(message) -> position in self._saved
+        self._released = 0  # Messages before this position are only on disk, self._saved holds None for them
+        self._line_ends = []  # Plain format: byte offset where each message's line ends
+        self._frames = []  # Compressed format: [offset, length, first message, message count] per frame
+        self._lock = threading.Lock()
+        self._save_listeners = []
+
+        # cleaning cached file, on the writer thread so it does not delay startup
+        _get_writer().call(self._timed_cleanup)
 
     def _get_save_path(self,custom_path:str = None):
         path = custom_path if custom_path else os.getenv('CACHE_PATH')
@@ -36,62 +183,261 @@ class ChatLogManager:
             try:
                 if os.path.exists(cached_file):  # Check if file exists before attempting to delete
                     os.remove(cached_file)
+                    self.manifest.remove(self.filename)
                     print_info("Cached chat log deleted.")
                 else:
                     print_info("No cached chat log found.")
             except Exception as e:
                 print_error(f"Failed to delete cached chat log: {e}")
 
-    def show_cached_chatlog_list(self):
-        cached_files_list = os.listdir(self.save_path)
-        return cached_files_list
+    @property
+    def manifest(self):
+        """
+        The manifest of the cache directory, shared by every ChatLogManager saving there.
+        """
+        return get_manifest(self.save_path, CHATLOG_PATTERN)
+
+    def get_cached_chatlogs(self) -> List[Dict]:
+        """
+        Returns the cached chat logs, oldest first, with their size, mtime, message count and
+        title, from the manifest instead of the files themselves.
+        """
+        return self.manifest.entries()
+
+    def set_title(self, title: str):
+        """
+        Records the conversation's title in the manifest, once the chat log has been saved.
+        """
+        _get_writer().call(partial(self.manifest.set_title, self.filename, title))
 
 
-    def load_from_chatlog(self, filename='cached_chatlog'):
+    def load_from_chatlog(self, filename='cached_chatlog', last_n=None, max_tokens=None):
         """
         Loads the latest cached chat log based on filename.
+        Plain (.jsonl) and compressed (.jsonlz) logs are supported. With last_n or max_tokens
+        only the newest messages are decoded, so resuming a huge log stays fast.
+        A torn last line, left behind by a crash in the middle of a write, is skipped.
+
+        :param filename: The chat log to load.
+        :param last_n: (Optional) The maximum number of messages to load.
+        :param max_tokens: (Optional) The maximum number of tokens the loaded messages may use.
         """
         try:
-            with open(os.path.join(self.save_path,filename), 'r') as file:  # Read contents of the latest chat log
-                chat_history = [json.loads(line) for line in file] # jsonl 파일 로딩 방식 확인하기
+            chat_history = read_chatlog(os.path.join(self.save_path, filename), last_n, max_tokens)
             print_info(f"Loaded history from {filename}.")
         except Exception as e:
             print_error(f"Failed to load cached chat log: {e}")
         return chat_history
 
-    def save_chatlog(self,chat_history):
+    def save_chatlog(self, chat_history, rewrite=False):
         """
-        Saves the current chat history to a new file with a timestamped filename.
+        Saves the current chat history to the session's timestamped file.
+        Only the messages added since the last save are appended. The file is truncated
+        back when the tail of the history was removed (undo), and rewritten from scratch
+        when the history was replaced (clear, load) or when rewrite is set.
+        A summary that replaced the oldest messages is written in front of the first
+        message it kept, so the file still holds the full conversation and a tail load
+        starts with the summary.
+        The write itself happens on a background thread.
+
+        :param chat_history: The chat history to save.
+        :param rewrite: Force a full rewrite, e.g. after the start of the history changed.
         """
-        # Create a filename with the current timestamp
         file_path = os.path.join(self.save_path, self.filename)
-        
+
         try:
-            with open(file_path, 'w') as file:  # Write the chat history to the new file
-                for message in chat_history:
-                    file.write(json.dumps(message)+"\n") # jsonl 파일 제대로 저장되는지 확인
+            chat_history = list(chat_history)  # It may be compacted by a background thread meanwhile
+            with self._lock:
+                common, start = -1, 0
+                if not rewrite:
+                    # Find the newest message that is already in the file
+                    for i in range(len(chat_history) - 1, -1, -1):
+                        j = self._saved_index.get(id(chat_history[i]))
+                        if j is not None and self._saved[j] is chat_history[i]:
+                            common, start = j, i + 1
+                            break
+                    # A summary in front of saved messages goes in front of them in the file too
+                    if start > 1 and id(chat_history[0]) not in self._saved_index:
+                        j = self._saved_index.get(id(chat_history[1]))
+                        if j is not None and self._saved[j] is chat_history[1] and common - j == start - 2:
+                            common, start = j - 1, 0
+
+                # Forget what was written after that message; it is truncated below
+                position = common + 1
+                for message in self._saved[position:]:
+                    if message is not None:
+                        del self._saved_index[id(message)]
+                del self._saved[position:]
+                self._released = min(self._released, position)
+
+                new_messages = chat_history[start:]
+                for message in new_messages:
+                    self._saved_index[id(message)] = len(self._saved)
+                    self._saved.append(message)
+                if chat_history:
+                    self._release(self._saved_index.get(id(chat_history[0]), 0))
+
+                if self.compress:
+                    offset, data = self._encode_frames(position)
+                else:
+                    offset, data = self._encode_lines(position)
+                writer = _get_writer()
+                queued = time.perf_counter()
+                writer.write(file_path, offset, data)
+                if self.metrics is not None:
+                    # Time until the write is on disk, including the wait behind other writes
+                    writer.call(lambda: self.metrics.record("save_background", time.perf_counter() - queued))
+                for listener in self._save_listeners:
+                    writer.call(partial(listener, file_path, new_messages, position))
+                # Record the file in the manifest and delete old cached files if it is over a quota
+                writer.call(partial(self.manifest.update, self.filename, offset + len(data), len(self._saved)))
+                writer.call(self._timed_cleanup)
 
-            print_info(f"Chat log saved to {file_path}.")
-            self.cleanup_cached_files()  # Clean up old cached files
+            if self.verbose:
+                print_info(f"Chat log saved to {file_path}.")
 
         except Exception as e:
             print_error(f"Failed to save chat log: {e}")
 
-    def cleanup_cached_files(self):
+    def _release(self, boundary):
         """
-        Deletes the oldest cached files if the total number exceeds the limit.
+        Lets go of the saved messages before boundary, the position of the oldest message in
+        the history: saves never truncate the file before it, so they are not needed again.
         """
-        # Get a sorted list of cached files, sorted by modification time
-        cached_files = sorted(glob.glob(os.path.join(self.save_path, 'cached_chatlog_*.jsonl')),
-                              key=os.path.getmtime)
+        if self.compress:
+            boundary -= boundary % FRAME_MESSAGES  # A frame is encoded again as a whole
+        for k in range(self._released, boundary):
+            message = self._saved[k]
+            if message is not None:
+                del self._saved_index[id(message)]
+                self._saved[k] = None
+        self._released = max(self._released, boundary)
 
-        # If the number of cached files exceeds the allowed limit, delete the oldest
-        while len(cached_files) > self.max_cached_files:
-            try:
-                os.remove(cached_files[0])  # Remove the oldest file
-                print_info(f"Deleted oldest cached file: {cached_files[0]}")
-                cached_files.pop(0)  # Remove the filename from the list
-            except Exception as e:
-                print_error(f"Failed to delete cached file: {e}")
+    def resume(self, filename, last_n=None, max_tokens=None):
+        """
+        Continues an existing chat log: loads its newest messages, like load_from_chatlog, and
+        makes the following saves append to it instead of starting a new file.
+        Of a compressed log without a valid footer, the complete frames are kept and whatever
+        an interrupted write left after them is overwritten by the next save.
+
+        :param filename: The chat log to continue.
+        :param last_n: (Optional) The maximum number of messages to load.
+        :param max_tokens: (Optional) The maximum number of tokens the loaded messages may use.
+        :return: The loaded messages, to be used as the chat history.
+        """
+        path = os.path.join(self.save_path, filename)
+        messages = read_chatlog(path, last_n, max_tokens)
+        total = count_messages(path)
+        released = total - len(messages)
+        saved = messages
+        line_ends, frames = [], []
+        compress = filename.endswith(COMPRESSED_SUFFIX)
+        if compress:
+            first = 0
+            for offset, length, count in read_frame_index(path, recover=True):
+                frames.append([offset, length, first, count])
+                first += count
+            # The frame holding the oldest loaded message may be encoded again, load all of it
+            released -= released % FRAME_MESSAGES
+            if total - released > len(messages):
+                saved = read_chatlog(path, last_n=total - released)
+                messages = saved[len(saved) - len(messages):]
+        else:
+            # The end of the line before the oldest loaded one is where a rewrite of it starts
+            ends = find_line_ends(path, len(messages) + (1 if released else 0))
+            line_ends = [None] * (total - len(ends)) + ends
+
+        with self._lock:
+            self.filename = filename
+            self.compress = compress
+            self._saved = [None] * released + saved
+            self._saved_index = {id(message): released + i for i, message in enumerate(saved)}
+            self._released = released
+            self._line_ends = line_ends
+            self._frames = frames
+        return messages
+
+    def _encode_lines(self, position):
+        """
+        Encodes the saved messages from position on as JSONL lines.
+        Returns the offset to write them at and the encoded bytes.
+        """
+        del self._line_ends[position:]
+        offset = self._line_ends[-1] if self._line_ends else 0
+        end = offset
+        lines = []
+        for message in self._saved[position:]:
+            line = (json.dumps(message) + "\n").encode('utf-8')
+            lines.append(line)
+            end += len(line)
+            self._line_ends.append(end)
+        return offset, b"".join(lines)
+
+    def _encode_frames(self, position):
+        """
+        Re-encodes the frames holding the saved messages from position on, and the footer.
+        The last frame is also re-encoded while it has room, so frames fill up over a session.
+        Returns the offset to write them at and the encoded bytes.
+        """
+        frames = self._frames
+        # First frame that holds a changed message, or the last frame if it is not full yet
+        k = len(frames)
+        while k > 0 and frames[k - 1][2] + frames[k - 1][3] > position:
+            k -= 1
+        if k == len(frames) and k > 0 and frames[-1][3] < FRAME_MESSAGES:
+            k -= 1
+        if k < len(frames):
+            offset, first = frames[k][0], frames[k][2]
+        elif frames:
+            offset, first = frames[-1][0] + frames[-1][1], frames[-1][2] + frames[-1][3]
+        else:
+            offset, first = 0, 0
+        del frames[k:]
+
+        chunks = []
+        end = offset
+        for i in range(first, len(self._saved), FRAME_MESSAGES):
+            messages = self._saved[i:i + FRAME_MESSAGES]
+            frame = encode_frame(messages)
+            chunks.append(frame)
+            frames.append([end, len(frame), i, len(messages)])
+            end += len(frame)
+        chunks.append(encode_footer([[offset, length, count] for offset, length, _, count in frames]))
+        return offset, b"".join(chunks)
+
+    def add_save_listener(self, listener):
+        """
+        Registers a function to be called on the writer thread after every save as
+        listener(file_path, messages, position): the file now holds messages from
+        position on, replacing whatever it held there before.
+        """
+        self._save_listeners.append(listener)
+
+    def flush(self):
+        """
+        Waits until every queued chat log write has reached the disk.
+        """
+        _get_writer().flush()
+
+    def _timed_cleanup(self):
+        start = time.perf_counter()
+        self.cleanup_cached_files()
+        if self.metrics is not None:
+            self.metrics.record("cleanup", time.perf_counter() - start)
+
+    def cleanup_cached_files(self):
+        """
+        Deletes the oldest cached files while there are too many, they take up too much space
+        or they are too old. The session's own file is kept. The files are found through the
+        manifest, so this does not touch the disk unless something is deleted.
+        """
+        removed = self.manifest.enforce(
+            max_files=self.max_cached_files,
+            max_bytes=self.max_cached_bytes,
+            max_age=self.max_cached_age,
+            keep=(self.filename,)
+        )
+        for name in removed:
+            print_info(f"Deleted oldest cached file: {name}")
 
 
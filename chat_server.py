@@ -0,0 +1,421 @@
+import os
+import re
+import json
+import time
+import uuid
+import asyncio
+import argparse
+from contextlib import asynccontextmanager
+from http import HTTPStatus
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+from async_chatbot import AsyncChatBot
+from chat_log_manager import ChatLogManager
+from request_scheduler import RequestScheduler
+from response_cache import ResponseCache
+from ui import print_error
+
+SESSION_LOG = 'cached_chatlog_session_{}.jsonl'
+SESSION_META = 'session_{}.json'
+MAX_BODY_BYTES = 1 << 20
+_SESSION_PATH = re.compile(r"^/sessions/([0-9a-f]{32})(/messages)?$")
+
+
+class HTTPError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class _Session:
+    __slots__ = ("id", "bot", "log", "last_used", "lock", "users")
+
+    def __init__(self, session_id: str, bot: AsyncChatBot, log: ChatLogManager):
+        self.id = session_id
+        self.bot = bot
+        self.log = log
+        self.last_used = time.monotonic()
+        self.lock = asyncio.Lock()  # One turn at a time
+        self.users = 0  # Requests using the session, it stays in memory while there are any
+
+
+class ChatServer:
+    """
+    Hosts many chat sessions in one process over HTTP, streaming replies as server-sent events.
+
+    All sessions share one pooled async client and one request scheduler, which rate limits
+    and retries their requests, and optionally a response cache. A session's history is capped by the ChatBot
+    limits and saved to its own chat log after every turn, so a session that has been idle
+    for a while, or the least recently used one beyond max_sessions, is simply dropped from
+    memory. Its next request loads it again from the end of its chat log.
+
+        POST   /sessions                {"model": ..., "system": ...}  -> {"session_id": ...}
+        POST   /sessions/<id>/messages  {"content": ..., "stream": true} -> SSE or {"reply": ...}
+        GET    /sessions/<id>           -> {"model": ..., "messages": [...]}
+        DELETE /sessions/<id>
+        GET    /stats
+    """
+
+    def __init__(
+        self,
+        api_key: str,
+        base_url: Optional[str] = None,
+        model: str = "gpt-4o-mini",
+        sessions_path: Optional[str] = None,
+        max_sessions: int = 1000,
+        idle_timeout: float = 600.0,
+        max_history_length: int = 50,
+        max_history_tokens: Optional[int] = 8000,
+        max_session_age: Optional[float] = None,
+        scheduler: Optional[RequestScheduler] = None,
+        response_cache: Optional[ResponseCache] = None
+    ):
+        """
+        :param api_key: Your OpenAI API key.
+        :param base_url: (Optional) The API endpoint, e.g. a proxy or a local server.
+        :param model: The model of new sessions that do not ask for one.
+        :param sessions_path: (Optional) The directory the session logs are kept in.
+                              Defaults to the 'sessions' directory in CACHE_PATH.
+        :param max_sessions: How many sessions are kept in memory at most.
+        :param idle_timeout: The seconds after which an idle session is dropped from memory.
+        :param max_history_length: The maximum number of messages a session keeps in memory.
+        :param max_history_tokens: (Optional) The maximum number of tokens a session keeps in memory.
+        :param max_session_age: (Optional) The seconds after which an unused session log is deleted.
+        :param scheduler: (Optional) The scheduler that rate limits and retries the requests of every session.
+        :param response_cache: (Optional) A cache to answer repeated requests from without an API call.
+        """
+        self.api_key = api_key
+        self.base_url = base_url
+        self.model = model
+        self.sessions_path = sessions_path or os.path.join(os.getenv('CACHE_PATH', '.'), 'sessions')
+        os.makedirs(self.sessions_path, exist_ok=True)
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.max_history_length = max_history_length
+        self.max_history_tokens = max_history_tokens
+        self.max_session_age = max_session_age
+        self.scheduler = scheduler or RequestScheduler()
+        self.response_cache = response_cache
+
+        self._sessions: "OrderedDict[str, _Session]" = OrderedDict()  # Least recently used first
+        self._loading: Dict[str, asyncio.Future] = {}
+        self.stats = {"created": 0, "evicted": 0, "rehydrated": 0, "turns": 0, "prompt_tokens": 0, "cached_tokens": 0}
+
+    # Sessions
+
+    def _new_session(self, session_id: str, model: str, system: Optional[str]) -> _Session:
+        bot = AsyncChatBot(
+            api_key=self.api_key,
+            model=model,
+            max_history_length=self.max_history_length,
+            max_history_tokens=self.max_history_tokens,
+            base_url=self.base_url,
+            scheduler=self.scheduler,
+            response_cache=self.response_cache,
+        )
+        if system:
+            bot.set_system_prompt(system)
+        log = ChatLogManager(
+            save_path=self.sessions_path,
+            max_cached_files=None,
+            max_cached_age=self.max_session_age,
+            verbose=False
+        )
+        log.filename = SESSION_LOG.format(session_id)
+        return _Session(session_id, bot, log)
+
+    def _add(self, session: _Session):
+        self._sessions[session.id] = session
+        self._sessions.move_to_end(session.id)
+        self._evict(lambda s: len(self._sessions) > self.max_sessions)
+
+    def _evict(self, should_evict):
+        """
+        Drops sessions from memory, least recently used first, while should_evict(session) is
+        true. Sessions that a request is using are skipped. Their logs are already saved.
+        """
+        for session in list(self._sessions.values()):
+            if not should_evict(session):
+                break
+            if session.users:
+                continue
+            del self._sessions[session.id]
+            self.stats["evicted"] += 1
+
+    async def _evict_idle(self):
+        while True:
+            await asyncio.sleep(min(self.idle_timeout / 2, 30))
+            deadline = time.monotonic() - self.idle_timeout
+            self._evict(lambda session: session.last_used < deadline)
+
+    def _write_meta(self, session_id: str, model: str, system: Optional[str]):
+        with open(os.path.join(self.sessions_path, SESSION_META.format(session_id)), 'w') as file:
+            json.dump({"model": model, "system": system}, file)
+
+    def _rehydrate(self, session_id: str) -> Optional[_Session]:
+        """
+        Loads a session that is not in memory from its files, on a worker thread.
+        """
+        try:
+            with open(os.path.join(self.sessions_path, SESSION_META.format(session_id))) as file:
+                meta = json.load(file)
+        except (OSError, ValueError):
+            return None
+        session = self._new_session(session_id, meta.get("model") or self.model, meta.get("system"))
+        bot = session.bot
+        session.log.flush()  # The last turns saved before the session was dropped may still be queued
+        if os.path.exists(os.path.join(self.sessions_path, session.log.filename)):
+            bot.chat_history = session.log.resume(session.log.filename, last_n=bot.max_history_length,
+                                                  max_tokens=bot.get_history_token_budget())
+        return session
+
+    async def _rehydrate_and_add(self, session_id: str) -> Optional[_Session]:
+        try:
+            session = await asyncio.to_thread(self._rehydrate, session_id)
+            if session is not None:
+                self._add(session)
+                self.stats["rehydrated"] += 1
+            return session
+        finally:
+            # Only once the session is in memory, so no request in between loads it again
+            self._loading.pop(session_id, None)
+
+    async def _load_session(self, session_id: str) -> _Session:
+        session = self._sessions.get(session_id)
+        if session is not None:
+            return session
+        # Concurrent requests for the same session share one load, so there is only ever one
+        # ChatLogManager appending to its log
+        loading = self._loading.get(session_id)
+        if loading is None:
+            loading = self._loading[session_id] = asyncio.ensure_future(self._rehydrate_and_add(session_id))
+        session = await loading
+        if session is None:
+            raise HTTPError(404, "No such session.")
+        return session
+
+    @asynccontextmanager
+    async def use_session(self, session_id: str):
+        """
+        Gets a session, loading it from its chat log if it is not in memory, and keeps it in
+        memory until the block ends.
+        """
+        session = await self._load_session(session_id)
+        session.users += 1
+        try:
+            session.last_used = time.monotonic()
+            self._add(session)
+            yield session
+        finally:
+            session.users -= 1
+            session.last_used = time.monotonic()
+
+    # Routes
+
+    async def create_session(self, body: Dict) -> Tuple[int, Dict]:
+        session_id = uuid.uuid4().hex
+        model = body.get("model") or self.model
+        await asyncio.to_thread(self._write_meta, session_id, model, body.get("system"))
+        self._add(self._new_session(session_id, model, body.get("system")))
+        self.stats["created"] += 1
+        return 201, {"session_id": session_id, "model": model}
+
+    async def delete_session(self, session_id: str) -> Tuple[int, Dict]:
+        async with self.use_session(session_id) as session, session.lock:
+            self._sessions.pop(session_id, None)
+            session.log.flush()
+            for name in (session.log.filename, SESSION_META.format(session_id)):
+                try:
+                    os.remove(os.path.join(self.sessions_path, name))
+                except FileNotFoundError:
+                    pass
+            session.log.manifest.remove(session.log.filename)
+        return 200, {"deleted": session_id}
+
+    async def send_message(self, session: _Session, body: Dict, writer: asyncio.StreamWriter):
+        content = body.get("content")
+        if not isinstance(content, str) or not content.strip():
+            raise HTTPError(400, "'content' must be a non-empty string.")
+        stream = body.get("stream", True)
+        async with session.lock:
+            chunks = session.bot.stream_message(content, body.get("model"))
+            try:
+                if stream:
+                    await self._send_events(writer, chunks, session)
+                else:
+                    reply = "".join([chunk async for chunk in chunks])
+                    await self._send_json(writer, 200, {"reply": reply, "usage": session.bot.last_usage})
+            finally:
+                await chunks.aclose()  # Keeps the partial reply if the client went away
+                session.log.save_chatlog(session.bot.chat_history)
+                self.stats["turns"] += 1
+                usage = session.bot.last_usage
+                if usage:
+                    self.stats["prompt_tokens"] += usage["prompt_tokens"] or 0
+                    self.stats["cached_tokens"] += usage["cached_tokens"]
+
+    async def dispatch(self, method: str, path: str, body: Dict, writer: asyncio.StreamWriter):
+        if path == "/sessions" and method == "POST":
+            return await self._send_json(writer, *await self.create_session(body))
+        if path == "/stats" and method == "GET":
+            return await self._send_json(writer, 200, dict(self.stats, sessions=len(self._sessions),
+                                                           requests=self.scheduler.get_metrics()))
+        match = _SESSION_PATH.match(path)
+        if match is None:
+            raise HTTPError(404, "Not found.")
+        session_id, messages = match.groups()
+        if messages and method == "POST":
+            async with self.use_session(session_id) as session:
+                return await self.send_message(session, body, writer)
+        if not messages and method == "GET":
+            async with self.use_session(session_id) as session:
+                return await self._send_json(writer, 200, {"session_id": session_id, "model": session.bot.model,
+                                                           "messages": session.bot.chat_history,
+                                                           "prompt_cache": session.bot.prompt_cache})
+        if not messages and method == "DELETE":
+            return await self._send_json(writer, *await self.delete_session(session_id))
+        raise HTTPError(405, "Method not allowed.")
+
+    # HTTP
+
+    async def _send_json(self, writer: asyncio.StreamWriter, status: int, payload: Dict):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        writer.write(f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+                     f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n".encode('ascii') + body)
+        await writer.drain()
+
+    async def _send_events(self, writer: asyncio.StreamWriter, chunks, session: _Session):
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+                     b"Cache-Control: no-cache\r\nTransfer-Encoding: chunked\r\n\r\n")
+
+        def event(payload):
+            data = f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode('utf-8')
+            writer.write(b"%x\r\n%s\r\n" % (len(data), data))
+
+        async for chunk in chunks:
+            event({"delta": chunk})
+            await writer.drain()  # Also notices when the client went away
+        event({"done": True, "usage": session.bot.last_usage})
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    async def _read_request(self, reader: asyncio.StreamReader):
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        try:
+            method, target, _ = request_line.decode('latin-1').split(" ", 2)
+        except ValueError:
+            raise HTTPError(400, "Malformed request line.")
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode('latin-1').partition(":")
+            headers[name.strip().lower()] = value.strip()
+        try:
+            length = int(headers.get("content-length") or 0)
+            if length < 0:
+                raise ValueError(length)
+        except ValueError:
+            raise HTTPError(400, "Malformed Content-Length header.")
+        if length > MAX_BODY_BYTES:
+            raise HTTPError(413, "Request body too large.")
+        body = {}
+        if length:
+            try:
+                body = json.loads(await reader.readexactly(length))
+            except ValueError:
+                raise HTTPError(400, "Request body must be JSON.")
+            if not isinstance(body, dict):
+                raise HTTPError(400, "Request body must be a JSON object.")
+        return method.upper(), target.split("?", 1)[0], headers, body
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                headers = {}
+                try:
+                    request = await self._read_request(reader)
+                    if request is None:
+                        break
+                    method, path, headers, body = request
+                    await self.dispatch(method, path, body, writer)
+                except HTTPError as e:
+                    await self._send_json(writer, e.status, {"error": str(e)})
+                    if not headers:
+                        break  # The request was not read completely
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass  # The client went away
+        except Exception as e:
+            # A bug in a route: the client gets a status line instead of a dropped connection
+            print_error(f"Request failed: {type(e).__name__}: {e}")
+            try:
+                await self._send_json(writer, 500, {"error": "Internal server error."})
+            except ConnectionError:
+                pass
+        finally:
+            writer.close()
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8080) -> asyncio.AbstractServer:
+        """
+        Starts listening and returns the asyncio server; port 0 picks a free port.
+        """
+        server = await asyncio.start_server(self.handle_connection, host, port, backlog=1024)
+        self._eviction = asyncio.ensure_future(self._evict_idle())
+        return server
+
+    async def close(self):
+        """
+        Stops dropping idle sessions and waits until every saved turn is on disk.
+        """
+        self._eviction.cancel()
+        for session in list(self._sessions.values())[-1:]:
+            await asyncio.to_thread(session.log.flush)  # One writer thread serves every session
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 8080):
+        server = await self.start(host, port)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            await self.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="main.py serve", description="Serves many chat sessions over HTTP.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--model", default="gpt-4o-mini", help="the model of new sessions")
+    parser.add_argument("--max-sessions", type=int, default=1000, help="sessions kept in memory")
+    parser.add_argument("--idle-timeout", type=float, default=600, help="seconds before an idle session leaves memory")
+    parser.add_argument("--max-history-tokens", type=int, default=8000, help="tokens of history per session")
+    parser.add_argument("--max-session-days", type=float, help="days before an unused session is deleted")
+    args = parser.parse_args(argv)
+
+    from dotenv import load_dotenv
+    from ui import print_info
+    load_dotenv()
+
+    api_key = os.getenv('OPENAI_API_KEY')
+    if not api_key:
+        print_error("API key must be provided via the OPENAI_API_KEY environment variable.")
+        return 1
+    server = ChatServer(
+        api_key=api_key,
+        model=args.model,
+        max_sessions=args.max_sessions,
+        idle_timeout=args.idle_timeout,
+        max_history_tokens=args.max_history_tokens,
+        max_session_age=args.max_session_days * 86400 if args.max_session_days else None,
+        response_cache=ResponseCache() if os.getenv('RESPONSE_CACHE', '').lower() in ('1', 'true', 'yes') else None,
+    )
+    print_info(f"Serving chat sessions on http://{args.host}:{args.port}")
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    return 0
@@ -1,8 +1,20 @@
-import openai
 import os
-from dotenv import load_dotenv
-from typing import List, Dict, Optional
+import time
+import threading
+from typing import List, Dict, Optional, Iterator
 from os.path import join, dirname
+from clients import get_client
+from conversation_store import ConversationStore
+from model_router import CANCELLED
+from response_cache import ResponseCache
+from request_scheduler import RequestScheduler
+from tokens import (
+    count_message_tokens,
+    get_context_window,
+    supports_system_prompt,
+    DEFAULT_REPLY_RESERVE,
+    REPLY_PRIMING
+)
 
 
 class ChatBot:
@@ -15,7 +27,13 @@ class ChatBot:
         self, 
         api_key: Optional[str] = None, 
         model: str = "gpt-4o-mini", 
-        max_history_length: int = 20
+        max_history_length: int = 20,
+        max_history_tokens: Optional[int] = None,
+        reply_reserve: int = DEFAULT_REPLY_RESERVE,
+        base_url: Optional[str] = None,
+        response_cache: Optional[ResponseCache] = None,
+        scheduler: Optional[RequestScheduler] = None,
+        history_trim_target: float = 0.75
     ):
         """
         Initializes the ChatBot with the provided API key and model.
@@ -24,52 +42,284 @@ class ChatBot:
                         'OPENAI_API_KEY' environment variable.
         :param model: The OpenAI model to use for generating responses.
         :param max_history_length: The maximum number of messages to retain in history.
+        :param max_history_tokens: (Optional) The maximum number of tokens to retain in history.
+                                   By default the history may fill the model's context window.
+        :param reply_reserve: The number of tokens of the context window kept free for the reply.
+        :param base_url: (Optional) The API endpoint, e.g. a proxy or a local server.
+        :param response_cache: (Optional) A cache to answer repeated requests from without an API call.
+        :param scheduler: (Optional) The scheduler that rate limits, retries and hedges the requests.
+                          Chatbots sharing an API key should share one.
+        :param history_trim_target: The fraction of the history limits the history is trimmed to
+                                    once it exceeds them, 0.75 by default. 1.0 drops only as
+                                    much as needed, every turn.
         """
         self.api_key = api_key
         if not self.api_key:
             raise ValueError("API key must be provided either as an argument or via the OPENAI_API_KEY environment variable.")
         
-        openai.api_key = self.api_key
+        self.base_url = base_url
+        self._client = None
         self.model = model
         self.max_history_length = max_history_length
+        self.max_history_tokens = max_history_tokens
+        self.reply_reserve = reply_reserve
+        self.history_trim_target = history_trim_target
+        self.response_cache = response_cache
+        self.scheduler = scheduler or RequestScheduler()
+        self.last_usage: Optional[Dict[str, int]] = None  # Token usage of the last reply, as reported by the API
+        self.prompt_cache = {"prompt_tokens": 0, "cached_tokens": 0}  # Totals of the session, for the hit rate
         self.system_prompt = [{"role":"system", "content": "You are a helpful assistant"}]
-        self.chat_history: List[Dict[str, str]] = []
+        self._history_lock = threading.RLock()  # The history may be compacted by a background thread
+        self._store = ConversationStore()
+        self.memory = None  # (Optional) A SemanticMemory to recall relevant past messages from
+        self.router = None  # (Optional) A ModelRouter that picks the model of every turn
 
+    @property
+    def client(self):
+        """
+        The shared OpenAI client. It is created on first use, so openai is only imported
+        once a message is actually sent.
+        """
+        if self._client is None:
+            self._client = get_client(self.api_key, self.base_url)
+        return self._client
+
+    @property
+    def chat_history(self) -> List[Dict[str, str]]:
+        """
+        The messages of the conversation that are sent with requests, oldest first.
+        The list is changed in place as the conversation goes on.
+        """
+        return self._store.messages
+
+    @chat_history.setter
+    def chat_history(self, history: List[Dict[str, str]]):
+        """
+        Replaces the history, e.g. with one loaded from a chat log, and counts its tokens.
+        """
+        token_counts = [count_message_tokens(message) for message in history]
+        with self._history_lock:
+            self._store.reset(history, token_counts)
+            self._enforce_history_limit()
+
+    def _append_message(self, role: str, content: str) -> Dict[str, str]:
+        """
+        Appends a message to the history, counting its tokens once. Returns the message.
+        """
+        message = {"role": role, "content": content}
+        tokens = count_message_tokens(message)
+        with self._history_lock:
+            self._store.append(message, tokens)
+            self._enforce_history_limit()
+        return message
+
+    def replace_oldest(self, messages: List[Dict[str, str]], summary: str) -> bool:
+        """
+        Replaces the oldest messages of the history with a summary of them, in one step.
+        Messages that were trimmed meanwhile are replaced too; if the history no longer
+        holds the newest of them (it was cleared, loaded or undone), nothing changes.
 
+        :param messages: The oldest messages of the history, as they were summarized.
+        :param summary: The summary, sent as a user message in their place.
+        :return: Whether the history was changed.
+        """
+        message = {"role": "user", "content": summary}
+        tokens = count_message_tokens(message)
+        with self._history_lock:
+            history = self._store.messages
+            last = messages[-1]
+            cut = next((i + 1 for i, kept in enumerate(history[:len(messages)]) if kept is last), None)
+            if cut is None:
+                return False
+            self._store.replace_oldest(cut, message, tokens)
+            self._enforce_history_limit()
+        return True
+
+
+    def complete(self, messages: List[Dict[str, str]], model: Optional[str] = None) -> str:
+        """
+        Sends messages as a one-off request, without reading or changing the chat history.
+        Errors are raised to the caller.
 
-    def send_message(self, user_input: str, model: Optional[str] = None) -> str:
+        :param messages: The request messages.
+        :param model: (Optional) The model to use. Defaults to the chatbot's model.
+        :return: The response.
+        """
+        response = self._request(messages, model or self.model)
+        return response.choices[0].message.content.strip()
+
+    def _request(self, messages: List[Dict[str, str]], model: str, stream: bool = False):
+        """
+        Sends a chat completion request through the scheduler.
+        """
+        estimated_tokens = sum(count_message_tokens(message) for message in messages)
+        options = {"stream": True, "stream_options": {"include_usage": True}} if stream else {}
+        return self.scheduler.call(
+            lambda timeout: self.client.chat.completions.with_raw_response.create(
+                model=model,
+                messages=messages,
+                timeout=timeout,
+                **options,
+            ),
+            estimated_tokens=estimated_tokens,
+            hedge=not stream,
+        )
+
+    def _record_usage(self, usage):
+        if usage is None:
+            self.last_usage = None
+            return
+        details = getattr(usage, "prompt_tokens_details", None)
+        self.last_usage = {
+            "prompt_tokens": usage.prompt_tokens,
+            "completion_tokens": usage.completion_tokens,
+            "cached_tokens": getattr(details, "cached_tokens", None) or 0,
+        }
+        self.prompt_cache["prompt_tokens"] += self.last_usage["prompt_tokens"] or 0
+        self.prompt_cache["cached_tokens"] += self.last_usage["cached_tokens"]
+
+    def _get_cache_key(self, messages: List[Dict[str, str]], use_cache: bool) -> Optional[str]:
+        if self.response_cache is None or not use_cache:
+            return None
+        return ResponseCache.make_key(self.model, self.system_prompt, messages)
+
+    def send_message(
+        self,
+        user_input: str,
+        model: Optional[str] = None,
+        use_cache: bool = True,
+        raise_errors: bool = False
+    ) -> str:
         """
         Sends a user message to the OpenAI API and returns the chatbot's response.
 
         :param user_input: The input message from the user.
         :param model: (Optional) The model to use for this specific message.
+        :param use_cache: Whether the response cache may answer this message, if there is one.
+        :param raise_errors: Raise API errors instead of answering with an apology, e.g. in scripts.
         :return: The chatbot's response.
         """
+        import openai
+
         # Append the user message to the history
-        self.chat_history.append({"role": "user", "content": user_input})
-        self._enforce_history_limit()
+        self._append_message("user", user_input)
         # Change the model if the model value was given
 
         if model:
             self.set_model(model)
+        route = None if model else self._route()
+
+        messages = self._format_system_prompt()
+        cache_key = self._get_cache_key(messages, use_cache)
+        if cache_key:
+            assistant_message = self.response_cache.get(cache_key)
+            if assistant_message is not None:
+                self.last_usage = None
+                self._append_message("assistant", assistant_message)
+                return assistant_message
 
+        start = time.perf_counter()
         try:
-            response = openai.chat.completions.create(
-                model=self.model,
-                messages=self._format_system_prompt(),
-            )
+            response = self._request(messages, self.model)
+            self._record_usage(response.usage)
+            if route:
+                self.router.record(route, None, time.perf_counter() - start, self.last_usage)
             # Extract the assistant's reply
             assistant_message = response.choices[0].message.content.strip()
+            if cache_key:
+                self.response_cache.put(cache_key, self.model, assistant_message)
             # Append the assistant's reply to the history
-            self.chat_history.append({"role": "assistant", "content": assistant_message})
-            self._enforce_history_limit()
+            self._append_message("assistant", assistant_message)
             return assistant_message
 
-        except openai.error.OpenAIError as e:
+        except openai.OpenAIError as e:
+            if route:
+                self.router.record(route, None, time.perf_counter() - start, error=type(e).__name__)
+            if raise_errors:
+                raise
             # Handle API errors gracefully
             print(f"An error occurred: {e}")
             return "I'm sorry, but I'm unable to process your request at the moment."
 
+    def stream_message(self, user_input: str, model: Optional[str] = None, use_cache: bool = True) -> Iterator[str]:
+        """
+        Sends a user message to the OpenAI API and yields the chatbot's response as it arrives.
+        The reply is appended to the history once the stream ends. If the stream is cut off
+        (API error or the consumer stops iterating), the partial reply is kept. If it is
+        cancelled (Ctrl+C or the consumer stops iterating) before any of the reply arrived,
+        the question is taken out of the history again, so it never holds two questions in a row.
+
+        :param user_input: The input message from the user.
+        :param model: (Optional) The model to use for this specific message.
+        :param use_cache: Whether the response cache may answer this message, if there is one.
+        :return: An iterator over the chunks of the chatbot's response.
+        """
+        import openai
+
+        # Append the user message to the history
+        question = self._append_message("user", user_input)
+
+        if model:
+            self.set_model(model)
+        route = None if model else self._route()
+
+        messages = self._format_system_prompt()
+        cache_key = self._get_cache_key(messages, use_cache)
+        if cache_key:
+            assistant_message = self.response_cache.get(cache_key)
+            if assistant_message is not None:
+                self.last_usage = None
+                self._append_message("assistant", assistant_message)
+                yield assistant_message
+                return
+
+        stream = None
+        chunks: List[str] = []
+        self.last_usage = None
+        start = time.perf_counter()
+        first_token = None
+        error = None
+        try:
+            stream = self._request(messages, self.model, stream=True)
+            for chunk in stream:
+                if chunk.usage is not None:
+                    self._record_usage(chunk.usage)  # Sent in the last chunk
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    if first_token is None:
+                        first_token = time.perf_counter() - start
+                    chunks.append(delta)
+                    yield delta
+            # Only complete replies are cached
+            if cache_key:
+                self.response_cache.put(cache_key, self.model, "".join(chunks).strip())
+
+        except openai.OpenAIError as e:
+            error = type(e).__name__
+            # Handle API errors gracefully
+            print(f"An error occurred: {e}")
+            if not chunks:
+                yield "I'm sorry, but I'm unable to process your request at the moment."
+
+        except (GeneratorExit, KeyboardInterrupt):
+            error = CANCELLED  # The time until then is not how long the model took
+            raise
+
+        finally:
+            if stream is not None:
+                stream.close()  # Release the connection if the stream was cut off
+            if route:
+                self.router.record(route, first_token, time.perf_counter() - start, self.last_usage, error)
+            # Keep whatever was received, even if the stream ended early
+            assistant_message = "".join(chunks).strip()
+            if assistant_message:
+                self._append_message("assistant", assistant_message)
+            elif error == CANCELLED:
+                with self._history_lock:
+                    self._store.discard(question)
+
 
     def clear_history(self):
         """
@@ -79,13 +329,80 @@ class ChatBot:
 
     def _enforce_history_limit(self):
         """
-        Ensures that the chat history does not exceed the maximum allowed length.
-        This helps manage the token usage and maintain performance.
+        Ensures that the chat history does not exceed the maximum allowed length or token budget.
+        Once it does, the oldest messages are dropped in one step, down to history_trim_target of
+        the limits and on to the start of a user turn, instead of one message every turn. The
+        requests then begin with the same messages for many turns, so the provider's prompt
+        prefix cache keeps hitting.
+        The cached token counts are used, so trimming costs nothing per remaining message.
+        """
+        with self._history_lock:
+            store = self._store
+            history = store.messages
+            if not history:
+                return
+            budget = self.get_history_token_budget()
+            if len(history) <= self.max_history_length and store.tokens <= budget:
+                return
+            max_length = max(int(self.max_history_length * self.history_trim_target), 1)
+            budget = int(budget * self.history_trim_target)
+            excess = max(len(history) - max_length, 0)
+            tokens = store.tokens - store.tokens_before(excess)
+            # Drop the oldest messages until the rest fits, but always keep the newest one
+            while tokens > budget and excess < len(history) - 1:
+                tokens -= store.token_count(excess)
+                excess += 1
+            # Start with a user message, so no reply is left without its question
+            while history[excess]["role"] != "user" and excess < len(history) - 1:
+                tokens -= store.token_count(excess)
+                excess += 1
+            store.trim(excess)
+
+    def _system_prompt_tokens(self) -> int:
+        if not supports_system_prompt(self.model):
+            return 0  # The system prompt is not sent to these models
+        return sum(count_message_tokens(message) for message in self.system_prompt)
+
+    def get_history_token_budget(self) -> int:
+        """
+        Returns how many tokens the history may use: the model's context window minus the
+        system prompt and the room reserved for the reply and the recalled messages.
+        """
+        budget = (get_context_window(self.model) - self.reply_reserve
+                  - self._system_prompt_tokens() - REPLY_PRIMING)
+        if self.memory is not None:
+            budget -= self.memory.max_tokens  # Room for the recalled messages
+        if self.max_history_tokens is not None:
+            budget = min(budget, self.max_history_tokens)
+        return max(budget, 0)
+
+    def get_budget_usage(self) -> Dict[str, int]:
+        """
+        Reports how much of the model's context window the next request will use.
+        """
+        return {
+            "model": self.model,
+            "context_window": get_context_window(self.model),
+            "reply_reserve": self.reply_reserve,
+            "system_prompt_tokens": self._system_prompt_tokens(),
+            "history_tokens": self._store.tokens,
+            "history_budget": self.get_history_token_budget(),
+            "messages": len(self._store),
+        }
+
+    def _route(self) -> Optional[Dict]:
+        """
+        Lets the router pick the model for the next request, if there is a router.
         """
-        if len(self.chat_history) > self.max_history_length:
-            # Remove the oldest messages to maintain the limit
-            excess = len(self.chat_history) - self.max_history_length
-            self.chat_history = self.chat_history[excess:]
+        if self.router is None:
+            return None
+        with self._history_lock:
+            prompt_tokens = self._store.tokens + REPLY_PRIMING
+        prompt_tokens += sum(count_message_tokens(message) for message in self.system_prompt)
+        route = self.router.route(prompt_tokens)
+        if route["model"] != self.model:
+            self.set_model(route["model"])
+        return route
 
     def set_model(self, model: str):
         """
@@ -94,6 +411,7 @@ class ChatBot:
         :param model: The new OpenAI model to use.
         """
         self.model = model
+        self._enforce_history_limit()  # The new model may have a smaller context window
 
     def set_max_history_length(self, max_length: int):
         """
@@ -107,15 +425,33 @@ class ChatBot:
     def remove_last_interaction(self):
         """
         Removes the last user message and the corresponding assistant reply from the history.
+        They are kept aside, so redo_last_interaction can bring them back.
         """
-        if len(self.chat_history) >= 2:
-            # Remove assistant message
-            removed_assistant = self.chat_history.pop()
-            # Remove user message
-            removed_user = self.chat_history.pop()
-            print("Last interaction removed from history.")
-        else:
-            print("No interaction to remove.")
+        with self._history_lock:
+            if self._store.undo(2):
+                print("Last interaction removed from history.")
+            else:
+                print("No interaction to remove.")
+
+    def redo_last_interaction(self, branch: int = -1) -> bool:
+        """
+        Brings back an interaction removed by remove_last_interaction.
+
+        :param branch: Which of the interactions removed at this point, by default the last one.
+        :return: Whether there was one to bring back.
+        """
+        with self._history_lock:
+            if not self._store.redo(2, branch):
+                return False
+            self._enforce_history_limit()  # The limits may have changed meanwhile
+            return True
+
+    def count_redo_branches(self) -> int:
+        """
+        Returns how many removed interactions redo_last_interaction can choose from.
+        """
+        with self._history_lock:
+            return self._store.branches()
     def _detach_system_prompt(self):
         return self.chat_history[1:]
 
@@ -123,23 +459,26 @@ class ChatBot:
         return self.system_prompt+self.chat_history
 
     def _format_system_prompt(self):
-        if self.model.lower().startswith('o1'):
-            return self.chat_history
+        # The request is the only copy of the history that is made, and holds the same messages
+        with self._history_lock:
+            messages = self._format_messages(self._store.messages, self.model)
+        if self.memory is not None and messages and messages[-1]["role"] == "user":
+            recalled = self.memory.recall(messages[-1]["content"], messages)
+            if recalled:
+                # Right before the question, so the start of the request stays the same between turns
+                role = "system" if supports_system_prompt(self.model) else "user"
+                messages.insert(len(messages) - 1, {"role": role, "content": recalled})
+        return messages
+
+    def _format_messages(self, history: List[Dict[str, str]], model: str) -> List[Dict[str, str]]:
+        """
+        Builds the request messages for the model, which for o1 models excludes the system prompt.
+        """
+        if not supports_system_prompt(model):
+            return list(history)
         else:
-            return self._attach_system_prompt()
+            return self.system_prompt + history
 
     def set_system_prompt(self,prompt):
         self.system_prompt = [{"role": 'system', 'content': prompt}]
-
-
-    def get_history(self) -> str:
-        """
-        Returns a string representation of the conversation history.
-
-        :return: A formatted string of the chat history.
-        """
-        history_str = ""
-        for message in self.chat_history[:-2]: # remove final summary query
-            role = "User" if message["role"] == "user" else "Assistant"
-            history_str += f"**{role}**: \n\n{message['content']}\n\n"
-        return history_str.strip()
+        self._enforce_history_limit()
@@ -0,0 +1,228 @@
+# Readers and writers for the two chat log formats.
+#
+# Plain logs (.jsonl) hold one JSON message per line.
+#
+# Compressed logs (.jsonlz) hold a sequence of frames, each a zlib stream of JSONL messages,
+# followed by a footer: a JSON list of [offset, length, message count] per frame, the footer
+# length as a little-endian uint32 and the magic bytes b"CLZ1". The footer lets a reader
+# decompress only the frames it needs, starting from the end.
+import os
+import json
+import mmap
+import zlib
+import struct
+from typing import List, Dict, Optional, Tuple
+from tokens import count_message_tokens
+
+COMPRESSED_SUFFIX = '.jsonlz'
+FRAME_MESSAGES = 64  # Messages per frame in compressed logs
+MAGIC = b"CLZ1"
+_TRAILER = struct.Struct("<I4s")
+
+
+def encode_messages(messages: List[Dict[str, str]]) -> bytes:
+    return b"".join((json.dumps(message) + "\n").encode('utf-8') for message in messages)
+
+
+def encode_frame(messages: List[Dict[str, str]]) -> bytes:
+    return zlib.compress(encode_messages(messages))
+
+
+def encode_footer(frames: List[Tuple[int, int, int]]) -> bytes:
+    """
+    :param frames: The offset, length and message count of every frame.
+    """
+    index = json.dumps(frames, separators=(',', ':')).encode('utf-8')
+    return index + _TRAILER.pack(len(index), MAGIC)
+
+
+def _decode_lines(data: bytes, tolerate_torn_tail: bool) -> List[Dict[str, str]]:
+    lines = data.splitlines()
+    messages = []
+    for i, line in enumerate(lines):
+        try:
+            messages.append(json.loads(line))
+        except json.JSONDecodeError:
+            if not (tolerate_torn_tail and i == len(lines) - 1):
+                raise
+    return messages
+
+
+def _read_footer(buffer) -> Optional[List[Tuple[int, int, int]]]:
+    if len(buffer) < _TRAILER.size:
+        return None
+    length, magic = _TRAILER.unpack(buffer[-_TRAILER.size:])
+    start = len(buffer) - _TRAILER.size - length
+    if magic != MAGIC or start < 0:
+        return None
+    try:
+        return json.loads(bytes(buffer[start:len(buffer) - _TRAILER.size]))
+    except ValueError:
+        return None
+
+
+def _walk_frames(buffer):
+    """
+    Decompresses frames one after another from the start, for a file whose footer was never
+    written because of a crash. Yields the offset, length and data of every complete frame
+    and stops at the first incomplete one.
+    """
+    view = memoryview(buffer)
+    offset = 0
+    while offset < len(buffer):
+        decompressor = zlib.decompressobj()
+        try:
+            data = decompressor.decompress(view[offset:])
+        except zlib.error:
+            return
+        if not decompressor.eof:
+            return
+        end = len(buffer) - len(decompressor.unused_data)
+        yield offset, end - offset, data
+        offset = end
+
+
+def _recover_frames(buffer) -> List[List[Dict[str, str]]]:
+    """
+    Decodes the complete frames of a file whose footer was never written.
+    """
+    return [_decode_lines(data, tolerate_torn_tail=False) for _, _, data in _walk_frames(buffer)]
+
+
+def _enough(count: int, tokens: int, last_n: Optional[int], max_tokens: Optional[int]) -> bool:
+    return ((last_n is not None and count >= last_n)
+            or (max_tokens is not None and tokens >= max_tokens))
+
+
+def _trim(messages: List[Dict[str, str]], last_n: Optional[int], max_tokens: Optional[int]) -> List[Dict[str, str]]:
+    """
+    Keeps the newest messages that fit last_n and max_tokens, always at least one.
+    """
+    if last_n is not None:
+        messages = messages[-last_n:] if last_n > 0 else []
+    if max_tokens is not None:
+        tokens = 0
+        for i in range(len(messages) - 1, -1, -1):
+            tokens += count_message_tokens(messages[i])
+            if tokens > max_tokens and i < len(messages) - 1:
+                return messages[i + 1:]
+    return messages
+
+
+def _read_compressed_tail(buffer, last_n, max_tokens) -> List[Dict[str, str]]:
+    frames = _read_footer(buffer)
+    if frames is None:
+        decoded = _recover_frames(buffer)
+    else:
+        decoded = []
+        count, tokens = 0, 0
+        # Decompress frames from the newest until the limits are covered
+        for offset, length, _ in reversed(frames):
+            messages = _decode_lines(zlib.decompress(buffer[offset:offset + length]), tolerate_torn_tail=False)
+            decoded.append(messages)
+            count += len(messages)
+            if max_tokens is not None:
+                tokens += sum(count_message_tokens(message) for message in messages)
+            if _enough(count, tokens, last_n, max_tokens):
+                break
+        decoded.reverse()
+    return [message for messages in decoded for message in messages]
+
+
+def _read_plain_tail(buffer, last_n, max_tokens) -> List[Dict[str, str]]:
+    if last_n is None and max_tokens is None:
+        return _decode_lines(bytes(buffer), tolerate_torn_tail=True)
+    messages = []
+    tokens = 0
+    end = len(buffer)
+    # A last line without a newline was torn by an interrupted write
+    torn = end > 0 and buffer[end - 1:end] != b"\n"
+    # Walk the lines backwards from the end of the file
+    while end > 0 and not _enough(len(messages), tokens, last_n, max_tokens):
+        start = buffer.rfind(b"\n", 0, end - 1) + 1
+        line = buffer[start:end]
+        end = start
+        try:
+            message = json.loads(line)
+        except json.JSONDecodeError:
+            if torn and not messages:
+                torn = False
+                continue
+            raise
+        torn = False
+        messages.append(message)
+        if max_tokens is not None:
+            tokens += count_message_tokens(message)
+    messages.reverse()
+    return messages
+
+
+def read_chatlog(path: str, last_n: Optional[int] = None, max_tokens: Optional[int] = None) -> List[Dict[str, str]]:
+    """
+    Reads the messages of a plain or compressed chat log. With last_n or max_tokens only
+    the newest messages that fit are returned, and only the end of the file is decoded.
+
+    :param path: The chat log file.
+    :param last_n: (Optional) The maximum number of messages to return.
+    :param max_tokens: (Optional) The maximum number of tokens the returned messages may use.
+    :return: The messages in chronological order.
+    """
+    if os.path.getsize(path) == 0:
+        return []
+    with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        if path.endswith(COMPRESSED_SUFFIX):
+            messages = _read_compressed_tail(buffer, last_n, max_tokens)
+        else:
+            messages = _read_plain_tail(buffer, last_n, max_tokens)
+    return _trim(messages, last_n, max_tokens)
+
+
+def count_messages(path: str) -> int:
+    """
+    Counts the messages in a plain or compressed chat log without decoding them, except
+    for a compressed log without a valid footer, whose frames have to be recovered.
+    """
+    if os.path.getsize(path) == 0:
+        return 0
+    with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        if path.endswith(COMPRESSED_SUFFIX):
+            frames = _read_footer(buffer)
+            if frames is not None:
+                return sum(count for _, _, count in frames)
+            return sum(len(frame) for frame in _recover_frames(buffer))
+        # A torn last line has no newline and is not counted, like read_chatlog skips it
+        return sum(buffer[start:start + (1 << 20)].count(b"\n") for start in range(0, len(buffer), 1 << 20))
+
+
+def read_frame_index(path: str, recover: bool = False) -> Optional[List[Tuple[int, int, int]]]:
+    """
+    Returns [offset, length, message count] of every frame of a compressed chat log, or None
+    if its footer is missing or damaged.
+
+    :param recover: If the footer is missing or damaged, return the complete frames found by
+        decompressing the file from the start instead of None.
+    """
+    if os.path.getsize(path) == 0:
+        return []
+    with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        frames = _read_footer(buffer)
+        if frames is None and recover:
+            frames = [[offset, length, data.count(b"\n")] for offset, length, data in _walk_frames(buffer)]
+        return frames
+
+
+def find_line_ends(path: str, count: int) -> List[int]:
+    """
+    Returns the byte offsets where the last count complete lines of a plain chat log end,
+    oldest first. A torn last line is not counted.
+    """
+    if count == 0 or os.path.getsize(path) == 0:
+        return []
+    ends = []
+    with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        end = buffer.rfind(b"\n") + 1
+        while end > 0 and len(ends) < count:
+            ends.append(end)
+            end = buffer.rfind(b"\n", 0, end - 1) + 1
+    ends.reverse()
+    return ends
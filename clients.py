@@ -0,0 +1,33 @@
+from functools import lru_cache
+from typing import Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import openai
+
+
+@lru_cache(maxsize=None)
+def get_client(api_key: str, base_url: Optional[str] = None) -> "openai.OpenAI":
+    """
+    Returns the shared client for the API key, so every ChatBot reuses one connection pool.
+    The client does not retry on its own, ChatBot's RequestScheduler does.
+
+    :param api_key: Your OpenAI API key.
+    :param base_url: (Optional) The API endpoint. Defaults to the OPENAI_BASE_URL environment
+                     variable or the official endpoint.
+    """
+    import openai  # Imported on first use, it is the slowest import of the app
+    return openai.OpenAI(api_key=api_key, base_url=base_url, max_retries=0)
+
+
+@lru_cache(maxsize=None)
+def get_async_client(api_key: str, base_url: Optional[str] = None) -> "openai.AsyncOpenAI":
+    """
+    Returns the shared asyncio client for the API key, so every AsyncChatBot reuses one
+    connection pool. It must only be used from one event loop.
+
+    :param api_key: Your OpenAI API key.
+    :param base_url: (Optional) The API endpoint. Defaults to the OPENAI_BASE_URL environment
+                     variable or the official endpoint.
+    """
+    import openai
+    return openai.AsyncOpenAI(api_key=api_key, base_url=base_url)
@@ -0,0 +1,166 @@
+from typing import Dict, List, Optional, Sequence
+
+
+class _Node:
+    # Only links to children: without cycles, trimmed messages are freed as soon as they are cut off
+    __slots__ = ("message", "tokens", "children")
+
+    def __init__(self, message: Optional[Dict[str, str]], tokens: int):
+        self.message = message
+        self.tokens = tokens
+        self.children: Optional[List["_Node"]] = None  # Newest last, redo follows the newest
+
+
+class ConversationStore:
+    """
+    The chat history as a tree of messages. The conversation is the path from the root to the
+    newest message, and messages holds its window, the part sent with requests.
+
+    Undo moves the end of the path back without deleting anything, so redo can bring the
+    messages back, and a message sent after an undo starts a new branch next to the undone one.
+    Trimming the window cuts the path off in front of it, which frees the trimmed messages and
+    the branches that start from them.
+
+    messages is a single list that is only ever changed in place, so the request, the chat log
+    and the compactor can all use it without copying it. The token count of each message is
+    kept in its node, so trimming and budgeting never count a message again.
+    """
+
+    def __init__(self, messages: Optional[List[Dict[str, str]]] = None, token_counts: Sequence[int] = ()):
+        self.reset(messages if messages is not None else [], token_counts)
+
+    def reset(self, messages: List[Dict[str, str]], token_counts: Sequence[int]):
+        """
+        Replaces the whole tree with one path of messages. The list is used as is, not copied.
+
+        :param messages: The messages, oldest first.
+        :param token_counts: The token count of each message.
+        """
+        self._root = _Node(None, 0)
+        self._nodes: List[_Node] = []  # The path of the window, in step with messages
+        self.messages = messages
+        self.tokens = 0
+        parent = self._root
+        for message, tokens in zip(messages, token_counts):
+            node = _Node(message, tokens)
+            parent.children = [node]
+            self._nodes.append(node)
+            self.tokens += tokens
+            parent = node
+
+    def __len__(self) -> int:
+        return len(self.messages)
+
+    def _head(self) -> _Node:
+        return self._nodes[-1] if self._nodes else self._root
+
+    def token_count(self, index: int) -> int:
+        return self._nodes[index].tokens
+
+    def tokens_before(self, count: int) -> int:
+        """
+        Returns the tokens of the oldest count messages of the window.
+        """
+        return sum(node.tokens for node in self._nodes[:count])
+
+    def append(self, message: Dict[str, str], tokens: int):
+        parent = self._head()
+        node = _Node(message, tokens)
+        if parent.children is None:
+            parent.children = [node]
+        else:
+            parent.children.append(node)
+        self._nodes.append(node)
+        self.messages.append(message)
+        self.tokens += tokens
+
+    def _cut(self, first: Optional[_Node]):
+        """
+        Makes first the root's only child, dropping everything that came before it.
+        """
+        self._root.children = [first] if first is not None else None
+
+    def trim(self, count: int):
+        """
+        Drops the oldest count messages from the window. They can no longer be undone to.
+        """
+        if count <= 0:
+            return
+        self.tokens -= self.tokens_before(count)
+        self._cut(self._nodes[count] if count < len(self._nodes) else None)
+        del self._nodes[:count]
+        del self.messages[:count]
+
+    def replace_oldest(self, count: int, message: Dict[str, str], tokens: int):
+        """
+        Replaces the oldest count messages of the window with one message, e.g. their summary.
+        """
+        node = _Node(message, tokens)
+        if count < len(self._nodes):
+            node.children = [self._nodes[count]]
+        self.tokens += tokens - self.tokens_before(count)
+        self._cut(node)
+        self._nodes[:count] = [node]
+        self.messages[:count] = [message]
+
+    def undo(self, count: int) -> bool:
+        """
+        Takes the newest count messages out of the window. They stay in the tree for redo.
+
+        :return: Whether there were count messages to take out.
+        """
+        if count > len(self._nodes):
+            return False
+        for _ in range(count):
+            self.tokens -= self._nodes.pop().tokens
+            self.messages.pop()
+        return True
+
+    def discard(self, message: Dict[str, str]) -> bool:
+        """
+        Deletes the newest message, if it is message, from the window and from the tree, e.g. a
+        question whose reply was cancelled. Unlike undo, it cannot be brought back.
+
+        :return: Whether it was deleted.
+        """
+        if not self._nodes or self._nodes[-1].message is not message:
+            return False
+        node = self._nodes.pop()
+        parent = self._head()
+        parent.children = [child for child in parent.children if child is not node] or None
+        self.tokens -= node.tokens
+        self.messages.pop()
+        return True
+
+    def branches(self) -> int:
+        """
+        Returns how many undone branches redo can choose from at the end of the window.
+        """
+        children = self._head().children
+        return len(children) if children else 0
+
+    def redo(self, count: int, branch: int = -1) -> bool:
+        """
+        Brings back count undone messages: the first from the given branch, the following
+        ones from the branch that was undone last.
+
+        :param count: How many messages to bring back.
+        :param branch: The index of the branch, by default the newest one.
+        :return: Whether there were count messages to bring back.
+        """
+        path = [self._head()]
+        for _ in range(count):
+            children = path[-1].children
+            index = branch if len(path) == 1 else -1
+            if not children or not -len(children) <= index < len(children):
+                return False
+            path.append(children[index])
+        for parent, node in zip(path, path[1:]):
+            # The chosen branch becomes the newest, so the next redo follows it again
+            if parent.children[-1] is not node:
+                parent.children.remove(node)
+                parent.children.append(node)
+            self._nodes.append(node)
+            self.messages.append(node.message)
+            self.tokens += node.tokens
+        return True
@@ -0,0 +1,321 @@
+import os
+import html
+import json
+import hashlib
+import threading
+from collections import Counter
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, TYPE_CHECKING
+from chatlog_format import read_chatlog
+
+if TYPE_CHECKING:
+    from concurrent.futures import ProcessPoolExecutor
+
+EXPORT_FORMATS = ('md', 'html', 'json')
+EXPORT_MANIFEST = 'export_manifest.json'
+EXPORT_VERSION = 1  # Bumped when the output of a format changes, so every output is written again
+BATCH_SIZE = 16  # Chat logs per task of a bulk export, fewer round trips to the worker processes
+WRITE_BUFFER = 1 << 16  # Characters collected before they are encoded, hashed and written
+
+_JSON = json.JSONEncoder(ensure_ascii=False)
+
+_HTML_HEAD = """<!DOCTYPE html>
+<html lang="en">
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<style>
+body {{ font-family: sans-serif; max-width: 50em; margin: 2em auto; padding: 0 1em; }}
+.message {{ white-space: pre-wrap; margin: 1em 0; padding: 0.5em 1em; border-radius: 6px; }}
+.user {{ background: #e8f0fe; }}
+.assistant {{ background: #f1f3f4; }}
+.role {{ font-weight: bold; display: block; margin-bottom: 0.3em; }}
+</style>
+</head>
+<body>
+<h1>{title}</h1>
+"""
+
+
+class _HashingWriter:
+    """
+    Writes text to a file and hashes it on the way, so an output is hashed without being
+    held in memory or read back. Small pieces are collected and encoded together.
+    """
+
+    def __init__(self, file):
+        self._file = file
+        self._hash = hashlib.blake2b(digest_size=16)
+        self._pieces: List[str] = []
+        self._buffered = 0
+
+    def write(self, text: str):
+        self._pieces.append(text)
+        self._buffered += len(text)
+        if self._buffered >= WRITE_BUFFER:
+            self.flush()
+
+    def flush(self):
+        data = "".join(self._pieces).encode('utf-8')
+        self._pieces.clear()
+        self._buffered = 0
+        self._hash.update(data)
+        self._file.write(data)
+
+    def hexdigest(self) -> str:
+        self.flush()
+        return self._hash.hexdigest()
+
+
+def _role(message: Dict[str, str]) -> str:
+    return "User" if message["role"] == "user" else "Assistant"
+
+
+def write_markdown(messages: Iterable[Dict[str, str]], writer, title: Optional[str] = None):
+    """
+    Writes the conversation as Markdown: every message under a bold "User" or "Assistant"
+    heading, the format the search index reads saved conversations in.
+    """
+    previous = None
+    for message in messages:
+        if previous is not None:
+            writer.write(f"**{_role(previous)}**: \n\n{previous['content']}\n\n")
+        previous = message
+    if previous is not None:  # The last one without the whitespace it ends with
+        writer.write(f"**{_role(previous)}**: \n\n{previous['content']}".rstrip())
+
+
+def write_html(messages: Iterable[Dict[str, str]], writer, title: Optional[str] = None):
+    """
+    Writes the conversation as a self-contained HTML page.
+    """
+    writer.write(_HTML_HEAD.format(title=html.escape(title or "Conversation")))
+    for message in messages:
+        css_class = "user" if message["role"] == "user" else "assistant"
+        writer.write(f'<div class="message {css_class}"><span class="role">{_role(message)}</span>'
+                     f'{html.escape(message["content"].strip())}</div>\n')
+    writer.write("</body>\n</html>\n")
+
+
+def write_json(messages: Iterable[Dict[str, str]], writer, title: Optional[str] = None):
+    """
+    Writes the conversation as a JSON object with its title and messages.
+    """
+    writer.write('{"title": ' + json.dumps(title) + ', "messages": [')
+    separator = "\n"
+    for message in messages:
+        writer.write(separator + _JSON.encode({"role": message["role"], "content": message["content"]}))
+        separator = ",\n"
+    writer.write("\n]}\n")
+
+
+_WRITERS = {'md': write_markdown, 'html': write_html, 'json': write_json}
+
+
+def _write_output(messages: List[Dict[str, str]], path: str, fmt: str, title: Optional[str],
+                  previous: Optional[str]) -> Tuple[str, bool]:
+    """
+    Streams one output to a temporary file and moves it into place, unless its content hash
+    equals the one of the output already there. Returns the hash and whether it was written.
+    """
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, 'wb') as file:
+        writer = _HashingWriter(file)
+        _WRITERS[fmt](messages, writer, title)
+        digest = writer.hexdigest()
+    if digest == previous and os.path.exists(path):
+        os.remove(temporary)  # Unchanged: the file and its modification time are left alone
+        return digest, False
+    os.replace(temporary, path)
+    return digest, True
+
+
+def _source_digest(path: str) -> str:
+    hasher = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def export_messages(messages: List[Dict[str, str]], directory: str, name: str, formats: Iterable[str],
+                    title: Optional[str] = None, known: Optional[Dict[str, str]] = None) -> Dict:
+    """
+    Writes a conversation in every format to directory/name.<format>.
+
+    :param known: The content hashes of the existing outputs, by path.
+    :return: The content hash of every output and which of them were written.
+    """
+    known = known or {}
+    outputs, written = {}, []
+    for fmt in formats:
+        path = os.path.join(directory, f"{name}.{fmt}")
+        digest, changed = _write_output(messages, path, fmt, title, known.get(path))
+        outputs[path] = digest
+        if changed:
+            written.append(path)
+    return {"outputs": outputs, "written": written}
+
+
+def export_logs(jobs: List[Tuple[str, str, Optional[str], Dict]], directory: str, formats: List[str]) -> List[Dict]:
+    """
+    Exports a batch of chat logs. Runs in the worker processes.
+
+    :param jobs: The path, name, title and manifest entry of every chat log.
+    :return: The new manifest entry of every chat log, or the error it failed with.
+    """
+    results = []
+    for source, name, title, entry in jobs:
+        try:
+            stat = os.stat(source)
+            signature = [stat.st_size, stat.st_mtime_ns]
+            paths = [os.path.join(directory, f"{name}.{fmt}") for fmt in formats]
+            exported_before = entry.get("version") == EXPORT_VERSION and entry.get("title") == title \
+                and all(path in entry.get("outputs", {}) and os.path.exists(path) for path in paths)
+            # The log is only hashed if it was touched, and only rendered if its content changed
+            if exported_before and entry.get("signature") == signature:
+                results.append({"name": name, "entry": entry, "written": [], "skipped": True})
+                continue
+            source_digest = _source_digest(source)
+            if exported_before and entry.get("source") == source_digest:
+                results.append({"name": name, "entry": dict(entry, signature=signature), "written": [],
+                                "skipped": True})
+                continue
+            exported = export_messages(read_chatlog(source), directory, name, formats, title, entry.get("outputs"))
+            outputs = dict(entry.get("outputs", {}), **exported["outputs"])
+            results.append({"name": name, "written": exported["written"], "skipped": False, "entry": {
+                "source": source_digest, "signature": signature, "version": EXPORT_VERSION, "title": title,
+                "outputs": outputs}})
+        except Exception as e:
+            results.append({"name": name, "error": f"{type(e).__name__}: {e}"})
+    return results
+
+
+class Exporter:
+    """
+    Exports conversations to Markdown, HTML and JSON in a pool of worker processes, so
+    rendering and writing never hold up the chat.
+
+    Outputs are streamed to disk, never built as one string, and their content hashes are
+    kept in a manifest in the output directory. An output whose content did not change is not
+    written again, and a chat log that was not modified since its last export is not even read.
+    """
+
+    def __init__(self, directory: str, max_workers: Optional[int] = None):
+        """
+        :param directory: The directory the exports are written to.
+        :param max_workers: (Optional) The number of worker processes. Defaults to the number of cores.
+        """
+        self.directory = directory
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self._executor: Optional["ProcessPoolExecutor"] = None
+        self._collectors: List[threading.Thread] = []
+        self._lock = threading.Lock()
+        self._manifest_path = os.path.join(directory, EXPORT_MANIFEST)
+        self._manifest: Optional[Dict[str, Dict]] = None  # Loaded on the first export
+
+    @property
+    def executor(self) -> "ProcessPoolExecutor":
+        """
+        The worker processes. They are started on first use, as fresh interpreters: forking
+        the chat would copy its threads' locks, held by the log writer or an SQLite call.
+        """
+        # Imported on first use as well, most sessions never export
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                     mp_context=multiprocessing.get_context('spawn'))
+            return self._executor
+
+    def _load_manifest(self) -> Dict[str, Dict]:
+        # Called with the lock held. The directory is created here, not when the chat starts
+        if self._manifest is None:
+            os.makedirs(self.directory, exist_ok=True)
+            try:
+                with open(self._manifest_path) as file:
+                    self._manifest = json.load(file)
+            except (OSError, ValueError):
+                self._manifest = {}
+        return self._manifest
+
+    def _update_manifest(self, entries: Dict[str, Dict], save: bool = True):
+        # Written to a temporary file and renamed, so a crash never leaves half a manifest
+        with self._lock:
+            self._load_manifest().update(entries)
+            if not save:
+                return
+            temporary = f"{self._manifest_path}.{os.getpid()}.tmp"
+            try:
+                with open(temporary, 'w', encoding='utf-8') as file:
+                    json.dump(self._manifest, file)
+                os.replace(temporary, self._manifest_path)
+            except OSError:
+                pass  # Everything is rendered once more next time
+
+    def export_all(self, sources: List[Tuple[str, Optional[str]]], formats: Iterable[str] = EXPORT_FORMATS,
+                   on_done: Optional[Callable[[Dict], None]] = None) -> threading.Thread:
+        """
+        Exports many chat logs in the background, spread over all worker processes.
+
+        :param sources: The path and title of every chat log.
+        :param formats: The formats to write.
+        :param on_done: (Optional) Called with how many logs were exported, skipped and failed.
+        :return: The thread that collects the results.
+        """
+        formats = list(formats)
+        sources = list(dict(sources).items())  # A log listed twice is exported once
+        stems = [os.path.splitext(os.path.basename(path))[0] for path, _ in sources]
+        stem_counts = Counter(stems)
+        with self._lock:
+            manifest = self._load_manifest()
+            jobs = []
+            for (path, title), stem in zip(sources, stems):
+                # Logs whose names differ only in the extension (.jsonl and .jsonlz) keep it,
+                # otherwise they would write the same outputs
+                name = stem if stem_counts[stem] == 1 else os.path.basename(path)
+                jobs.append((path, name, title, dict(manifest.get(name, {}))))
+        batches = [jobs[i:i + BATCH_SIZE] for i in range(0, len(jobs), BATCH_SIZE)]
+        futures = [self.executor.submit(export_logs, batch, self.directory, formats) for batch in batches]
+
+        def collect():
+            summary = {"logs": len(jobs), "exported": 0, "skipped": 0, "written": 0, "failed": 0, "errors": []}
+            for batch, future in zip(batches, futures):
+                try:
+                    results = future.result()
+                except Exception as e:  # The worker died
+                    summary["failed"] += len(batch)
+                    summary["errors"].append(f"{type(e).__name__}: {e}")
+                    continue
+                entries = {}
+                for result in results:
+                    if "error" in result:
+                        summary["failed"] += 1
+                        summary["errors"].append(f"{result['name']}: {result['error']}")
+                        continue
+                    summary["skipped" if result["skipped"] else "exported"] += 1
+                    summary["written"] += len(result["written"])
+                    entries[result["name"]] = result["entry"]
+                self._update_manifest(entries, save=False)
+            self._update_manifest({})  # Saved once, it holds an entry for every chat log
+            if on_done is not None:
+                on_done(summary)
+
+        thread = threading.Thread(target=collect, name="export", daemon=True)
+        thread.start()
+        with self._lock:
+            self._collectors = [collector for collector in self._collectors if collector.is_alive()] + [thread]
+        return thread
+
+    def close(self, wait: bool = True):
+        """
+        Shuts the worker processes down, by default after the exports in progress.
+        """
+        with self._lock:
+            executor, self._executor = self._executor, None
+            collectors, self._collectors = self._collectors, []
+        if executor is not None:
+            executor.shutdown(wait=wait)
+        if wait:
+            for collector in collectors:
+                collector.join()  # Records the results in the manifest
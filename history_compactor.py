@@ -0,0 +1,106 @@
+import os
+import time
+import threading
+from typing import List, Dict, Optional
+from chatbot import ChatBot
+
+SUMMARY_PREFIX = "[Summary of the earlier conversation]"
+SUMMARY_PROMPT = "Summarize the conversation above for your own future reference. Keep the facts, decisions, names, numbers, code and open questions that later turns may rely on, drop pleasantries and repetition. If it starts with an earlier summary, merge it in. Write plain, dense notes, no longer than needed."
+
+
+def is_summary(message: Dict[str, str]) -> bool:
+    return message["role"] == "user" and message["content"].startswith(SUMMARY_PREFIX)
+
+
+class HistoryCompactor:
+    """
+    Compacts the chat history instead of letting the oldest turns be dropped: once the
+    history fills a share of its limits, the older turns are summarized by a cheap model in
+    a worker thread while the user keeps chatting, and the summary replaces them in one step.
+    The history limits still apply, so a slow summary never makes the prompt grow unbounded.
+    """
+
+    def __init__(
+        self,
+        bot: ChatBot,
+        model: Optional[str] = None,
+        threshold: float = 0.75,
+        keep_recent: int = 6,
+        max_message_chars: int = 4000,
+        metrics=None
+    ):
+        """
+        :param bot: The chatbot whose history is compacted.
+        :param model: (Optional) The model that writes summaries. Defaults to the
+                      COMPACTION_MODEL environment variable, or gpt-4o-mini.
+        :param threshold: The share of the history's message and token limits after which
+                          it is compacted.
+        :param keep_recent: How many of the newest messages are always kept as they are.
+        :param max_message_chars: How much of each message the summary is based on.
+        :param metrics: (Optional) A PerformanceMetrics to record the summary times in.
+        """
+        self.bot = bot
+        self.model = model or os.getenv('COMPACTION_MODEL', 'gpt-4o-mini')
+        self.threshold = threshold
+        self.keep_recent = keep_recent
+        self.max_message_chars = max_message_chars
+        self.metrics = metrics
+        self.compactions = 0
+
+        self._lock = threading.Lock()
+        self._busy = False
+
+    def needs_compaction(self) -> bool:
+        usage = self.bot.get_budget_usage()
+        return (usage["messages"] > self.threshold * self.bot.max_history_length
+                or usage["history_tokens"] > self.threshold * usage["history_budget"])
+
+    def _select(self, chat_history: List[Dict[str, str]]) -> List[Dict[str, str]]:
+        """
+        Returns the oldest messages to summarize: all but the newest keep_recent, cut so
+        that the kept messages start with a user message.
+        """
+        cut = len(chat_history) - self.keep_recent
+        while cut > 0 and chat_history[cut]["role"] != "user":
+            cut -= 1
+        if cut < 2:
+            return []
+        return chat_history[:cut]
+
+    def update(self):
+        """
+        Starts compacting the history in the background if it has grown past the threshold
+        and no summary is being written already.
+        """
+        if not self.needs_compaction():
+            return
+        with self._lock:
+            if self._busy:
+                return
+            messages = self._select(self.bot.chat_history)
+            if not messages:
+                return
+            self._busy = True
+        threading.Thread(target=self._run, args=(messages,), name="history-compactor", daemon=True).start()
+
+    def _build_messages(self, messages: List[Dict[str, str]]) -> List[Dict[str, str]]:
+        transcript = "\n\n".join(
+            message["content"][:self.max_message_chars] if is_summary(message) else
+            f"{'User' if message['role'] == 'user' else 'Assistant'}: {message['content'][:self.max_message_chars]}"
+            for message in messages
+        )
+        return [{"role": "user", "content": f"{transcript}\n\n{SUMMARY_PROMPT}"}]
+
+    def _run(self, messages: List[Dict[str, str]]):
+        start = time.perf_counter()
+        try:
+            summary = self.bot.complete(self._build_messages(messages), self.model)
+            if summary and self.bot.replace_oldest(messages, f"{SUMMARY_PREFIX}\n\n{summary}"):
+                self.compactions += 1
+        except Exception:
+            pass  # The history is left as it is and compacted again after the next turn
+        finally:
+            if self.metrics is not None:
+                self.metrics.record("compact", time.perf_counter() - start)
+            with self._lock:
+                self._busy = False
@@ -0,0 +1,80 @@
+import queue
+import threading
+from typing import Callable, Optional
+
+
+class InputPipeline:
+    """
+    Reads the user's input on a background thread, so the next prompt can be typed while
+    the previous one is still being answered. Inputs are handed out in the order they were
+    typed, so queued prompts run one after the other, as if they were typed in turn.
+
+    Commands are barriers: after reading one, the thread stops reading until the command
+    has been handled (see done), because commands may read input themselves and may change
+    what the prompts typed after them are sent to.
+    """
+
+    def __init__(
+        self,
+        read: Callable[[], Optional[str]],
+        is_barrier: Callable[[str], bool] = lambda text: text.startswith('/')
+    ):
+        """
+        :param read: Reads one input from the user. Returns None at the end of the input.
+        :param is_barrier: Whether reading has to wait until an input has been handled.
+        """
+        self._read = read
+        self._is_barrier = is_barrier
+        self._queue: "queue.Queue[Optional[str]]" = queue.Queue()
+        self._pending = 0  # Inputs in the queue, without the end of the input
+        self._pending_lock = threading.Lock()
+        self._resume = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="input-pipeline", daemon=True)
+
+    def start(self) -> "InputPipeline":
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while True:
+            try:
+                text = self._read()
+            except (EOFError, OSError, ValueError):  # stdin was closed
+                text = None
+            if text is None:
+                self._queue.put(None)
+                return
+            if not text.strip():
+                continue  # Ignore empty inputs
+            barrier = self._is_barrier(text)
+            if barrier:
+                self._resume.clear()
+            with self._pending_lock:
+                self._pending += 1
+            self._queue.put(text)
+            if barrier:
+                self._resume.wait()
+
+    def get(self) -> Optional[str]:
+        """
+        Returns the next input, waiting for one to be typed if none is queued.
+        Returns None once the input has ended.
+        """
+        text = self._queue.get()
+        if text is not None:
+            with self._pending_lock:
+                self._pending -= 1
+        return text
+
+    def pending(self) -> int:
+        """
+        Returns how many inputs are queued, not counting the end of the input.
+        """
+        with self._pending_lock:
+            return self._pending
+
+    def done(self):
+        """
+        Lets the thread read on after a barrier was handled.
+        """
+        self._resume.set()
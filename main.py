@@ -1,26 +1,48 @@
 import os
 import sys
+import threading
+from datetime import datetime
 from chatbot import ChatBot
-from dotenv import load_dotenv
 from ui import (
     print_welcome,
     print_user_message,
     print_bot_message,
+    print_bot_message_stream,
     print_error,
     print_info,
     print_prompt_save_conversation,
     print_model_list,
     print_help,
     print_model_status,
-    print_cache_chat_logs
+    print_cache_chat_logs,
+    print_budget_usage,
+    print_compare_results,
+    print_cache_stats,
+    print_search_results,
+    print_stats,
+    print_router_status
 )
-from chat_log_manager import ChatLogManager
-from rich.console import Console
-import pyperclip
+from chat_log_manager import ChatLogManager, CHATLOG_PATTERN
+from response_cache import ResponseCache
+from search_index import SearchIndex, MATCH_START, MATCH_END
+from title_generator import TitleGenerator
+from history_compactor import HistoryCompactor
+from request_scheduler import RequestScheduler
+from perf_metrics import PerformanceMetrics
+from model_router import ModelRouter
+from input_pipeline import InputPipeline
+from attachments import AttachmentIndex
+from exporter import Exporter, EXPORT_FORMATS, export_messages
+from tokens import count_tokens
 
-def save_data(chat_history: str, filename: str):
+AVAILABLE_MODELS = ['gpt-4o-mini', 'gpt-4o', 'o1-preview', 'o1-mini']
+
+def save_data(chat_history, filename: str, search_index: SearchIndex = None, formats=('md',)):
     # change to prompt toolkit?
-    """Saves the chat history to a file."""
+    """
+    Saves the chat history in every format, streamed to the files, and adds the Markdown
+    file to the search index.
+    """
     save_path = os.getenv('SAVE_PATH')
     if not save_path:
         print_error("SAVE_PATH environment variable not set.")
@@ -29,15 +51,16 @@ def save_data(chat_history: str, filename: str):
         print_error("SAVE_PATH environment variable is not a valid directory.")
         return
 
-
-    file_path = os.path.join(save_path, f'{filename}.md')
-
     try:
-        with open(file_path, 'w') as file:
-            file.write(chat_history)
-        print_info(f"Chat history saved to {file_path}.")
+        # One conversation at exit: written here, a worker process would take longer to start
+        exported = export_messages(chat_history, save_path, filename, formats, title=filename)
     except Exception as e:
         print_error(f"Failed to save chat history: {e}")
+        return
+    for file_path in exported["written"]:
+        print_info(f"Chat history saved to {file_path}.")
+        if search_index is not None and file_path.endswith('.md'):
+            search_index.index_file(file_path)
 
 def multi_line_input(prompt_text):
     print_user_message(title = 'User')
@@ -47,7 +70,35 @@ def multi_line_input(prompt_text):
     print_user_message()
     return lines.strip()
 
-def handle_command(command_parts, bot,chat_log_manager):
+def read_pipelined_input():
+    # Typed while replies are written, so without prompts of its own; None once stdin is closed
+    lines = sys.stdin.read()
+    if not lines and not sys.stdin.isatty():
+        return None
+    return lines.strip()
+
+def attach_files(bot, attachments, question, max_tokens):
+    """
+    Puts the parts of the attached files that best match the question in front of it.
+    The files share the tokens the history can spare, but take no more than max_tokens.
+    """
+    budget = min(max_tokens, (bot.get_history_token_budget() - count_tokens(question)) // 2)
+    budget //= len(attachments.pending)
+    parts = []
+    for file_path in attachments.pending:
+        try:
+            text, stats = attachments.build_context(file_path, question, budget)
+        except (OSError, ValueError) as e:
+            print_error(f"Could not attach '{file_path}': {e}")
+            continue
+        parts.append(text)
+        print_info(f"Sending {stats['included']} of {stats['chunks']} parts of '{os.path.basename(file_path)}' "
+                   f"({stats['tokens']} tokens).")
+    attachments.pending.clear()
+    return "\n\n".join(parts + [question])
+
+def handle_command(command_parts, bot,chat_log_manager, search_index=None, metrics=None, router=None, attachments=None,
+                   exporter=None):
      command = command_parts[0].lower()
 
      if command in ['/exit', '/quit', '/bye']:
@@ -61,11 +112,40 @@ def handle_command(command_parts, bot,chat_log_manager):
          new_model = command_parts[1]
          bot.set_model(new_model)
          print_info(f"Model has been changed to '{new_model}'.")
+         if bot.router is not None:
+             bot.router = None  # A model chosen by hand is kept
+             print_info("Automatic model selection is off. Type /auto to turn it on again.")
+         return False
+
+     elif command == '/auto':
+         option = command_parts[1].lower() if len(command_parts) > 1 else 'on'
+         if router is None:
+             print_error("Automatic model selection is not available.")
+         elif option == 'on':
+             bot.router = router
+             print_info(f"The model is now chosen for every turn among {', '.join(router.models)}.")
+         elif option == 'off':
+             bot.router = None
+             print_info(f"Automatic model selection is off, '{bot.model}' answers from now on.")
+         elif option == 'status':
+             print_router_status(router.status(), bot.router is not None)
+         else:
+             print_error("Unknown option. Usage: /auto [on|off|status]")
          return False
 
      elif command == '/model_list':
-         available_models = ['gpt-4o-mini', 'gpt-4o', 'o1-preview', 'o1-mini']
-         print_model_list(available_models)
+         print_model_list(AVAILABLE_MODELS)
+         return False
+
+     elif command == '/compare':
+         models = command_parts[1:] or AVAILABLE_MODELS
+         question = multi_line_input(f"Ask your question to {', '.join(models)}.")
+         if not question:
+             return False
+         print_info(f"Asking {len(models)} models...")
+         from async_chatbot import AsyncChatBot, run_sync  # asyncio is only needed here
+         results = run_sync(AsyncChatBot.from_bot(bot).compare(question, models))
+         print_compare_results(results)
          return False
 
      elif command == '/undo':
@@ -73,20 +153,89 @@ def handle_command(command_parts, bot,chat_log_manager):
          print_info("Last interaction has been removed from history.")
          return False
 
+     elif command == '/redo':
+         branches = bot.count_redo_branches()
+         if len(command_parts) > 1:
+             if not command_parts[1].isdigit() or not 1 <= int(command_parts[1]) <= branches:
+                 print_error(f"Please choose an interaction between 1 and {branches}. Usage: /redo [number]")
+                 return False
+             restored = bot.redo_last_interaction(int(command_parts[1]) - 1)
+         else:
+             restored = bot.redo_last_interaction()
+         if restored:
+             others = f" {branches - 1} other removed interactions can be restored with /redo <number>." if branches > 1 else ""
+             print_info("Last removed interaction has been restored." + others)
+         else:
+             print_info("No removed interaction to restore.")
+         return False
+
+     elif command == '/attach':
+         if len(command_parts) < 2:
+             print_error("Please specify the file to attach. Usage: /attach <path>")
+             return False
+         if attachments is None:
+             print_error("Attachments are not available. Set CACHE_PATH to enable them.")
+             return False
+         file_path = os.path.expanduser(" ".join(command_parts[1:]))
+         try:
+             index = attachments.index(file_path)  # Chunked now, so the question is not kept waiting
+         except FileNotFoundError:
+             print_error(f"File '{file_path}' not found. Please check the filename and try again.")
+             return False
+         except (OSError, ValueError) as e:
+             print_error(f"Could not attach '{file_path}': {e}")
+             return False
+         attachments.pending.append(file_path)
+         cached = " (unchanged since it was last attached)" if index.reused == len(index.chunks) else ""
+         print_info(f"'{os.path.basename(file_path)}' is attached to your next question: "
+                    f"{len(index.chunks)} parts, {index.size / 1024 / 1024:.1f} MB{cached}.")
+         return False
+
      elif command == '/copy':
+         import pyperclip  # Loaded on first use, it probes the clipboard backends
          pyperclip.copy(bot.chat_history[-1]['content'])
          print_info("Last interaction has been located on the clipboard")
          return False
 
+     elif command == '/export_all':
+         if exporter is None:
+             print_error("Exporting is not available. Set SAVE_PATH or CACHE_PATH to enable it.")
+             return False
+         formats = [fmt.lower().lstrip('.') for fmt in command_parts[1:]] or EXPORT_FORMATS
+         unknown = [fmt for fmt in formats if fmt not in EXPORT_FORMATS]
+         if unknown:
+             print_error(f"Unknown format '{unknown[0]}'. Available formats: {', '.join(EXPORT_FORMATS)}.")
+             return False
+         chat_log_manager.flush()  # The current conversation is exported as it is now
+         sources = [(os.path.join(chat_log_manager.save_path, entry['name']), entry.get('title'))
+                    for entry in chat_log_manager.get_cached_chatlogs()]
+         if not sources:
+             print_info("There are no cached chat logs to export.")
+             return False
+
+         def exported(summary):
+             print_info(f"Exported {summary['exported']} of {summary['logs']} chat logs to {exporter.directory} "
+                        f"({summary['written']} files written, {summary['skipped']} logs unchanged).")
+             for error in summary['errors'][:5]:
+                 print_error(f"Export failed: {error}")
+         exporter.export_all(sources, formats, on_done=exported)
+         print_info(f"Exporting {len(sources)} chat logs in the background.")
+         return False
+
      elif command == '/history_list':
-         chat_history_list= chat_log_manager.show_cached_chatlog_list()
+         chat_history_list= chat_log_manager.get_cached_chatlogs()
          print_cache_chat_logs(chat_history_list)
          return False
 
      elif command == '/load_history':
          try:
              change_history_filename = input("Enter the filename: ")
-             bot.chat_history = chat_log_manager.load_from_chatlog(change_history_filename)
+             # Only decode as much of the log as the bot can keep
+             bot.chat_history = chat_log_manager.load_from_chatlog(
+                 change_history_filename,
+                 last_n=bot.max_history_length,
+                 max_tokens=bot.get_history_token_budget()
+             )
              print_info(f"Chat history from '{change_history_filename}' has been loaded.")
          except FileNotFoundError:
              print_error(f"File '{change_history_filename}' not found. Please check the filename and try again.")
@@ -97,11 +246,43 @@ def handle_command(command_parts, bot,chat_log_manager):
          return False
 
 
+     elif command == '/search':
+         if len(command_parts) < 2:
+             print_error("Please specify what to search for. Usage: /search <query>")
+             return False
+         if search_index is None:
+             print_error("The search index is not available.")
+             return False
+         results = search_index.search(" ".join(command_parts[1:]))
+         print_search_results(results, MATCH_START, MATCH_END)
+         return False
+
      elif command == '/clear_history':
          bot.clear_history()
          print_info("Conversation history has been cleared.")
          return False
 
+     elif command == '/budget':
+         print_budget_usage(bot.get_budget_usage())
+         return False
+
+     elif command == '/stats':
+         if metrics is None or not metrics.enabled:
+             print_info("Performance metrics are disabled. Unset PERF_METRICS=0 to enable them.")
+         else:
+             print_stats(metrics.summary(), bot.scheduler.get_metrics())
+         return False
+
+     elif command == '/cache':
+         if bot.response_cache is None:
+             print_info("The response cache is disabled. Set RESPONSE_CACHE=1 to enable it.")
+         elif len(command_parts) > 1 and command_parts[1].lower() == 'clear':
+             bot.response_cache.clear()
+             print_info("Response cache has been cleared.")
+         else:
+             print_cache_stats(bot.response_cache.stats())
+         return False
+
      elif command == '/help':
          print_help()
          return False
@@ -113,23 +294,105 @@ def handle_command(command_parts, bot,chat_log_manager):
 
 def main():
     # Load environment variables
+    from dotenv import load_dotenv
     load_dotenv()
-    console = Console()
-    log_handler = ChatLogManager()
+    metrics_enabled = os.getenv('PERF_METRICS', '1').lower() not in ('0', 'false', 'no')
+    metrics = PerformanceMetrics(
+        path=os.path.join(os.getenv('CACHE_PATH'), 'metrics.jsonl') if metrics_enabled and os.getenv('CACHE_PATH') else None,
+        enabled=metrics_enabled
+    )
+    max_cached_mb = os.getenv('CACHE_MAX_MB')
+    max_cached_days = os.getenv('CACHE_MAX_DAYS')
+    log_handler = ChatLogManager(
+        compress=os.getenv('CHATLOG_COMPRESSION', '').lower() in ('1', 'true', 'yes'),
+        metrics=metrics,
+        max_cached_files=int(os.getenv('CACHE_MAX_FILES', '10')),
+        max_cached_bytes=int(float(max_cached_mb) * 1024 * 1024) if max_cached_mb else None,
+        max_cached_age=float(max_cached_days) * 86400 if max_cached_days else None
+    )
+
+    # Keep the search index up to date: chat logs as they are saved, other files in the background
+    search_index = SearchIndex()
+    log_handler.add_save_listener(search_index.update_source)
+    index_patterns = [os.path.join(log_handler.save_path, CHATLOG_PATTERN)]
+    if os.getenv('SAVE_PATH'):
+        index_patterns.append(os.path.join(os.getenv('SAVE_PATH'), '*.md'))
+    threading.Thread(target=search_index.sync, args=(index_patterns,), daemon=True).start()
 
     # Initialize the chatbot (API key is fetched from the environment variable)
     try:
-        bot = ChatBot(api_key=os.getenv('OPENAI_API_KEY'))
+        response_cache = None
+        if os.getenv('RESPONSE_CACHE', '').lower() in ('1', 'true', 'yes'):
+            response_cache = ResponseCache()
+        hedge_percentile = os.getenv('REQUEST_HEDGE_PERCENTILE')
+        scheduler = RequestScheduler(hedge_percentile=float(hedge_percentile) if hedge_percentile else None)
+        bot = ChatBot(
+            api_key=os.getenv('OPENAI_API_KEY'),
+            response_cache=response_cache,
+            scheduler=scheduler,
+            history_trim_target=float(os.getenv('HISTORY_TRIM_TARGET', '0.75'))
+        )
     except ValueError as ve:
         print_error(str(ve))
         return
 
+    # The model of every turn can be chosen by prompt size, observed latency and cost
+    router_models = [model.strip() for model in os.getenv('ROUTER_MODELS', 'gpt-4o,gpt-4o-mini').split(',') if model.strip()]
+    router = None
+    if router_models:
+        router = ModelRouter(
+            models=router_models,
+            latency_target=float(os.getenv('ROUTER_LATENCY_TARGET')) if os.getenv('ROUTER_LATENCY_TARGET') else None,
+            cost_target=float(os.getenv('ROUTER_COST_TARGET')) if os.getenv('ROUTER_COST_TARGET') else None,
+            log_path=os.path.join(os.getenv('CACHE_PATH'), 'routing.jsonl') if os.getenv('CACHE_PATH') else None,
+            reply_reserve=bot.reply_reserve
+        )
+    if router is not None and os.getenv('MODEL_ROUTING', '').lower() in ('1', 'true', 'yes'):
+        bot.router = router
+
+    # Titles are generated in the background after every turn, so exiting does not wait for one
+    title_generator = TitleGenerator(bot)
+    # Relevant messages of earlier conversations are recalled into the requests
+    if os.getenv('SEMANTIC_MEMORY', '').lower() in ('1', 'true', 'yes'):
+        from semantic_memory import SemanticMemory  # Needs numpy
+        bot.memory = SemanticMemory()
+        log_handler.add_save_listener(bot.memory.update_source)
+        threading.Thread(target=bot.memory.sync, args=(index_patterns[:1],), daemon=True).start()
+    # Old turns are summarized in the background instead of being dropped from the history
+    compactor = None
+    if os.getenv('HISTORY_COMPACTION', '').lower() in ('1', 'true', 'yes'):
+        compactor = HistoryCompactor(bot, metrics=metrics)
+
     # Welcome message and commands
     print_welcome()
 
+    # Files attached with /attach are chunked and cached in CACHE_PATH
+    attachments = AttachmentIndex() if os.getenv('CACHE_PATH') else None
+    attach_max_tokens = int(os.getenv('ATTACH_MAX_TOKENS', '8000'))
+
+    # /export_all renders the cached chat logs in worker processes, next to the saved conversations
+    export_formats = [fmt.strip() for fmt in os.getenv('EXPORT_FORMATS', 'md').split(',') if fmt.strip() in EXPORT_FORMATS]
+    export_path = os.getenv('EXPORT_PATH')
+    if not export_path and (os.getenv('SAVE_PATH') or os.getenv('CACHE_PATH')):
+        export_path = os.path.join(os.getenv('SAVE_PATH') or os.getenv('CACHE_PATH'), 'exports')
+    exporter = Exporter(export_path) if export_path else None
+
+    # The next prompts can be typed while a reply is being written
+    pipeline = None
+    if os.getenv('PIPELINED_INPUT', '').lower() in ('1', 'true', 'yes'):
+        pipeline = InputPipeline(read_pipelined_input).start()
+        print_info("Type your prompts at any time (Ctrl+D to submit each one), they are answered in order.")
+
     while True:
-        print_model_status(bot.model)
-        user_input = multi_line_input("Ask your question.")
+        print_model_status(bot.model if bot.router is None else f"auto (last: {bot.model})")
+        if pipeline is None:
+            user_input = multi_line_input("Ask your question.")
+        else:
+            user_input = pipeline.get()
+            if user_input is None:
+                break  # The input has ended
+            if pipeline.pending():
+                print_info(f"{pipeline.pending()} more prompts are queued.")
 
         if not user_input.strip():
             continue  # Ignore empty inputs
@@ -137,27 +400,70 @@ def main():
         # Check for commands (prefix with '/')
         if user_input.startswith('/'):
             command_parts = user_input.split()
-            exit_signal = handle_command(command_parts, bot,log_handler)
+            exit_signal = handle_command(command_parts, bot,log_handler, search_index, metrics, router, attachments,
+                                         exporter)
             if exit_signal:
                 break
+            if pipeline is not None:
+                pipeline.done()  # Commands may read input themselves, so reading waits for them
 
         # Regular user message
         else:
-            with console.status("[bold green]Working on tasks...") as status:
-                response = bot.send_message(user_input)
-            print_bot_message(response)
-            log_handler.save_chatlog(bot.chat_history)
+            turn = metrics.start_turn(bot.model)
+            if attachments is not None and attachments.pending:
+                with turn.stage('attach'):
+                    user_input = attach_files(bot, attachments, user_input, attach_max_tokens)
+            chunks = turn.timed_stream(bot.stream_message(user_input))
+            try:
+                with turn.stage('respond'):
+                    print_bot_message_stream(chunks)
+            except KeyboardInterrupt:
+                # Ctrl+C cancels only the reply: what arrived of it is kept like a cut-off stream
+                print_info("The reply has been cancelled.")
+            finally:
+                chunks.close()  # Closes the connection now, not when the stream is garbage collected
+            with turn.stage('save'):
+                log_handler.save_chatlog(bot.chat_history)
+            title = title_generator.get_title(timeout=0)  # Of an earlier turn, the newest is still being written
+            if title:
+                log_handler.set_title(title)
+            title_generator.update(bot.chat_history)
+            if compactor is not None:
+                compactor.update()
+            metrics.end_turn(turn, bot.last_usage, model=bot.model)  # The router may have picked another one
 
+    if compactor is not None and compactor.compactions:
+        log_handler.save_chatlog(bot.chat_history)  # The last summary may have arrived after the last save
+    log_handler.flush()
 
     # Optionally, save the conversation history
     try:
-        summary_prompt = "Think deeply about the conversation and give it an appropriate title. The title should be short and concise, replace the spaces with '_'. Don't wirte as markdown format."
-        summary = bot.send_message(summary_prompt)
+        if not bot.chat_history:
+            return
+        summary = title_generator.get_title()
+        if not summary:
+            title_generator.update(bot.chat_history)  # The last attempt failed, try once more
+            summary = title_generator.get_title()
+        if not summary:
+            summary = datetime.now().strftime("conversation_%Y-%m-%d_%H-%M")
+        else:
+            log_handler.set_title(summary)
         if print_prompt_save_conversation(summary).lower()=='yes':
-            save_data(bot.get_history(), summary)
+            save_data(bot.chat_history, summary, search_index, export_formats or ['md'])
     except Exception as e:
         print_error(f"An error occurred while summarizing: {e}")
+    finally:
+        if exporter is not None:
+            exporter.close()  # Bulk exports still running are finished before the chat exits
 
 if __name__ == "__main__":
+    # "main.py batch in.jsonl out.jsonl" runs a file of prompts instead of the interactive chat
+    if sys.argv[1:2] == ['batch']:
+        from batch import main as batch_main
+        sys.exit(batch_main(sys.argv[2:]))
+    # "main.py serve" hosts many chat sessions over HTTP instead
+    if sys.argv[1:2] == ['serve']:
+        from chat_server import main as serve_main
+        sys.exit(serve_main(sys.argv[2:]))
     main()
 
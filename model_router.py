@@ -0,0 +1,275 @@
+import json
+import time
+import threading
+from collections import deque
+from typing import Dict, List, Optional
+from perf_metrics import percentile
+from tokens import get_context_window
+
+# USD per million prompt and completion tokens, matched by the longest prefix of the model name
+MODEL_PRICES = {
+    'gpt-4o-mini': (0.15, 0.60),
+    'gpt-4o': (2.50, 10.00),
+    'o1-preview': (15.00, 60.00),
+    'o1-mini': (3.00, 12.00),
+}
+DEFAULT_REPLY_TOKENS = 500  # Expected reply length of a model that has not answered yet
+CANCELLED = 'cancelled'  # The error of a turn the user cancelled
+
+
+def get_price(model: str) -> Optional[tuple]:
+    """
+    Returns the prompt and completion price of the model, or None for unknown models.
+    """
+    model = model.lower()
+    matches = [prefix for prefix in MODEL_PRICES if model.startswith(prefix)]
+    if not matches:
+        return None
+    return MODEL_PRICES[max(matches, key=len)]
+
+
+class ModelStats:
+    """
+    What the router has observed of one model: moving averages of the time to the first
+    token, the generation speed and the reply length, and the recent first-token times
+    to notice tail latency spikes.
+    """
+    __slots__ = ("ttft", "tokens_per_second", "reply_tokens", "turns", "baseline", "recent", "degraded_until",
+                 "probing", "updated")
+
+    def __init__(self, tail_window: int):
+        self.ttft: Optional[float] = None
+        self.tokens_per_second: Optional[float] = None
+        self.reply_tokens: Optional[float] = None
+        self.turns = 0
+        self.baseline = deque(maxlen=50)  # First-token times to compare the recent ones against
+        self.recent = deque(maxlen=tail_window)
+        self.degraded_until = 0.0  # Monotonic time until which the model is avoided
+        self.probing = False  # The next turn is the first after a cooldown
+        self.updated: Optional[float] = None  # Monotonic time of the last turn
+
+
+def _ewma(average: Optional[float], sample: float, alpha: float) -> float:
+    return sample if average is None else average + alpha * (sample - average)
+
+
+class ModelRouter:
+    """
+    Picks the model of every turn. Models are listed best first, and a turn goes to the
+    first one whose context window fits the prompt, whose estimated latency and cost meet
+    the targets and whose tail latency has not spiked. If none does, the turn goes to the
+    fitting model that comes closest to the targets.
+
+    Latency is estimated from moving averages of what the model did in earlier turns. A model
+    that has not answered yet, or not for stale_after seconds, is assumed to meet the latency
+    target until it has, so a model that was too slow once is tried again later.
+    When the 90th percentile of a model's recent first-token times exceeds spike_factor
+    times its usual one, it is avoided for cooldown seconds. The first turn after that
+    probes it: if that one is still that slow, the model is avoided for another cooldown.
+
+    Every decision is appended to a JSONL log together with its outcome, with the estimates
+    of all models, so other policies can be evaluated against the log offline.
+    """
+
+    def __init__(
+        self,
+        models: List[str],
+        latency_target: Optional[float] = None,
+        cost_target: Optional[float] = None,
+        log_path: Optional[str] = None,
+        reply_reserve: int = 0,
+        alpha: float = 0.3,
+        tail_window: int = 10,
+        spike_factor: float = 3.0,
+        min_samples: int = 5,
+        cooldown: float = 60.0,
+        stale_after: float = 600.0
+    ):
+        """
+        :param models: The models to choose from, best first.
+        :param latency_target: (Optional) Seconds a whole reply should take at most.
+        :param cost_target: (Optional) USD a turn should cost at most.
+        :param log_path: (Optional) The JSONL file every decision and its outcome is appended to.
+        :param reply_reserve: Tokens of the context window that must stay free for the reply.
+        :param alpha: The weight of the newest sample in the moving averages.
+        :param tail_window: How many recent turns of a model its tail latency is taken over.
+        :param spike_factor: How many times its usual first-token time the tail of a model may take.
+        :param min_samples: How many turns a model needs before its tail is judged.
+        :param cooldown: Seconds a model whose tail latency spiked is avoided.
+        :param stale_after: Seconds after which the latency estimate of an unused model is dropped.
+        """
+        if not models:
+            raise ValueError("At least one model must be given to route between.")
+        self.models = list(models)
+        self.latency_target = latency_target
+        self.cost_target = cost_target
+        self.log_path = log_path
+        self.reply_reserve = reply_reserve
+        self.alpha = alpha
+        self.spike_factor = spike_factor
+        self.min_samples = min_samples
+        self.cooldown = cooldown
+        self.stale_after = stale_after
+        self._stats = {model: ModelStats(tail_window) for model in self.models}
+        self._lock = threading.Lock()
+
+    def _estimate(self, model: str, prompt_tokens: int, now: float) -> Dict:
+        stats = self._stats[model]
+        reply_tokens = stats.reply_tokens if stats.reply_tokens is not None else DEFAULT_REPLY_TOKENS
+        latency = None
+        fresh = stats.updated is not None and now - stats.updated < self.stale_after
+        if fresh and stats.ttft is not None and stats.tokens_per_second:
+            latency = stats.ttft + reply_tokens / stats.tokens_per_second
+        price = get_price(model)
+        cost = (prompt_tokens * price[0] + reply_tokens * price[1]) / 1e6 if price else None
+        return {
+            "latency": latency,
+            "cost": cost,
+            "fits": prompt_tokens + self.reply_reserve <= get_context_window(model),
+            "degraded": stats.degraded_until > now,
+        }
+
+    def _rejection(self, estimate: Dict) -> Optional[str]:
+        """
+        Returns why a model cannot take the turn, or None if it can.
+        """
+        if not estimate["fits"]:
+            return "context window"
+        if estimate["degraded"]:
+            return "tail latency"
+        if self.latency_target is not None and estimate["latency"] is not None \
+                and estimate["latency"] > self.latency_target:
+            return "latency target"
+        if self.cost_target is not None and estimate["cost"] is not None and estimate["cost"] > self.cost_target:
+            return "cost target"
+        return None
+
+    def route(self, prompt_tokens: int) -> Dict:
+        """
+        Picks the model for a prompt.
+
+        :param prompt_tokens: The estimated token count of the request.
+        :return: The decision: the model, why it was picked and the estimates of all models.
+                 Pass it to record once the turn is over.
+        """
+        now = time.monotonic()
+        with self._lock:
+            estimates = {model: self._estimate(model, prompt_tokens, now) for model in self.models}
+        rejections = {model: self._rejection(estimate) for model, estimate in estimates.items()}
+        model = next((model for model in self.models if rejections[model] is None), None)
+        if model == self.models[0]:
+            reason = "preferred"
+        elif model is not None:
+            reason = f"{self.models[0]}: {rejections[self.models[0]]}"
+        else:
+            fitting = [model for model in self.models if estimates[model]["fits"]]
+            if not fitting:
+                model = max(self.models, key=get_context_window)
+                reason = "no model fits the prompt"
+            else:
+                # Models whose tail latency spiked only if all of them did
+                healthy = [model for model in fitting if not estimates[model]["degraded"]] or fitting
+                metric = "latency" if self.latency_target is not None else "cost"
+                known = [model for model in healthy if estimates[model][metric] is not None]
+                model = min(known, key=lambda m: estimates[m][metric]) if known else healthy[0]
+                reason = f"no model meets the targets, lowest {metric}"
+        return {
+            "time": time.time(),
+            "prompt_tokens": prompt_tokens,
+            "model": model,
+            "reason": reason,
+            "targets": {"latency": self.latency_target, "cost": self.cost_target},
+            "estimates": estimates,
+        }
+
+    def record(
+        self,
+        decision: Dict,
+        ttft: Optional[float],
+        latency: float,
+        usage: Optional[Dict[str, int]] = None,
+        error: Optional[str] = None
+    ):
+        """
+        Learns from the outcome of a routed turn and logs the decision with it.
+
+        :param decision: The decision returned by route.
+        :param ttft: Seconds to the first token, or None if the reply was not streamed.
+        :param latency: Seconds the whole request took.
+        :param usage: (Optional) The token usage the API reported.
+        :param error: (Optional) Why the request failed, if it did, or CANCELLED. A cancelled
+                      turn only counts with the first token, if that arrived before.
+        """
+        model = decision["model"]
+        completion_tokens = (usage or {}).get("completion_tokens")
+        tokens_per_second = None
+        if completion_tokens and ttft is not None and latency > ttft:
+            tokens_per_second = completion_tokens / (latency - ttft)
+        with self._lock:
+            stats = self._stats.get(model)
+            if stats is not None:
+                stats.turns += 1
+                stats.updated = time.monotonic()
+                # A failed request says nothing about speed, but a slow failure is still a slow model
+                first = ttft if ttft is not None else latency
+                if error == CANCELLED:
+                    # The reply was cut short by the user, so only its first token is a sample
+                    if ttft is not None:
+                        stats.ttft = _ewma(stats.ttft, ttft, self.alpha)
+                        self._check_tail(stats, ttft)
+                else:
+                    if error is None:
+                        stats.ttft = _ewma(stats.ttft, first, self.alpha)
+                        if tokens_per_second:
+                            stats.tokens_per_second = _ewma(stats.tokens_per_second, tokens_per_second, self.alpha)
+                        if completion_tokens:
+                            stats.reply_tokens = _ewma(stats.reply_tokens, completion_tokens, self.alpha)
+                    self._check_tail(stats, first)
+            record = dict(decision, outcome={
+                "ttft": ttft,
+                "latency": latency,
+                "prompt_tokens": (usage or {}).get("prompt_tokens"),
+                "completion_tokens": completion_tokens,
+                "tokens_per_second": tokens_per_second,
+                "error": error,
+            })
+            if self.log_path:
+                try:
+                    with open(self.log_path, 'a') as file:
+                        file.write(json.dumps(record) + "\n")
+                except OSError:
+                    pass  # Logging must never break the chat
+
+    def _check_tail(self, stats: ModelStats, first: float):
+        if len(stats.baseline) >= self.min_samples:
+            usual = percentile(list(stats.baseline), 0.5)
+            if stats.probing:
+                stats.probing = False
+                tail = first
+            else:
+                stats.recent.append(first)
+                # A single slow turn is not a spike, so the tail is only judged over a full window
+                tail = percentile(list(stats.recent), 0.9) if len(stats.recent) == stats.recent.maxlen else 0.0
+            if tail > self.spike_factor * usual:
+                stats.degraded_until = time.monotonic() + self.cooldown
+                stats.probing = True
+                stats.recent.clear()  # The spike is judged on fresh samples from now on
+                return
+        stats.baseline.append(first)
+
+    def status(self) -> Dict[str, Dict]:
+        """
+        Returns what the router currently knows of each model.
+        """
+        now = time.monotonic()
+        with self._lock:
+            return {
+                model: {
+                    "turns": stats.turns,
+                    "ttft": stats.ttft,
+                    "tokens_per_second": stats.tokens_per_second,
+                    "reply_tokens": stats.reply_tokens,
+                    "degraded_for": max(stats.degraded_until - now, 0.0),
+                }
+                for model, stats in self._stats.items()
+            }
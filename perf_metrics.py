@@ -0,0 +1,208 @@
+import json
+import math
+import time
+import threading
+from typing import Dict, Iterable, Iterator, List, Optional
+
+perf_counter = time.perf_counter
+
+
+def percentile(samples: List[float], fraction: float) -> float:
+    """
+    Returns the nearest-rank percentile of samples, e.g. fraction=0.95 for p95.
+    """
+    ordered = sorted(samples)
+    index = min(max(math.ceil(fraction * len(ordered)) - 1, 0), len(ordered) - 1)
+    return ordered[index]
+
+
+class _Stage:
+    __slots__ = ("turn", "name", "start")
+
+    def __init__(self, turn, name: str):
+        self.turn = turn
+        self.name = name
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.turn.add(self.name, perf_counter() - self.start)
+        return False
+
+
+class _NullStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class Turn:
+    """
+    Timings of one user turn. Stages are timed with monotonic clocks and add up if a
+    stage runs more than once.
+    """
+
+    def __init__(self, model: str):
+        self.model = model
+        self.start = perf_counter()
+        self.stages: Dict[str, float] = {}
+        self.first_token: Optional[float] = None  # Seconds from the request to the first chunk
+
+    def stage(self, name: str) -> _Stage:
+        return _Stage(self, name)
+
+    def add(self, name: str, seconds: float):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def timed_stream(self, chunks: Iterable[str]) -> Iterator[str]:
+        """
+        Passes a response stream through, timing the waits on the API as the 'api' stage
+        and recording the time to the first token.
+        """
+        iterator = iter(chunks)
+        start = perf_counter()
+        waited = 0.0
+        try:
+            while True:
+                wait_start = perf_counter()
+                try:
+                    chunk = next(iterator)
+                except StopIteration:
+                    waited += perf_counter() - wait_start
+                    return
+                waited += perf_counter() - wait_start
+                if self.first_token is None:
+                    self.first_token = perf_counter() - start
+                yield chunk
+        finally:
+            self.add("api", waited)
+            close = getattr(iterator, "close", None)
+            if close is not None:
+                close()
+
+
+class _NullTurn:
+    __slots__ = ()
+
+    def stage(self, name: str) -> _NullStage:
+        return _NULL_STAGE
+
+    def add(self, name: str, seconds: float):
+        pass
+
+    def timed_stream(self, chunks: Iterable[str]) -> Iterable[str]:
+        return chunks
+
+
+_NULL_TURN = _NullTurn()
+
+
+class PerformanceMetrics:
+    """
+    Collects per-turn timings and token counts for the session and appends every turn to
+    a metrics JSONL file. When disabled, turns and stages are shared no-op objects.
+    """
+
+    def __init__(self, path: Optional[str] = None, enabled: bool = True):
+        """
+        :param path: (Optional) The JSONL file every turn is appended to.
+        :param enabled: Whether to collect anything at all.
+        """
+        self.path = path
+        self.enabled = enabled
+        self.turns: List[Dict] = []
+        self.background: Dict[str, List[float]] = {}  # Stages that run outside of turns
+        self._lock = threading.Lock()
+
+    def start_turn(self, model: str):
+        if not self.enabled:
+            return _NULL_TURN
+        return Turn(model)
+
+    def end_turn(self, turn, usage: Optional[Dict[str, int]] = None, model: Optional[str] = None):
+        """
+        Records a finished turn.
+
+        :param turn: The turn returned by start_turn.
+        :param usage: (Optional) The token usage the API reported for the turn.
+        :param model: (Optional) The model that answered, if it was only chosen during the turn.
+        """
+        if not self.enabled:
+            return
+        stages = dict(turn.stages)
+        if "respond" in stages:
+            # Rendering is what the response stage spent not waiting on the API
+            stages["render"] = max(stages.pop("respond") - stages.get("api", 0.0), 0.0)
+        record = {
+            "time": time.time(),
+            "model": model or turn.model,
+            "ttft": turn.first_token,
+            "latency": stages.get("api"),
+            "stages": stages,
+        }
+        if usage:
+            record["prompt_tokens"] = usage.get("prompt_tokens")
+            record["completion_tokens"] = usage.get("completion_tokens")
+            record["cached_tokens"] = usage.get("cached_tokens")
+            generation = (record["latency"] or 0.0) - (turn.first_token or 0.0)
+            if usage.get("completion_tokens") and generation > 0:
+                record["tokens_per_second"] = usage["completion_tokens"] / generation
+        with self._lock:
+            self.turns.append(record)
+        if self.path:
+            try:
+                with open(self.path, 'a') as file:
+                    file.write(json.dumps(record) + "\n")
+            except OSError:
+                pass  # Metrics must never break the chat
+
+    def record(self, stage: str, seconds: float):
+        """
+        Records a stage that ran outside of a turn, e.g. on a background thread.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self.background.setdefault(stage, []).append(seconds)
+
+    def summary(self) -> Dict[str, Dict[str, Dict[str, float]]]:
+        """
+        Returns p50/p95/p99 of the session's timings, per model and per stage.
+        """
+        with self._lock:
+            turns = list(self.turns)
+            background = {stage: list(samples) for stage, samples in self.background.items()}
+
+        def describe(samples):
+            samples = [sample for sample in samples if sample is not None]
+            if not samples:
+                return None
+            return {"count": len(samples), "p50": percentile(samples, 0.5),
+                    "p95": percentile(samples, 0.95), "p99": percentile(samples, 0.99)}
+
+        models = {}
+        for model in sorted({turn["model"] for turn in turns}):
+            model_turns = [turn for turn in turns if turn["model"] == model]
+            models[model] = {
+                metric: describe([turn.get(metric) for turn in model_turns])
+                for metric in ("ttft", "latency", "tokens_per_second", "prompt_tokens", "completion_tokens")
+            }
+            # The share of the prompt tokens the provider served from its prompt prefix cache
+            prompt_tokens = sum(turn.get("prompt_tokens") or 0 for turn in model_turns)
+            cached_tokens = sum(turn.get("cached_tokens") or 0 for turn in model_turns)
+            models[model]["cache_hit_rate"] = cached_tokens / prompt_tokens if prompt_tokens else None
+
+        stages = background
+        for turn in turns:
+            for stage, seconds in turn["stages"].items():
+                stages.setdefault(stage, []).append(seconds)
+        return {"models": models, "stages": {stage: describe(samples) for stage, samples in stages.items()}}
@@ -0,0 +1,267 @@
+import re
+import time
+import random
+import threading
+from collections import deque
+from typing import Callable, Dict, Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from concurrent.futures import ThreadPoolExecutor
+
+# Durations in rate limit headers look like "1s", "6m0s", "20ms" or "1h2m3.5s"
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_duration(value: str) -> Optional[float]:
+    """
+    Parses a rate limit reset duration into seconds.
+    """
+    parts = _DURATION_PART.findall(value or "")
+    if not parts:
+        return None
+    return sum(float(number) * _DURATION_UNITS[unit] for number, unit in parts)
+
+
+class TokenBucket:
+    """
+    A token bucket whose level and refill rate are taken from the rate limit headers of
+    the last response: the bucket holds what is remaining and refills to the limit by the
+    time the limit resets. Until the first response it lets everything through.
+    """
+
+    def __init__(self):
+        self.capacity: Optional[float] = None
+        self.level = 0.0
+        self.rate = 0.0  # Units refilled per second
+        self._updated = time.monotonic()
+
+    def update(self, limit: Optional[str], remaining: Optional[str], reset: Optional[str]):
+        try:
+            limit, remaining = float(limit), float(remaining)
+        except (TypeError, ValueError):
+            return
+        reset_seconds = parse_duration(reset)
+        self.capacity = limit
+        self.level = remaining
+        self.rate = (limit - remaining) / reset_seconds if reset_seconds else limit
+        self._updated = time.monotonic()
+
+    def reserve(self, amount: float) -> float:
+        """
+        Takes amount out of the bucket and returns how many seconds to wait before it is there.
+        """
+        if self.capacity is None:
+            return 0.0
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+        amount = min(amount, self.capacity)  # A request bigger than the bucket can only wait for a full one
+        self.level -= amount
+        if self.level >= 0:
+            return 0.0
+        return -self.level / self.rate if self.rate else 0.0
+
+
+class RequestScheduler:
+    """
+    Runs API requests with client-side rate limiting, retries with jittered exponential
+    backoff, a per-request timeout and, optionally, hedging: when a request takes longer
+    than a percentile of recent latencies, a duplicate is sent and the first answer wins.
+    """
+
+    def __init__(
+        self,
+        max_retries: int = 4,
+        base_delay: float = 0.5,
+        max_delay: float = 20.0,
+        timeout: float = 60.0,
+        hedge_percentile: Optional[float] = None,
+        hedge_min_samples: int = 20
+    ):
+        """
+        :param max_retries: How many times a failed request is retried.
+        :param base_delay: The backoff before the first retry, doubled for every further one.
+        :param max_delay: The longest backoff between retries.
+        :param timeout: The number of seconds a single attempt may take.
+        :param hedge_percentile: (Optional) The latency percentile, e.g. 0.95, after which a
+                                 duplicate request is sent. Hedging is off by default.
+        :param hedge_min_samples: How many latencies to observe before hedging starts.
+        """
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+
+        self.metrics: Dict[str, int] = {
+            "requests": 0,
+            "retries": 0,
+            "failures": 0,
+            "rate_limit_waits": 0,
+            "hedges": 0,
+            "hedge_wins": 0,
+        }
+        self._latencies = deque(maxlen=200)
+        self._requests = TokenBucket()
+        self._tokens = TokenBucket()
+        self._lock = threading.Lock()
+        self._executor: Optional["ThreadPoolExecutor"] = None
+
+    def get_metrics(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.metrics)
+
+    def _count(self, metric: str):
+        with self._lock:
+            self.metrics[metric] += 1
+
+    def _update_limits(self, headers):
+        if headers is None:
+            return
+        with self._lock:
+            self._requests.update(headers.get("x-ratelimit-limit-requests"),
+                                  headers.get("x-ratelimit-remaining-requests"),
+                                  headers.get("x-ratelimit-reset-requests"))
+            self._tokens.update(headers.get("x-ratelimit-limit-tokens"),
+                                headers.get("x-ratelimit-remaining-tokens"),
+                                headers.get("x-ratelimit-reset-tokens"))
+
+    def _wait_for_capacity(self, estimated_tokens: int):
+        with self._lock:
+            delay = max(self._requests.reserve(1), self._tokens.reserve(estimated_tokens))
+        if delay > 0:
+            self._count("rate_limit_waits")
+            time.sleep(delay)
+
+    def _hedge_after(self) -> Optional[float]:
+        if self.hedge_percentile is None:
+            return None
+        with self._lock:
+            if len(self._latencies) < self.hedge_min_samples:
+                return None
+            latencies = sorted(self._latencies)
+        return latencies[min(int(len(latencies) * self.hedge_percentile), len(latencies) - 1)]
+
+    def _backoff(self, attempt: int, error) -> float:
+        # Honour the server's Retry-After when it sends one
+        response = getattr(error, "response", None)
+        if response is not None:
+            retry_after = response.headers.get("retry-after-ms")
+            if retry_after:
+                return float(retry_after) / 1000
+            retry_after = response.headers.get("retry-after")
+            if retry_after:
+                try:
+                    return float(retry_after)
+                except ValueError:
+                    pass
+        # Full jitter: anywhere between no wait and the exponential backoff
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def _attempt(self, request: Callable, record_latency: bool):
+        start = time.monotonic()
+        raw = request(self.timeout)
+        self._update_limits(raw.headers)
+        result = raw.parse()
+        if record_latency:
+            with self._lock:
+                self._latencies.append(time.monotonic() - start)
+        return result
+
+    def _hedged_attempt(self, request: Callable, hedge_after: float):
+        # Imported on first use: hedging is opt-in (hedge_percentile), and they slow down the start
+        from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="hedge")
+        primary = self._executor.submit(self._attempt, request, True)
+        done, _ = wait([primary], timeout=hedge_after)
+        if done:
+            return primary.result()
+
+        self._count("hedges")
+        hedge = self._executor.submit(self._attempt, request, True)
+        pending = {primary, hedge}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is hedge:
+                        self._count("hedge_wins")
+                    return future.result()  # The slower request finishes in the background
+                error = future.exception()
+        raise error
+
+    def call(self, request: Callable, estimated_tokens: int = 0, hedge: bool = True):
+        """
+        Runs a request, retrying it when it is rate limited, times out or fails on the server.
+
+        :param request: A function taking the timeout in seconds and returning the raw API
+                        response, e.g. a call to client.chat.completions.with_raw_response.create.
+        :param estimated_tokens: The tokens the request will use, for the token rate limit.
+        :param hedge: Whether the request may be hedged. Streaming requests should not be.
+        :return: The parsed response.
+        """
+        import openai
+
+        retryable = (openai.RateLimitError, openai.APITimeoutError,
+                     openai.APIConnectionError, openai.InternalServerError)
+        self._count("requests")
+        for attempt in range(self.max_retries + 1):
+            self._wait_for_capacity(estimated_tokens)
+            hedge_after = self._hedge_after() if hedge else None
+            try:
+                if hedge_after is None:
+                    return self._attempt(request, hedge)
+                return self._hedged_attempt(request, hedge_after)
+            except retryable as e:
+                response = getattr(e, "response", None)
+                self._update_limits(response.headers if response is not None else None)
+                if attempt == self.max_retries:
+                    self._count("failures")
+                    raise
+                self._count("retries")
+                time.sleep(self._backoff(attempt, e))
+            except Exception:
+                self._count("failures")
+                raise
+
+    async def call_async(self, request: Callable, estimated_tokens: int = 0):
+        """
+        Runs a request on an asyncio loop, with the same rate limiting and retries as call.
+        Async requests are not hedged.
+
+        :param request: A function taking the timeout in seconds and returning an awaitable
+                        of the raw API response, whose headers update the rate limits.
+        :param estimated_tokens: The tokens the request will use, for the token rate limit.
+        :return: The raw response.
+        """
+        import asyncio
+        import openai
+
+        retryable = (openai.RateLimitError, openai.APITimeoutError,
+                     openai.APIConnectionError, openai.InternalServerError)
+        self._count("requests")
+        for attempt in range(self.max_retries + 1):
+            with self._lock:
+                delay = max(self._requests.reserve(1), self._tokens.reserve(estimated_tokens))
+            if delay > 0:
+                self._count("rate_limit_waits")
+                await asyncio.sleep(delay)
+            try:
+                response = await request(self.timeout)
+                self._update_limits(getattr(response, "headers", None))
+                return response
+            except retryable as e:
+                response = getattr(e, "response", None)
+                self._update_limits(response.headers if response is not None else None)
+                if attempt == self.max_retries:
+                    self._count("failures")
+                    raise
+                self._count("retries")
+                await asyncio.sleep(self._backoff(attempt, e))
+            except Exception:
+                self._count("failures")
+                raise
@@ -0,0 +1,175 @@
+import os
+import re
+import glob
+import sqlite3
+import threading
+from typing import List, Dict, Optional
+from chatlog_format import read_chatlog
+
+# Markers around the matched terms in snippets, replaced with styling when printed
+MATCH_START = "\x02"
+MATCH_END = "\x03"
+
+# Role headings of saved conversations (exporter.write_markdown), e.g. "**User**: "
+_MARKDOWN_ROLE = re.compile(r"^\*\*(User|Assistant)\*\*: *$", re.MULTILINE)
+_QUERY_TERMS = re.compile(r"\w+", re.UNICODE)
+
+
+def _read_markdown(path: str) -> List[Dict[str, str]]:
+    with open(path, 'r') as file:
+        text = file.read()
+    parts = _MARKDOWN_ROLE.split(text)
+    # parts = [preamble, role, content, role, content, ...]
+    return [{"role": role.lower(), "content": content.strip()}
+            for role, content in zip(parts[1::2], parts[2::2])]
+
+
+def _read_file(path: str) -> List[Dict[str, str]]:
+    if path.endswith('.md'):
+        return _read_markdown(path)
+    return read_chatlog(path)
+
+
+class SearchIndex:
+    """
+    A full-text index (SQLite FTS5) over the messages of cached chat logs and saved conversations.
+    Chat logs are indexed as they are saved; other files are picked up by sync(), which only
+    reindexes files whose size or modification time changed.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        """
+        Opens (or creates) the index database.
+
+        :param path: The database file. Defaults to 'search_index.sqlite3' in CACHE_PATH.
+        """
+        if path is None:
+            cache_dir = os.getenv('CACHE_PATH')
+            if not cache_dir:
+                raise EnvironmentError("CACHE_PATH environment variable not set.")
+            path = os.path.join(cache_dir, 'search_index.sqlite3')
+        self.path = path
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sources ("
+            " path TEXT PRIMARY KEY, size INTEGER, mtime REAL)"
+        )
+        # Messages live in a plain table, so they can be looked up by file, and the FTS5 table
+        # indexes their content without storing a second copy
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            " id INTEGER PRIMARY KEY, source TEXT, position INTEGER, role TEXT, content TEXT)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS messages_source ON messages (source, position)")
+        self._conn.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+            " content, content='messages', content_rowid='id')"
+        )
+        self._conn.execute(
+            "CREATE TRIGGER IF NOT EXISTS messages_insert AFTER INSERT ON messages BEGIN"
+            " INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content); END"
+        )
+        self._conn.execute(
+            "CREATE TRIGGER IF NOT EXISTS messages_delete AFTER DELETE ON messages BEGIN"
+            " INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, old.content); END"
+        )
+        self._conn.commit()
+
+    def update_source(self, source: str, messages: List[Dict[str, str]], position: int = 0):
+        """
+        Indexes messages as the content of source from position on, replacing whatever
+        was indexed there before. Suitable as a ChatLogManager save listener.
+
+        :param source: The path of the file the messages are in.
+        :param messages: The messages stored from position on.
+        :param position: The index in the file of the first message.
+        """
+        with self._lock:
+            self._replace(source, messages, position)
+            self._conn.commit()
+
+    def _replace(self, source: str, messages: List[Dict[str, str]], position: int):
+        rows = [(source, position + i, message['role'], message['content'])
+                for i, message in enumerate(messages)]
+        self._conn.execute(
+            "DELETE FROM messages WHERE source = ? AND position >= ?", (source, position)
+        )
+        self._conn.executemany(
+            "INSERT INTO messages (source, position, role, content) VALUES (?, ?, ?, ?)", rows
+        )
+        self._record_source(source)
+
+    def _record_source(self, source: str):
+        try:
+            stat = os.stat(source)
+        except OSError:
+            return
+        self._conn.execute(
+            "INSERT OR REPLACE INTO sources VALUES (?, ?, ?)", (source, stat.st_size, stat.st_mtime)
+        )
+
+    def index_file(self, path: str):
+        """
+        (Re)indexes every message of a chat log (.jsonl, .jsonlz) or saved conversation (.md).
+        """
+        self.update_source(path, _read_file(path))
+
+    def sync(self, patterns: List[str]):
+        """
+        Brings the index up to date with the files on disk: new and changed files are
+        indexed, deleted ones are dropped. Unchanged files are not opened.
+
+        :param patterns: Glob patterns of the files to index.
+        """
+        files = {}
+        for pattern in patterns:
+            for path in glob.glob(pattern):
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files[path] = (stat.st_size, stat.st_mtime)
+
+        with self._lock:
+            known = {path: (size, mtime) for path, size, mtime
+                     in self._conn.execute("SELECT path, size, mtime FROM sources")}
+            for path in known.keys() - files.keys():
+                self._conn.execute("DELETE FROM messages WHERE source = ?", (path,))
+                self._conn.execute("DELETE FROM sources WHERE path = ?", (path,))
+            self._conn.commit()
+
+        changed = [path for path, signature in files.items() if known.get(path) != signature]
+        # Commit in batches: one transaction per file would make a first sync fsync-bound
+        for start in range(0, len(changed), 100):
+            with self._lock:
+                for path in changed[start:start + 100]:
+                    try:
+                        self._replace(path, _read_file(path), 0)
+                    except Exception:
+                        continue  # Unreadable files are retried on the next sync
+                self._conn.commit()
+
+    def search(self, query: str, limit: int = 10) -> List[Dict[str, str]]:
+        """
+        Returns the messages that best match query, best first.
+        Every word of query has to appear in a message for it to match.
+
+        :param query: The words to search for.
+        :param limit: The maximum number of results.
+        :return: The file, role and a snippet of each matching message.
+        """
+        terms = _QUERY_TERMS.findall(query)
+        if not terms:
+            return []
+        match = " ".join('"' + term + '"' for term in terms)
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT messages.source, messages.role, snippet(messages_fts, 0, ?, ?, '…', 16)"
+                " FROM messages_fts JOIN messages ON messages.id = messages_fts.rowid"
+                " WHERE messages_fts MATCH ? ORDER BY messages_fts.rank LIMIT ?",
+                (MATCH_START, MATCH_END, match, limit)
+            ).fetchall()
+        return [{"source": source, "role": role, "snippet": snippet} for source, role, snippet in rows]
@@ -0,0 +1,263 @@
+import os
+import re
+import glob
+import json
+import zlib
+import hashlib
+import threading
+import numpy as np
+from typing import Dict, Iterable, List, Optional
+from chatlog_format import read_chatlog
+from tokens import count_tokens
+
+EMBEDDING_DIM = 128  # A query reads the whole matrix, this keeps 100k messages around 50 MB
+MAX_STORED_CHARS = 2000  # Of a message, as recalled into a request
+
+_WORDS = re.compile(r"\w+", re.UNICODE)
+_STOP_WORDS = frozenset(
+    "the a an and or but if then of to in on at by for with from as is are was were be been it this that "
+    "these those i you he she we they me my your our their what which who how can could would should do "
+    "does did not no so there here have has had will just about into than also".split()
+)
+_VECTOR_BYTES = EMBEDDING_DIM * 4
+_ROW_FIELDS = 3  # Source id, position in the source, offset of the text record
+_ROW_BYTES = _ROW_FIELDS * 8
+
+
+def _features(text: str) -> List[str]:
+    words = [word[:-1] if len(word) > 3 and word.endswith('s') and not word.endswith('ss') else word
+             for word in _WORDS.findall(text.lower()) if word not in _STOP_WORDS]
+    return words + [f"{first} {second}" for first, second in zip(words, words[1:])]
+
+
+def embed(texts: Iterable[str]) -> np.ndarray:
+    """
+    Turns texts into unit vectors with a hashing vectorizer: every word (without a plural s)
+    and pair of adjacent words is hashed to a signed position, and the counts are damped with log1p. It needs no
+    model and no vocabulary, so the vectors of old messages never have to be recomputed.
+    """
+    rows, columns = [], []
+    count = 0
+    for count, text in enumerate(texts, 1):
+        hashes = [zlib.crc32(feature.encode('utf-8')) for feature in _features(text)]
+        rows.extend([count - 1] * len(hashes))
+        columns.extend(hashes)
+    matrix = np.zeros((count, EMBEDDING_DIM), np.float32)
+    if columns:
+        hashes = np.array(columns, dtype=np.uint32)
+        signs = np.where(hashes & 0x80000000, 1.0, -1.0).astype(np.float32)
+        np.add.at(matrix, (np.array(rows), hashes % EMBEDDING_DIM), signs)
+    matrix = np.sign(matrix) * np.log1p(np.abs(matrix))
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return np.divide(matrix, norms, out=np.zeros_like(matrix), where=norms > 0)
+
+
+def _source_id(source: str) -> int:
+    return int.from_bytes(hashlib.blake2b(source.encode('utf-8'), digest_size=8).digest(), 'little') >> 1
+
+
+class SemanticMemory:
+    """
+    A local vector index of the messages of past chat logs, to recall the ones relevant to a
+    new question into the request instead of loading whole conversations.
+
+    The index is three append-only files: the vectors (float32, memory-mapped for queries),
+    a row per vector with its source, position and text offset, and the texts as JSON lines.
+    Rows are written last, so a crash in the middle of an append only loses that append.
+    Chat logs are indexed as they are saved; older ones are picked up by sync().
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        max_results: int = 3,
+        min_score: float = 0.25,
+        max_tokens: int = 1000
+    ):
+        """
+        Opens (or creates) the index.
+
+        :param path: The index directory. Defaults to 'semantic_memory' in CACHE_PATH.
+        :param max_results: How many messages are recalled at most.
+        :param min_score: The lowest cosine similarity a recalled message may have.
+        :param max_tokens: How many tokens the recalled messages may take up in a request.
+        """
+        if path is None:
+            cache_dir = os.getenv('CACHE_PATH')
+            if not cache_dir:
+                raise EnvironmentError("CACHE_PATH environment variable not set.")
+            path = os.path.join(cache_dir, 'semantic_memory')
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.max_results = max_results
+        self.min_score = min_score
+        self.max_tokens = max_tokens
+
+        self._lock = threading.Lock()
+        self._vectors_path = os.path.join(path, 'vectors.f32')
+        self._rows_path = os.path.join(path, 'rows.i64')
+        self._texts_path = os.path.join(path, 'texts.jsonl')
+        self._sources_path = os.path.join(path, 'sources.json')
+        for file_path in (self._vectors_path, self._rows_path, self._texts_path):
+            open(file_path, 'ab').close()
+
+        # Drop a torn append: keep as many vectors as there are complete rows
+        self._count = min(os.path.getsize(self._rows_path) // _ROW_BYTES,
+                          os.path.getsize(self._vectors_path) // _VECTOR_BYTES)
+        for file_path, size in ((self._rows_path, _ROW_BYTES), (self._vectors_path, _VECTOR_BYTES)):
+            with open(file_path, 'r+b') as file:
+                file.truncate(self._count * size)
+        self._vectors = self._rows = None
+        self._mapped = 0
+        self._ends: Dict[int, int] = {}  # Source id -> position after its last indexed message
+        try:
+            with open(self._sources_path) as file:
+                self._sources = json.load(file)  # Synced file -> [size, mtime]
+        except (OSError, ValueError):
+            self._sources = {}
+
+    def __len__(self) -> int:
+        return self._count
+
+    def _map(self):
+        """
+        Maps the files again if rows were appended since they were last mapped.
+        """
+        if self._mapped != self._count:
+            self._vectors = np.memmap(self._vectors_path, np.float32, 'r+', shape=(self._count, EMBEDDING_DIM))
+            self._rows = np.memmap(self._rows_path, np.int64, 'r+', shape=(self._count, _ROW_FIELDS))
+            self._mapped = self._count
+
+    def update_source(self, source: str, messages: List[Dict[str, str]], position: int = 0):
+        """
+        Indexes messages as the content of source from position on, replacing whatever
+        was indexed there before. Suitable as a ChatLogManager save listener.
+
+        :param source: The path of the file the messages are in.
+        :param messages: The messages stored from position on.
+        :param position: The index in the file of the first message.
+        """
+        name = os.path.basename(source)
+        source_id = _source_id(name)
+        kept = [(position + i, message) for i, message in enumerate(messages)
+                if message.get('role') in ('user', 'assistant') and message.get('content', '').strip()]
+        vectors = embed(message['content'] for _, message in kept)
+        with self._lock:
+            # Sources saved to in this process are scanned only when messages are replaced
+            if self._count and position < self._ends.get(source_id, position + 1):
+                self._map()
+                # Replaced messages, e.g. after an undo, can no longer be recalled
+                replaced = np.nonzero((self._rows[:, 0] == source_id) & (self._rows[:, 1] >= position))[0]
+                if replaced.size:
+                    self._vectors[replaced] = 0.0
+                    self._rows[replaced, 1] = -1
+                    self._vectors.flush()
+                    self._rows.flush()
+            self._ends[source_id] = position + len(messages)
+            if not kept:
+                return
+            rows = np.empty((len(kept), _ROW_FIELDS), np.int64)
+            with open(self._texts_path, 'ab') as texts:
+                offset = texts.tell()
+                for row, (index, message) in enumerate(kept):
+                    record = json.dumps({"source": name, "position": index, "role": message['role'],
+                                         "content": message['content'][:MAX_STORED_CHARS]}, ensure_ascii=False)
+                    data = record.encode('utf-8') + b"\n"
+                    rows[row] = (source_id, index, offset)
+                    texts.write(data)
+                    offset += len(data)
+            with open(self._vectors_path, 'ab') as file:
+                file.write(vectors.tobytes())
+            with open(self._rows_path, 'ab') as file:
+                file.write(rows.tobytes())
+            self._count += len(kept)
+
+    def index_file(self, path: str):
+        """
+        (Re)indexes every message of a chat log.
+        """
+        self.update_source(path, read_chatlog(path))
+
+    def sync(self, patterns: List[str]):
+        """
+        Indexes the chat logs that are new or changed since they were last synced. Messages of
+        logs that were deleted stay in the index, so they can still be recalled.
+
+        :param patterns: Glob patterns of the chat logs.
+        """
+        for pattern in patterns:
+            for path in glob.glob(pattern):
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                signature = [stat.st_size, stat.st_mtime]
+                if self._sources.get(path) == signature:
+                    continue
+                try:
+                    self.index_file(path)
+                except Exception:
+                    continue  # Unreadable files are retried on the next sync
+                self._sources[path] = signature
+        with self._lock:
+            try:
+                with open(self._sources_path, 'w') as file:
+                    json.dump(self._sources, file)
+            except OSError:
+                pass
+
+    def search(self, query: str, limit: int = 10, exclude: Iterable[str] = ()) -> List[Dict]:
+        """
+        Returns the messages most similar to query, best first.
+
+        :param query: The text to find similar messages to.
+        :param limit: The maximum number of results.
+        :param exclude: Contents not to return, e.g. the messages already in the history.
+        :return: The source, position, role, content and score of each message.
+        """
+        vector = embed([query])[0]
+        if not vector.any():
+            return []
+        with self._lock:
+            if not self._count:
+                return []
+            self._map()
+            vectors, rows = self._vectors, self._rows
+        scores = vectors @ vector
+        # Ask for a few extra candidates, some may be excluded
+        candidates = min(limit + 8, len(scores))
+        best = np.argpartition(scores, -candidates)[-candidates:]
+        best = best[np.argsort(scores[best])[::-1]]
+        # Compared as stored, long messages are cut to MAX_STORED_CHARS
+        excluded = {content[:MAX_STORED_CHARS] for content in exclude}
+        results = []
+        with open(self._texts_path, 'rb') as texts:
+            for index in best:
+                score = float(scores[index])
+                if score < self.min_score or len(results) == limit:
+                    break
+                texts.seek(int(rows[index, 2]))
+                record = json.loads(texts.readline())
+                if record["content"] in excluded:
+                    continue
+                record["score"] = score
+                results.append(record)
+        return results
+
+    def recall(self, query: str, history: List[Dict[str, str]]) -> Optional[str]:
+        """
+        Returns the past messages relevant to query as one block of text for the request, or
+        None if there are none. Messages still in the history are left out.
+        """
+        results = self.search(query, self.max_results, (message['content'] for message in history))
+        parts = []
+        tokens = 0
+        for result in results:
+            part = f"[{result['role'].capitalize()}, {result['source']}]\n{result['content']}"
+            tokens += count_tokens(part)
+            if tokens > self.max_tokens:
+                break
+            parts.append(part)
+        if not parts:
+            return None
+        return "Possibly relevant messages from earlier conversations:\n\n" + "\n\n".join(parts)
@@ -0,0 +1,105 @@
+import os
+import re
+import threading
+from typing import List, Dict, Optional
+from chatbot import ChatBot
+
+TITLE_PROMPT = "Think deeply about the conversation and give it an appropriate title. The title should be short and concise, replace the spaces with '_'. Don't wirte as markdown format."
+
+
+def sanitize_title(title: str) -> str:
+    """
+    Turns a model-written title into something safe to use as a filename.
+    """
+    return re.sub(r"[^\w\-]+", "_", title).strip("_")[:80]
+
+
+class TitleGenerator:
+    """
+    Generates a title for the conversation in a worker thread after every turn, so that it
+    is ready when the user exits. It uses a cheap model and only the end of the conversation,
+    and never touches the chat history.
+    """
+
+    def __init__(
+        self,
+        bot: ChatBot,
+        model: Optional[str] = None,
+        context_messages: int = 6,
+        max_message_chars: int = 1000
+    ):
+        """
+        :param bot: The chatbot whose client is used for the requests.
+        :param model: (Optional) The model that writes titles. Defaults to the TITLE_MODEL
+                      environment variable, or gpt-4o-mini.
+        :param context_messages: How many of the newest messages the title is based on.
+        :param max_message_chars: How much of each message the title is based on.
+        """
+        self.bot = bot
+        self.model = model or os.getenv('TITLE_MODEL', 'gpt-4o-mini')
+        self.context_messages = context_messages
+        self.max_message_chars = max_message_chars
+
+        self._condition = threading.Condition()
+        self._pending: Optional[List[Dict[str, str]]] = None  # Newest conversation without a title yet
+        self._version = 0  # Bumped on every update
+        self._title: Optional[str] = None
+        self._title_version = 0  # Version the current title was generated for
+        self._busy = False
+        self._thread: Optional[threading.Thread] = None
+
+    def update(self, chat_history: List[Dict[str, str]]):
+        """
+        Schedules a title for the conversation as it is now. If a title is already being
+        generated, only the newest conversation is generated next.
+        """
+        context = [{"role": message["role"], "content": message["content"][:self.max_message_chars]}
+                   for message in chat_history[-self.context_messages:]]
+        with self._condition:
+            self._version += 1
+            self._pending = context
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="title-generator", daemon=True)
+                self._thread.start()
+            self._condition.notify_all()
+
+    def _build_messages(self, context: List[Dict[str, str]]) -> List[Dict[str, str]]:
+        transcript = "\n\n".join(
+            f"{'User' if message['role'] == 'user' else 'Assistant'}: {message['content']}"
+            for message in context
+        )
+        return [{"role": "user", "content": f"{transcript}\n\n{TITLE_PROMPT}"}]
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._pending is None:
+                    self._condition.wait()
+                context, version = self._pending, self._version
+                self._pending = None
+                self._busy = True
+            try:
+                title = sanitize_title(self.bot.complete(self._build_messages(context), self.model))
+            except Exception:
+                title = None  # Retried on the next update, or when the title is requested
+            with self._condition:
+                self._busy = False
+                if title:
+                    self._title, self._title_version = title, version
+                self._condition.notify_all()
+
+    def get_title(self, timeout: Optional[float] = 30) -> Optional[str]:
+        """
+        Returns the title of the conversation. Returns at once if the title of the newest
+        conversation is ready, otherwise waits up to timeout seconds for it and then falls
+        back to the newest title available.
+
+        :param timeout: The maximum number of seconds to wait.
+        :return: The title, or None if none could be generated.
+        """
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self._title_version == self._version or not (self._busy or self._pending),
+                timeout=timeout
+            )
+            return self._title
@@ -0,0 +1,80 @@
+import re
+from functools import lru_cache
+from typing import Dict
+
+
+# Context window of each model in tokens, matched by the longest prefix of the model name
+MODEL_CONTEXT_WINDOWS = {
+    'gpt-4o-mini': 128000,
+    'gpt-4o': 128000,
+    'o1-preview': 128000,
+    'o1-mini': 128000,
+}
+DEFAULT_CONTEXT_WINDOW = 8192
+# Models that take no system prompt, matched by prefix
+MODELS_WITHOUT_SYSTEM_PROMPT = ('o1',)
+
+DEFAULT_REPLY_RESERVE = 4096  # Tokens kept free for the assistant's reply
+MESSAGE_OVERHEAD = 4  # Role and separator tokens the API adds around every message
+REPLY_PRIMING = 3  # Tokens the API adds to prime the assistant's reply
+
+# Words, short digit runs and single symbols, roughly how BPE tokenizers split ASCII text
+_ASCII_PIECES = re.compile(r"[A-Za-z]+|\d{1,3}|[^\sA-Za-z\d]")
+
+
+def get_context_window(model: str) -> int:
+    """
+    Returns the context window of the model, or a conservative default for unknown models.
+    """
+    model = model.lower()
+    matches = [prefix for prefix in MODEL_CONTEXT_WINDOWS if model.startswith(prefix)]
+    if not matches:
+        return DEFAULT_CONTEXT_WINDOW
+    return MODEL_CONTEXT_WINDOWS[max(matches, key=len)]
+
+
+def supports_system_prompt(model: str) -> bool:
+    """
+    Returns whether requests to the model may contain a system message.
+    """
+    return not model.lower().startswith(MODELS_WITHOUT_SYSTEM_PROMPT)
+
+
+@lru_cache(maxsize=1)
+def _get_encoding():
+    try:
+        import tiktoken
+    except ImportError:  # tiktoken is optional, count_tokens falls back to an estimate
+        return None
+    try:
+        return tiktoken.get_encoding("o200k_base")
+    except Exception:  # The encoding file could not be loaded (e.g. offline on first use)
+        return None
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Estimates the token count of text without a tokenizer.
+    Calibrated to slightly overestimate o200k_base on English, code and Korean text.
+    """
+    ascii_text = text.encode('ascii', 'ignore').decode('ascii')
+    tokens = sum(1 + (len(piece) - 1) // 6 for piece in _ASCII_PIECES.findall(ascii_text))
+    # Characters outside ASCII (Hangul, CJK, emoji, ...) are about one token each
+    return tokens + len(text) - len(ascii_text)
+
+
+def count_tokens(text: str) -> int:
+    """
+    Counts the tokens in text, using tiktoken when it is available.
+    """
+    encoding = _get_encoding()
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(message: Dict[str, str]) -> int:
+    """
+    Counts the tokens a chat message takes up in a request.
+    """
+    return MESSAGE_OVERHEAD + count_tokens(message['content'])
@@ -3,17 +3,21 @@ from rich.prompt import Prompt
 from rich.panel import Panel
 from rich.text import Text
 from rich.table import Table
-from rich.columns import Columns
-from rich.markdown import Markdown
-from rich.measure import measure_renderables
-from typing import Optional
+from functools import lru_cache
+from itertools import chain
+from typing import Optional, Iterable, List
+import os
+import time
 
 console = Console()
 
 def create_oneline(style: str = 'blue cyan', title: str = None):
-    console = Console()  # Create a console object
+    # Rules are built once per style, title and terminal width; a resize builds new ones
+    return _create_oneline(style, title, console.width)
+
+@lru_cache(maxsize=64)
+def _create_oneline(style: str, title: Optional[str], width: int):
     border_char = "─"  # Border character
-    width = console.width
 
     if title:
         length_of_title = len(title)
@@ -48,11 +52,20 @@ def print_welcome():
     commands = [
         ["/change_model <model_name>", "Change the AI model."],
         ["/model_list", "List the available models."],
+        ["/auto [on|off|status]", "Choose the model of every turn automatically, or show what it is based on."],
+        ["/compare [model ...]", "Ask several models the same question side by side."],
         ["/undo", "Remove the last interaction."],
+        ["/redo [number]", "Restore the last removed interaction, or another one removed at this point."],
+        ["/attach <path>", "Attach the parts of a file that best match your next question."],
         ["/copy", "Copy the last bot response to the clipboard"],
+        ["/export_all [md|html|json ...]", "Export all cached chat logs in the background."],
         ["/history_list", "List all cached chat logs."],
         ["/load_history", "Load a previous chat history by filename."],
+        ["/search <query>", "Search all saved chat logs and conversations."],
         ["/clear_history", "Clear the conversation history."],
+        ["/budget", "Show how much of the context window is in use."],
+        ["/stats", "Show latency percentiles for this session."],
+        ["/cache [clear]", "Show response cache statistics, or clear the cache."],
         ["/help", "Show help message."],
         ["/exit or /quit or /bye", "Exit the chat."]
     ]
@@ -77,10 +90,106 @@ def print_user_message(title:str = None):
     else:
         console.print(create_oneline(style = 'bold cyan'))
 
+# Markdown (with its parser and syntax highlighter) and Live are imported on first use,
+# they are not needed to show the welcome screen.
+
+MARKDOWN_CHUNK_LINES = 50  # Long replies are parsed and printed in chunks of about this many lines
+
+class MarkdownChunker:
+    """
+    Splits Markdown, as it arrives, into self-contained chunks of about max_lines lines, so
+    a long reply is never parsed as a whole. Chunks end at blank lines outside code blocks;
+    a very long code block is split by closing its fence and opening it again.
+    """
+
+    def __init__(self, max_lines: int = MARKDOWN_CHUNK_LINES):
+        self.max_lines = max_lines
+        self._lines: List[str] = []  # Complete lines not in a chunk yet
+        self._partial = ""  # The unfinished last line
+        self._fence: Optional[str] = None  # Opening line of the code block the text is in
+        self._marker = ""
+
+    def feed(self, text: str) -> List[str]:
+        """
+        Adds text and returns the chunks it completed.
+        """
+        chunks = []
+        lines = (self._partial + text).split("\n")
+        self._partial = lines.pop()
+        for line in lines:
+            stripped = line.lstrip()
+            if self._fence is None and stripped[:3] in ("```", "~~~"):
+                if len(self._lines) >= self.max_lines:
+                    chunks.append("\n".join(self._lines))
+                    self._lines = []
+                self._fence, self._marker = line, stripped[:3]
+            elif self._fence is not None and stripped.startswith(self._marker) and not stripped.strip(self._marker[0]):
+                self._fence = None
+            self._lines.append(line)
+
+            if self._fence is None:
+                # Prefer a blank line, but do not wait forever for one
+                if (not line.strip() and len(self._lines) >= self.max_lines) or len(self._lines) >= 4 * self.max_lines:
+                    chunks.append("\n".join(self._lines))
+                    self._lines = []
+            elif len(self._lines) >= self.max_lines:
+                chunks.append("\n".join(self._lines + [self._marker]))
+                self._lines = [self._fence]
+        return chunks
+
+    def tail(self) -> str:
+        """
+        Returns the text that is not in a chunk yet.
+        """
+        return "\n".join(self._lines + [self._partial])
+
 def print_bot_message(message: str):
+    from rich.markdown import Markdown
+    console.print(create_oneline(title = "Assistant", style = 'bold magenta'))
+    console.print()
+    chunker = MarkdownChunker()
+    for chunk in chunker.feed(message) + [chunker.tail()]:
+        console.print(Markdown(chunk))
+    console.print()
+    console.print(create_oneline(style = 'bold magenta'))
+
+def print_bot_message_stream(chunks: Iterable[str], refresh_per_second: int = 10) -> str:
+    """
+    Renders a streamed reply live as Markdown and returns the full message.
+    Only the unfinished end of the reply is live and it is only redrawn when it changed;
+    finished chunks are printed above it once, so a long reply costs the same per refresh
+    as a short one.
+    """
+    from rich.markdown import Markdown
+    from rich.live import Live
     console.print(create_oneline(title = "Assistant", style = 'bold magenta'))
-    console.print(Markdown(f"\n{message}\n"))
+    console.print()
+    chunks = iter(chunks)
+    with console.status("Working on tasks...", spinner="dots"):
+        first = next(chunks, None)
+    parts = []
+    chunker = MarkdownChunker()
+    finished = []
+    interval = 1 / refresh_per_second
+    last_render = 0.0
+    with Live(console=console, auto_refresh=False, vertical_overflow="visible") as live:
+        for chunk in chain([first] if first is not None else [], chunks):
+            parts.append(chunk)
+            finished.extend(chunker.feed(chunk))
+            now = time.monotonic()
+            # Parsing Markdown is the expensive part, so only do it once per refresh
+            if now - last_render >= interval:
+                for block in finished:
+                    live.console.print(Markdown(block))
+                finished.clear()
+                live.update(Markdown(chunker.tail()), refresh=True)
+                last_render = now
+        for block in finished:
+            live.console.print(Markdown(block))
+        live.update(Markdown(chunker.tail()), refresh=True)
+    console.print()
     console.print(create_oneline(style = 'bold magenta'))
+    return "".join(parts)
 
 def print_error(message: str):
     console.print(f"[bold red]Error:[/bold red] {message}")
@@ -93,15 +202,57 @@ def print_prompt_save_conversation(summary: str) -> bool:
     yes_or_no = Prompt.ask(prompt_text, choices=["yes", "no"], default="no")
     return yes_or_no
 
-def print_cache_chat_logs(chat_cache_list:list):
-    console.print("[bold yellow]Chat History[/bold yellow]")
-    # columns = Columns(chat_cache_list, equal=True, expand=True)
-    total_text= ""
-    for filename in chat_cache_list:
-        total_text+=f"- {filename}\n"
-    console.print(total_text)
+def print_cache_chat_logs(chat_cache_list:list, limit: int = 50):
+    if not chat_cache_list:
+        print_info("No cached chat logs found.")
+        return
+    older = len(chat_cache_list) - limit
+    caption = f"{older} older chat logs not shown" if older > 0 else None
+    chat_cache_list = chat_cache_list[-limit:]  # The list is oldest first
+    table = Table(title="Chat History", caption=caption, show_header=True, header_style="bold blue")
+    table.add_column("File", style="cyan", no_wrap=True)
+    table.add_column("Title", style="magenta")
+    table.add_column("Messages", justify="right")
+    table.add_column("Size", justify="right")
+    table.add_column("Modified")
+    for entry in chat_cache_list:
+        table.add_row(entry['name'], entry.get('title') or "-", str(entry['messages']),
+                      f"{entry['size'] / 1024:.1f} KiB", time.strftime("%Y-%m-%d %H:%M", time.localtime(entry['mtime'])))
+    console.print(table)
         
 
+def print_compare_results(results: dict):
+    from rich.markdown import Markdown
+    panels = []
+    for model, (answer, elapsed) in results.items():
+        if isinstance(answer, Exception):
+            body = Text(f"Error: {answer}", style="bold red")
+        else:
+            body = Markdown(answer)
+        panels.append(Panel(body, title=f"[bold magenta]{model}[/bold magenta]",
+                            subtitle=f"{elapsed:.1f}s"))
+    grid = Table.grid(expand=True, padding=(0, 1))
+    for _ in panels:
+        grid.add_column(ratio=1)
+    grid.add_row(*panels)
+    console.print(grid)
+
+def print_search_results(results: list, match_start: str, match_end: str):
+    if not results:
+        print_info("No matching messages found.")
+        return
+    table = Table(title="Search Results", show_header=True, header_style="bold blue")
+    table.add_column("File", style="cyan")
+    table.add_column("Role", style="magenta")
+    table.add_column("Message")
+    for result in results:
+        snippet = Text()
+        # Matched terms are wrapped in match_start/match_end, highlight them
+        for i, part in enumerate(result['snippet'].replace(match_end, match_start).split(match_start)):
+            snippet.append(part, style="bold yellow" if i % 2 else None)
+        table.add_row(os.path.basename(result['source']), result['role'], snippet)
+    console.print(table)
+
 def print_model_list(models: list):
     table = Table(title="Available Models", show_header=True, header_style="bold blue")
     table.add_column("Model Name", style="cyan")
@@ -109,6 +260,81 @@ def print_model_list(models: list):
         table.add_row(model)
     console.print(table)
 
+def print_budget_usage(usage: dict):
+    table = Table(title=f"Token Budget ({usage['model']})", show_header=True, header_style="bold blue")
+    table.add_column("Item", style="cyan")
+    table.add_column("Tokens", style="magenta", justify="right")
+    table.add_row("Context window", str(usage['context_window']))
+    table.add_row("System prompt", str(usage['system_prompt_tokens']))
+    table.add_row("Reserved for reply", str(usage['reply_reserve']))
+    table.add_row(f"History ({usage['messages']} messages)", f"{usage['history_tokens']} / {usage['history_budget']}")
+    console.print(table)
+
+def print_cache_stats(stats: dict):
+    table = Table(title="Response Cache", show_header=True, header_style="bold blue")
+    table.add_column("Hits", style="cyan", justify="right")
+    table.add_column("Misses", style="cyan", justify="right")
+    table.add_column("Entries", style="magenta", justify="right")
+    table.add_column("Size", style="magenta", justify="right")
+    table.add_row(str(stats['hits']), str(stats['misses']), str(stats['entries']), f"{stats['bytes'] / 1024:.1f} KiB")
+    console.print(table)
+
+def print_stats(summary: dict, scheduler_metrics: dict):
+    if not summary['models'] and not summary['stages']:
+        print_info("No turns have been measured yet.")
+        return
+
+    def seconds(stats):
+        if not stats:
+            return "-", "-", "-"
+        return tuple(f"{stats[key] * 1000:.0f} ms" for key in ("p50", "p95", "p99"))
+
+    if summary['models']:
+        table = Table(title="Per Model", show_header=True, header_style="bold blue")
+        table.add_column("Model", style="cyan")
+        table.add_column("Turns", justify="right")
+        for name in ("TTFT", "Latency"):
+            for key in ("p50", "p95", "p99"):
+                table.add_column(f"{name} {key}", style="magenta", justify="right")
+        table.add_column("Tokens/s p50", justify="right")
+        table.add_column("Cached prompt", justify="right")
+        for model, stats in summary['models'].items():
+            latency = stats['latency']
+            tokens_per_second = stats['tokens_per_second']
+            cache_hit_rate = stats['cache_hit_rate']
+            table.add_row(model, str(latency['count'] if latency else 0), *seconds(stats['ttft']), *seconds(latency),
+                          f"{tokens_per_second['p50']:.0f}" if tokens_per_second else "-",
+                          f"{cache_hit_rate:.0%}" if cache_hit_rate is not None else "-")
+        console.print(table)
+
+    if summary['stages']:
+        table = Table(title="Per Stage", show_header=True, header_style="bold blue")
+        table.add_column("Stage", style="cyan")
+        table.add_column("Count", justify="right")
+        for key in ("p50", "p95", "p99"):
+            table.add_column(key, style="magenta", justify="right")
+        for stage, stats in summary['stages'].items():
+            table.add_row(stage, str(stats['count']), *seconds(stats))
+        console.print(table)
+
+    console.print("Requests: " + ", ".join(f"{name.replace('_', ' ')} {count}" for name, count in scheduler_metrics.items()))
+
+def print_router_status(status: dict, enabled: bool):
+    table = Table(title=f"Automatic Model Selection ({'on' if enabled else 'off'})", show_header=True, header_style="bold blue")
+    table.add_column("Model", style="cyan")
+    table.add_column("Turns", justify="right")
+    table.add_column("TTFT", style="magenta", justify="right")
+    table.add_column("Tokens/s", style="magenta", justify="right")
+    table.add_column("Reply tokens", justify="right")
+    table.add_column("Avoided for", justify="right")
+    for model, stats in status.items():
+        table.add_row(model, str(stats['turns']),
+                      f"{stats['ttft'] * 1000:.0f} ms" if stats['ttft'] is not None else "-",
+                      f"{stats['tokens_per_second']:.0f}" if stats['tokens_per_second'] else "-",
+                      f"{stats['reply_tokens']:.0f}" if stats['reply_tokens'] is not None else "-",
+                      f"{stats['degraded_for']:.0f} s" if stats['degraded_for'] else "-")
+    console.print(table)
+
 def print_help():
     print_welcome()
 